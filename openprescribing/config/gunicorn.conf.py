@@ -4,8 +4,11 @@
 # pragma: no cover file
 import os
 
-from opentelemetry import trace
+from opentelemetry import metrics, trace
+from opentelemetry.exporter.otlp.proto.http.metric_exporter import OTLPMetricExporter
 from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
 from opentelemetry.sdk.resources import Resource
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
@@ -20,8 +23,8 @@ wsgi_app = "openprescribing.config.wsgi"
 #  1. Almost all the CPU-bound heavy lifting is done by third-party modules (duckdb,
 #     sqlite3, numpy, pyarrow) which release the GIL during execution.
 #
-#  2. It relies on the standard library `functools.cache` decorator to hold expensive
-#     results in memory. This is shared between threads but not between processes.
+#  2. It relies on in-memory caches (see `data.utils.cache_metrics`) to hold expensive
+#     results. These are shared between threads but not between processes.
 #
 # For these reasons we're better off having a single worker process running multiple
 # threads than using the more traditional gunicorn setup of multiple worker processes.
@@ -45,6 +48,12 @@ def post_fork(server, worker):
     trace.set_tracer_provider(TracerProvider(resource=resource))
     span_processor = BatchSpanProcessor(OTLPSpanExporter())
     trace.get_tracer_provider().add_span_processor(span_processor)
+    # Metrics (e.g. the cache metrics from `data.utils.cache_metrics`) are exported
+    # periodically, every 60s by default
+    metric_reader = PeriodicExportingMetricReader(OTLPMetricExporter())
+    metrics.set_meter_provider(
+        MeterProvider(resource=resource, metric_readers=[metric_reader])
+    )
 
     from opentelemetry.instrumentation.auto_instrumentation import (  # noqa: F401
         sitecustomize,
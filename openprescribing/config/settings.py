@@ -87,12 +87,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "openprescribing.web.middleware.ServerTimingMiddleware",
+    "openprescribing.web.middleware.RequestCaptureMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "openprescribing.web.middleware.QueryErrorMiddleware",
 ]
 
 ROOT_URLCONF = "openprescribing.web.urls"
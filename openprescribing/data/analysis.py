@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import hashlib
+import json
 from dataclasses import dataclass
 
 from .bnf_query import BNFQuery
@@ -74,3 +76,9 @@ class Analysis:
             analysis_dict["org_id"] = self.org_id
 
         return analysis_dict
+
+    def get_hash(self):
+        """Return a short hash which is the same for equivalent analyses."""
+
+        analysis_json = json.dumps(self.to_dict(), sort_keys=True, default=str)
+        return hashlib.sha256(analysis_json.encode()).hexdigest()[:16]
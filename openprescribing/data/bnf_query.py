@@ -9,6 +9,8 @@ from django.db.models import Q
 
 from openprescribing.data import rxdb
 from openprescribing.data.models.dmd import VTM, Ing, OntFormRoute
+from openprescribing.data.utils import timing
+from openprescribing.data.utils.cache_metrics import metered_cache
 
 from .models import BNFCode
 
@@ -20,16 +22,9 @@ class ProductType(StrEnum):
 
 
 def _get_bnf_codes_for_form_routes(form_routes):
-    with rxdb.get_cursor() as cursor:
-        results = cursor.execute(
-            """
-            SELECT bnf_code
-            FROM medications
-            WHERE list_has_any(form_routes, ?)
-            """,
-            [list(form_routes)],
-        )
-        return [x[0] for x in results.fetchall()]
+    return _get_bnf_codes_for_medications_matching(
+        "list_has_any(form_routes, ?)", tuple(form_routes)
+    )
 
 
 def _expand_forms_and_routes(forms, routes):
@@ -52,27 +47,34 @@ def _expand_forms_and_routes(forms, routes):
 
 
 def _get_bnf_codes_for_ingredient_ids(ingredient_ids):
-    with rxdb.get_cursor() as cursor:
-        results = cursor.execute(
-            f"""
-            SELECT bnf_code
-            FROM medications
-            WHERE list_has_any(ingredient_ids, [{", ".join(str(i) for i in ingredient_ids)}])
-            """
-        )
-        return [x[0] for x in results.fetchall()]
+    return _get_bnf_codes_for_medications_matching(
+        "list_has_any(ingredient_ids, ?)", tuple(int(i) for i in ingredient_ids)
+    )
 
 
 def _get_bnf_codes_for_vtm_ids(vtm_ids):
+    return _get_bnf_codes_for_medications_matching(
+        "list_contains(?, vtm_id)", tuple(int(i) for i in vtm_ids)
+    )
+
+
+def _get_bnf_codes_for_medications_matching(condition, values):
     with rxdb.get_cursor() as cursor:
-        results = cursor.execute(
-            f"""
-            SELECT bnf_code
-            FROM medications
-            WHERE vtm_id IN ({", ".join(str(i) for i in vtm_ids)})
-            """
-        )
-        return [x[0] for x in results.fetchall()]
+        return _get_bnf_codes_for_medications_matching_cached(cursor, condition, values)
+
+
+# These lookups run every time a query using them is resolved, and the same few values
+# come up again and again. Cursors compare equal when they're over the same data, so
+# each result is cached until the data next changes.
+MEDICATIONS_LOOKUP_CACHE_SIZE = 1024
+
+
+@metered_cache(maxsize=MEDICATIONS_LOOKUP_CACHE_SIZE)
+def _get_bnf_codes_for_medications_matching_cached(cursor, condition, values):
+    results = cursor.execute(
+        f"SELECT bnf_code FROM medications WHERE {condition}", [list(values)]
+    )
+    return tuple(x[0] for x in results.fetchall())
 
 
 @dataclass(frozen=True)
@@ -245,13 +247,16 @@ class BNFQuery:
         if errors:
             raise ValueError("Invalid BNFQuery values:\n" + "\n".join(errors))
 
-    def to_sql(self):
+    def to_sql(self, codes=None):
         """Return SQL that returns items prescribed for codes matching query.
 
-        The query returns one row for each practice for each month with data.
+        The query returns one row for each practice for each month with data. If the
+        matching `codes` have already been found then they can be passed in to save
+        finding them again.
         """
 
-        codes = self.get_matching_presentation_codes()
+        if codes is None:
+            codes = self.get_matching_presentation_codes()
 
         if codes:
             return f"""
@@ -272,6 +277,12 @@ class BNFQuery:
         Returned codes are strings, not BNFCode instances.
         """
 
+        with timing.span("bnf.resolve") as counts:
+            codes = self._get_matching_presentation_codes()
+            counts["codes"] = len(codes)
+        return codes
+
+    def _get_matching_presentation_codes(self):
         includes = [build_q_for_bnf_code(code) for code in self.bnf_codes]
         excludes = [build_q_for_bnf_code(code) for code in self.bnf_codes_excluded]
 
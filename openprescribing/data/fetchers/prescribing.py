@@ -4,6 +4,11 @@ import re
 
 from openprescribing.data.utils.filename_utils import get_latest_files_by_date
 from openprescribing.data.utils.http_session import HTTPSession
+from openprescribing.data.utils.prescribing_file_utils import (
+    get_sorted_dir,
+    get_sorted_filename_for,
+    write_sorted_file,
+)
 from openprescribing.data.utils.remote_csv_utils import remote_zipped_csv_to_parquet
 
 
@@ -21,6 +26,7 @@ def fetch(directory):
         dataset_id="english-prescribing-data-epd",
         version_number=2,
     )
+    sort_files(directory)
 
 
 def fetch_dataset(directory, dataset_id, version_number):
@@ -58,6 +64,30 @@ def fetch_dataset(directory, dataset_id, version_number):
         log.info(f"Saved as: {output_filename}")
 
 
+def sort_files(directory):
+    # The ingestor reads a sorted copy of each file where there is one, which is much
+    # quicker to build from than the file as published (see `write_sorted_file`). We
+    # write any that are missing, which includes those for files fetched before we
+    # started doing this.
+    files_by_date = get_latest_files_by_date((directory / "prescribing").glob("*"))
+    sorted_filenames = set()
+    for date, filename in sorted(files_by_date.items()):
+        sorted_filename = get_sorted_filename_for(filename)
+        if not sorted_filename.exists():
+            log.info(f"Sorting: {filename.name}")
+            write_sorted_file(date, filename, sorted_filename)
+        sorted_filenames.add(sorted_filename)
+
+    # Anything else is a copy of a file which has since been replaced, a copy in an
+    # older format, or left over from a failed sort
+    for path in sorted(get_sorted_dir(directory).rglob("*"), reverse=True):
+        if path.is_file() and path not in sorted_filenames:
+            log.info(f"Deleting stale sorted file: {path.name}")
+            path.unlink()
+        elif path.is_dir() and not any(path.iterdir()):
+            path.rmdir()
+
+
 def get_items_to_fetch(existing_files, response_data, version_number):
     """
     Prescribing data are published in monthly releases, three months in arrears. Whilst
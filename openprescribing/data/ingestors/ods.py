@@ -5,7 +5,7 @@ import duckdb
 from django.conf import settings
 from django.db import transaction
 
-from openprescribing.data.models import IngestedFile, Org
+from openprescribing.data.models import IngestedFile, Org, OrgRelation
 from openprescribing.data.utils.duckdb_utils import escape
 
 
@@ -51,93 +51,171 @@ def ingest_ods(conn):
         OrgType.OTHER: "primaryRoleName = 'PRESCRIBING COST CENTRE' AND 'GP PRACTICE' NOT IN roleName",
     }
 
+    # Work out all the orgs and the relationships between them in DuckDB, so that we
+    # can create them with a couple of bulk inserts rather than one at a time. We start
+    # with a table of orgs of each type, along with the position of their type in the
+    # hierarchy.
+    org_type_queries = [
+        f"""
+        SELECT
+            id, name, inactive,
+            {escape(org_type.value)} AS org_type,
+            {list(OrgType).index(org_type)} AS org_type_rank,
+            -- Combine the various fields which can only contain a single related
+            -- org ID into a single list
+            [RE4, ICB, NHSER] AS related_ids,
+            -- Keep the field which can contain multiple related org IDs separate.
+            -- This is used for the relationship between PCNs and Practices/Others.
+            isPartnerToCode AS partner_ids
+        FROM
+            ods
+        WHERE
+            country = 'ENGLAND' AND ({where_clause})
+        """
+        for org_type, where_clause in ORG_TYPE_QUERIES.items()
+    ]
+    conn.sql(
+        "CREATE OR REPLACE TEMPORARY TABLE ods_org AS "
+        + " UNION ALL ".join(org_type_queries)
+    )
+
+    unexpected_partners = conn.sql(
+        f"""
+        SELECT COUNT(*) FROM ods_org
+        WHERE
+            org_type NOT IN ({escape(OrgType.PRACTICE.value)}, {escape(OrgType.OTHER.value)})
+            AND len(partner_ids) > 0
+        """
+    ).fetchone()[0]
+    assert unexpected_partners == 0, "Only Practices and Others can have partners"
+
+    create_practice_pcn_table(conn)
+
+    # The relations we get in the data don't specify the parent/child direction.
+    # However, as the org types are in strictly hierarchical order, a relationship with
+    # an org of an earlier type is a child->parent relationship.
+    relations = conn.sql(
+        """
+        WITH related AS (
+            SELECT
+                ods_org.id,
+                ods_org.org_type_rank,
+                UNNEST(
+                    CASE
+                        WHEN len(ods_org.partner_ids) <= 1
+                            THEN ods_org.related_ids || ods_org.partner_ids
+                        ELSE list_append(ods_org.related_ids, ods_practice_pcn.pcn_id)
+                    END
+                ) AS related_id
+            FROM
+                ods_org
+            LEFT JOIN
+                ods_practice_pcn
+            ON
+                ods_org.id = ods_practice_pcn.practice_id
+        )
+        SELECT DISTINCT
+            related.id AS child_id,
+            parent.id AS parent_id
+        FROM
+            related
+        JOIN
+            ods_org AS parent
+        ON
+            related.related_id = parent.id
+            AND parent.org_type_rank < related.org_type_rank
+        ORDER BY
+            child_id, parent_id
+        """
+    ).fetchall()
+
     # Create a "dummy" organisation to represent all of NHS England and set it as the
     # parent of every other organisation. This avoids needing special logic elsewhere to
     # handle national totals.
-    nation = Org.objects.create(
+    nation = Org(
         id="ENGLAND", org_type=OrgType.NATION, name="NHS England", inactive=False
     )
+    orgs = [
+        Org(id=id_, org_type=org_type, name=name, inactive=inactive)
+        for id_, org_type, name, inactive in conn.sql(
+            """
+            SELECT id, org_type, name, inactive FROM ods_org
+            ORDER BY org_type_rank, id
+            """
+        ).fetchall()
+    ]
+    Org.objects.bulk_create([nation, *orgs])
+    OrgRelation.objects.bulk_create(
+        [OrgRelation(child_id=org.id, parent_id=nation.id) for org in orgs]
+        + [
+            OrgRelation(child_id=child_id, parent_id=parent_id)
+            for child_id, parent_id in relations
+        ]
+    )
 
-    known_ids = set()
-
-    for org_type in OrgType:
-        if org_type == OrgType.NATION:
-            continue
-
-        where_clause = ORG_TYPE_QUERIES[org_type]
-        results = conn.execute(
-            f"""
-            SELECT
-                id, name, inactive,
-                -- Combine the various fields which can only contain a single related
-                -- org ID into a single list
-                [RE4, ICB, NHSER] AS related_ids,
-                -- Keep the field which can contain multiple related org IDs separate.
-                -- This is used for the relationship between PCNs and Practices/Others.
-                isPartnerToCode AS partner_ids
-            FROM
-                ods
-            WHERE
-                country = 'ENGLAND' AND ({where_clause})
+    counts = {
+        org_type: (total, active)
+        for org_type, total, active in conn.sql(
+            """
+            SELECT org_type, COUNT(*), COUNT(*) FILTER (NOT inactive) FROM ods_org
+            GROUP BY org_type
             """
+        ).fetchall()
+    }
+    for org_type in ORG_TYPE_QUERIES:
+        total, active = counts.get(org_type.value, (0, 0))
+        log.info(
+            f"Ingested {total:,} orgs of {org_type!r} (of which {active:,} are active)"
         )
 
-        counts_by_status = {False: 0, True: 0}
-
-        for id_, name, inactive, related_ids, partner_ids in results.fetchall():
-            org = Org.objects.create(
-                id=id_, org_type=org_type, name=name, inactive=inactive
-            )
-
-            if org_type is Org.OrgType.PRACTICE or org_type is Org.OrgType.OTHER:
-                if len(partner_ids) <= 1:
-                    related_ids.extend(partner_ids)
-                else:
-                    today = datetime.date.today()
-                    # RO272 means PCN as noted elsewhere.
-                    # RE8 means "is partner to", which appears to be the standard
-                    # relationship of a Practice to a PCN.
-                    sql = """
-                        SELECT id FROM
-                            ods,
-                            UNNEST(relationships['PRESCRIBING COST CENTRE']) AS t(rel)
-                        WHERE primaryRole='RO272' AND
-                            rel.sourceOrgCode = $1 AND
-                            rel.relationshipTypeCode = 'RE8' AND
-                            rel.opStartDate <= $2 AND
-                            ( rel.opEndDate >= $2 OR rel.opEndDate == '' )
-                        ORDER BY rel.opStartDate ASC;
-                    """
-                    parent_results = conn.execute(sql, [id_, str(today)]).fetchall()
-
-                    if len(parent_results) == 1:
-                        related_ids.append(parent_results[0][0])
-                    else:
-                        # It's still ambiguous which PCN this Practice/Other should be
-                        # attached to. This was observed with a Practice which had two
-                        # PCNs - one with an opStartDate five years ago & one with an
-                        # opStartDate three days ago. Neither had an opEndDate.
-                        # Let's take a guess that the earlier one is missing the opEndDate
-                        # and take the last matching record.
-                        related_ids.append(parent_results[-1][0])
-
-            else:
-                assert len(partner_ids) == 0
-
-            # The relations we get in the data don't specify the parent/child direction.
-            # However by creating orgs in strictly hierarchical order, and by only
-            # creating relationships where the target already exists we know that all
-            # the relationships are child->parent.
-            parent_ids = known_ids.intersection(related_ids)
-            org.parents.add(nation, *parent_ids)
-            known_ids.add(id_)
-            counts_by_status[inactive] += 1
-
-        total = sum(counts_by_status.values())
-        log.info(
-            f"Ingested {total:,} orgs of {org_type!r} "
-            f"(of which {counts_by_status[False]:,} are active)"
+    conn.sql("DROP TABLE ods_org")
+    conn.sql("DROP TABLE ods_practice_pcn")
+
+
+def create_practice_pcn_table(conn):
+    # Practices and Others are usually partnered with a single PCN. Where they have
+    # more than one, we look for the PCN with a current relationship with them.
+    #
+    # This needs the `relationships` data, which we only have for PCNs, so we only look
+    # at it if there are any Practices or Others we need it for.
+    ambiguous = conn.sql(
+        "SELECT COUNT(*) FROM ods_org WHERE len(partner_ids) > 1"
+    ).fetchone()[0]
+    if not ambiguous:
+        conn.sql(
+            """
+            CREATE OR REPLACE TEMPORARY TABLE ods_practice_pcn
+            (practice_id TEXT, pcn_id TEXT)
+            """
         )
+        return
+
+    # RO272 means PCN as noted elsewhere. RE8 means "is partner to", which appears to be
+    # the standard relationship of a Practice to a PCN.
+    #
+    # There may still be more than one PCN. This was observed with a Practice which had
+    # two PCNs - one with an opStartDate five years ago & one with an opStartDate three
+    # days ago. Neither had an opEndDate. We guess that the earlier one is missing the
+    # opEndDate and take the latest.
+    conn.sql(
+        """
+        CREATE OR REPLACE TEMPORARY TABLE ods_practice_pcn AS
+        SELECT
+            rel.sourceOrgCode AS practice_id,
+            arg_max(id, rel.opStartDate) AS pcn_id
+        FROM
+            ods,
+            UNNEST(relationships['PRESCRIBING COST CENTRE']) AS t(rel)
+        WHERE
+            primaryRole = 'RO272'
+            AND rel.relationshipTypeCode = 'RE8'
+            AND rel.opStartDate <= $today
+            AND (rel.opEndDate >= $today OR rel.opEndDate = '')
+        GROUP BY
+            rel.sourceOrgCode
+        """,
+        params={"today": str(datetime.date.today())},
+    )
 
 
 def verify_ods(conn):
@@ -1,27 +1,106 @@
+import concurrent.futures
+import contextlib
+import contextvars
 import logging
 import os
+import shutil
+import threading
 
 import duckdb
 from django.conf import settings
 
 from openprescribing.data.models.dmd import VMP
-from openprescribing.data.utils.duckdb_utils import escape
+from openprescribing.data.utils import timing
+from openprescribing.data.utils.duckdb_utils import escape, parse_memory_size
 from openprescribing.data.utils.filename_utils import (
     get_latest_files_by_date,
     get_temp_filename_for,
 )
+from openprescribing.data.utils.prescribing_file_utils import (
+    get_sorted_filename_for,
+    sql_for_raw_prescribing_files,
+)
 
 
 log = logging.getLogger(__name__)
 
 
-# Size of batch used when iterating over BNF codes for inserting data into
-# prescribing_norm table.  Larger batches consume more memory, so if ingestor is killed
-# by OOM killer, reducing the batch size may help.
-BNF_RANGE_BATCH_SIZE = int(os.environ.get("OPENPRESCRIBING_BNF_RANGE_BATCH_SIZE", 650))
+class IngestValidationError(Exception):
+    def __init__(self, anomalies):
+        self.anomalies = anomalies
+        super().__init__()
+
+    def __str__(self):
+        return "New prescribing database doesn't match the existing one:\n" + "\n".join(
+            f"  {anomaly}" for anomaly in self.anomalies
+        )
+
+
+# Fraction of DUCKDB_MEMORY_LIMIT which each batch of BNF codes should need when
+# inserting data into prescribing_norm table. We don't know exactly how much memory a
+# batch will need, so we estimate it from the number of rows of prescribing data it
+# covers (see `get_bnf_code_ranges`). Larger batches consume more memory, so if ingestor
+# is killed by OOM killer, reducing the fraction may help.
+BNF_RANGE_MEMORY_FRACTION = float(
+    os.environ.get("OPENPRESCRIBING_BNF_RANGE_MEMORY_FRACTION", 0.15)
+)
+
+# A rough estimate of the memory needed to normalise and sort a row of prescribing data,
+# which includes the source columns as well as the normalised ones
+ESTIMATED_BYTES_PER_ROW = 100
+
+# Number of BNF code ranges to process at once when building the prescribing_norm table.
+# Each worker needs memory for a whole batch, so this times BNF_RANGE_MEMORY_FRACTION
+# should be comfortably less than one. They share DuckDB's memory limit so more workers
+# means more spilling to disk rather than being OOM killed.
+INGEST_WORKERS = int(os.environ.get("OPENPRESCRIBING_INGEST_WORKERS", 4))
+
+# Dates are keyed by the number of months since this date (see `sql_for_date_table`)
+DATE_KEY_EPOCH = "2000-01-01"
+
+# Number of times we append new prescribing data to the existing database (see
+# `update_database`) before we rebuild it from scratch instead. Each append adds another
+# sorted run to the end of `prescribing_norm`, and the more runs there are the less
+# queries can skip, so rebuilding now and again puts the whole table back in order.
+MAX_APPENDED_RUNS = int(os.environ.get("OPENPRESCRIBING_MAX_APPENDED_RUNS", 6))
+
+# The largest relative change we accept in any of a month's totals between the database
+# we're replacing and the new one (see `validate_database`). Months are occasionally
+# republished with corrections, which change their totals slightly.
+VALIDATION_TOLERANCE = float(
+    os.environ.get("OPENPRESCRIBING_INGEST_VALIDATION_TOLERANCE", 0.05)
+)
+
+# As above, but for a month we didn't have before, which we compare with the nearest
+# month we did have. Prescribing varies from month to month (February is short, for
+# instance) so this needs to be looser.
+NEW_MONTH_VALIDATION_TOLERANCE = float(
+    os.environ.get("OPENPRESCRIBING_INGEST_NEW_MONTH_VALIDATION_TOLERANCE", 0.25)
+)
+
+# The totals for each month which we compare between the old and new databases
+VALIDATED_TOTALS = ["items", "net_cost", "actual_cost", "practices", "presentations"]
+
+# Seconds between samples of DuckDB's memory and temporary file use while ingesting,
+# from which we report the peaks (see `sample_resources`)
+RESOURCE_SAMPLE_INTERVAL = 1.0
+
+# Stages of a build which have been completed, and for `prescribing_norm` the BNF code up
+# to which it's been built (see `ingest_sources`)
+CHECKPOINT_COLUMNS = "stage TEXT, bnf_code TEXT"
+
+# The times we've appended a sorted run to `prescribing_norm` since the database was
+# built (see `update_database`)
+APPENDED_RUN_COLUMNS = "appended_at TIMESTAMP"
 
 
 def ingest(force=False):
+    """
+    Ingest any new prescribing and list size data into the prescribing database
+
+    Returns a report of the time each stage took and the resources DuckDB used (see
+    `get_ingest_report`), or None if there was nothing new to ingest.
+    """
     target_file = settings.PRESCRIBING_DATABASE
     prescribing_files = get_latest_files_by_date(
         settings.DOWNLOAD_DIR.glob("prescribing/*")
@@ -41,20 +120,12 @@ def ingest(force=False):
 
     all_files = sorted([*prescribing_files.values(), *list_size_files.values()])
 
-    conn = duckdb.connect()
-
-    # 16GB led to duckdb being OOM killed
-    conn.sql(f"SET memory_limit = '{settings.DUCKDB_MEMORY_LIMIT}';")
+    conn = connect()
 
-    # In production the container runs as user 10001, so we need
-    # to direct this to a directory where we have write access
-    conn.sql(f"SET temp_directory = '{settings.DUCKDB_TMP_DIRECTORY}';")
-    # At the time of writing, total imported db size is typically 22GB
-    # but 40GB was not sufficient tmp for an ingest
-    conn.sql(f"SET max_temp_directory_size = '{settings.DUCKDB_TMP_DIRECTORY_LIMIT}';")
-
-    if not force and target_file.exists():
+    if target_file.exists():
+        # We also check the database we build against this one before replacing it
         conn.sql(f"ATTACH {escape(target_file)} AS old (READONLY)")
+    if not force and target_file.exists():
         ingested_files = {
             f["filename"]
             for f in fetch_as_dicts(conn, "SELECT * FROM old.ingested_file")
@@ -72,34 +143,159 @@ def ingest(force=False):
     # We build the database in a new file, and atomically replace the old file with the
     # new one.
     target_file.parent.mkdir(parents=True, exist_ok=True)
-    tmp_file = get_temp_filename_for(target_file)
+
+    # If all the files we've already ingested are still current then we only need to add
+    # the new ones, which we do to a copy of the existing database rather than building
+    # a new one from scratch
+    incremental = (
+        ingested_files
+        and ingested_files <= {f.name for f in all_files}
+        and can_update_database(conn)
+    )
+    if incremental:
+        tmp_file = get_temp_filename_for(target_file)
+    else:
+        tmp_file = get_partial_filename_for(target_file)
 
     try:
-        build_database(conn, tmp_file, all_files, prescribing_files, list_size_files)
-        conn.close()
-        tmp_file.replace(target_file)
+        with timing.collect() as timings, sample_resources(conn) as resources:
+            if incremental:
+                new_files = [f for f in all_files if f.name not in ingested_files]
+                update_database(
+                    conn,
+                    target_file,
+                    tmp_file,
+                    new_files,
+                    prescribing_files,
+                    list_size_files,
+                )
+            else:
+                build_database(
+                    conn, tmp_file, all_files, prescribing_files, list_size_files
+                )
+
+            # Once we replace the existing database, the new one is what the site
+            # serves, so we check first that nothing has gone badly wrong
+            if target_file.exists():
+                log.info("Validating new database against existing one")
+                with timing.span("stage.validate"):
+                    validate_database(conn, force=force)
+    except BaseException:
+        # Building from scratch takes a long time so, if it fails partway through, we
+        # leave the partly built file where the next build can find it and carry on
+        # from where this one got to
+        if incremental:
+            tmp_file.unlink(missing_ok=True)
+        raise
     finally:
-        tmp_file.unlink(missing_ok=True)
+        # Close the connection whether or not the ingest succeeded, so that the file
+        # we've been building is no longer attached if the next ingest wants it
+        conn.close()
+    tmp_file.replace(target_file)
+
+    return get_ingest_report(timings, resources)
+
+
+def can_update_database(conn):
+    # Adding data to the existing database (attached as "old") relies on dates and
+    # practices having stable keys (see `sql_for_date_table`). Databases built before
+    # they did have to be rebuilt instead.
+    if not has_stable_keys(conn, "old"):
+        log.info("Rebuilding database which was built without stable keys")
+        return False
+
+    # Databases built before we recorded appended runs haven't had any
+    has_appended_runs = conn.sql(
+        """
+        SELECT COUNT(*) FROM duckdb_tables()
+        WHERE database_name = 'old' AND table_name = 'appended_run'
+        """
+    ).fetchone()[0]
+    if has_appended_runs:
+        appended_runs = count_table(conn, "old.appended_run")
+        if appended_runs >= MAX_APPENDED_RUNS:
+            log.info(f"Rebuilding database after {appended_runs} appended runs")
+            return False
+    return True
+
+
+def has_stable_keys(conn, database):
+    return bool(
+        conn.sql(
+            """
+            SELECT COUNT(*) FROM duckdb_columns()
+            WHERE
+                database_name = ?
+                AND table_name = 'prescribing_norm'
+                AND column_name = 'date_key'
+            """,
+            params=[database],
+        ).fetchone()[0]
+    )
+
+
+def connect():
+    conn = duckdb.connect()
+
+    # 16GB led to duckdb being OOM killed
+    conn.sql(f"SET memory_limit = '{settings.DUCKDB_MEMORY_LIMIT}';")
+
+    # In production the container runs as user 10001, so we need
+    # to direct this to a directory where we have write access
+    conn.sql(f"SET temp_directory = '{settings.DUCKDB_TMP_DIRECTORY}';")
+    # At the time of writing, total imported db size is typically 22GB
+    # but 40GB was not sufficient tmp for an ingest
+    conn.sql(f"SET max_temp_directory_size = '{settings.DUCKDB_TMP_DIRECTORY_LIMIT}';")
+
+    return conn
+
+
+def get_partial_filename_for(filename):
+    return filename.with_name(f".{filename.name}.partial")
 
 
 def build_database(conn, tmp_file, all_files, prescribing_files, list_size_files):
+    """
+    Build the database in `tmp_file` by ingesting all the data in `all_files`
+
+    If `tmp_file` already exists it was left by an earlier build which didn't finish,
+    and if that was building from the same files we carry on from the last stage it
+    completed (see `ingest_sources`). Otherwise we start again.
+    """
+    if tmp_file.exists() and not is_resumable(conn, tmp_file, all_files):
+        log.info("Discarding partly built database which can't be resumed")
+        tmp_file.unlink()
+        # DuckDB would otherwise replay the old database's write-ahead log into the new
+        tmp_file.with_name(f"{tmp_file.name}.wal").unlink(missing_ok=True)
+
     # Attach the file we're in the process of building under the schema name "new". The
     # STORAGE_VERSION setting allows us to opt-in to newer DuckDB file format features
     # which can't be read by older clients. If a newer release offers a feature we want
     # we can bump the version here.
+    resuming = tmp_file.exists()
     conn.sql(f"ATTACH {escape(tmp_file)} AS new (STORAGE_VERSION 'v1.2.0')")
 
-    # Record the names of the files we're ingesting
-    conn.sql("CREATE TABLE new.ingested_file (filename TEXT)")
-    conn.executemany(
-        "INSERT INTO new.ingested_file VALUES (?)",
-        [(f.name,) for f in all_files],
-    )
+    if resuming:
+        log.info("Resuming partly built database")
+    else:
+        # Record the names of the files we're ingesting, which tells later builds what
+        # this one was building if it doesn't finish
+        with transaction(conn):
+            conn.sql("CREATE TABLE new.ingested_file (filename TEXT)")
+            conn.executemany(
+                "INSERT INTO new.ingested_file VALUES (?)",
+                [(f.name,) for f in all_files],
+            )
+            conn.sql(f"CREATE TABLE new.build_checkpoint ({CHECKPOINT_COLUMNS})")
+            conn.sql(f"CREATE TABLE new.appended_run ({APPENDED_RUN_COLUMNS})")
 
     # Create views over all our source files, presenting each group of files as if they
     # were a single table. We then query these views to build the rest of the tables.
+    # Temporary views are only visible to the connection which created them, so the
+    # prescribing source goes in the in-memory database instead, where the workers in
+    # `ingest_sources` can see it too.
     conn.sql(
-        "CREATE TEMPORARY VIEW prescribing_source AS "
+        "CREATE VIEW memory.prescribing_source AS "
         + sql_for_prescribing_source_view(
             prescribing_files,
         )
@@ -110,60 +306,365 @@ def build_database(conn, tmp_file, all_files, prescribing_files, list_size_files
             list_size_files,
         )
     )
-    conn.sql(
-        "CREATE TEMPORARY VIEW bnf_code_changes_source AS "
-        + sql_for_bnf_code_changes_view(
-            settings.BNF_CODE_CHANGES_DIR / "bnf_code_mapping.csv"
-        )
-    )
-    create_vmp_code_changes_source(conn)
+    create_code_changes_sources(conn)
 
-    # Set the new database we're building as the default schema
+    # Set the new database we're building as the default schema, while still finding the
+    # prescribing source in the in-memory database
     conn.sql("USE new")
+    conn.sql("SET search_path = 'new.main,memory.main'")
 
     # Ingest all the data by querying the source views and writing the results to tables
     ingest_sources(conn)
 
 
-def sql_for_prescribing_source_view(prescribing_files_by_date):
-    # Return a query which reads from the supplied files and converts them into a
-    # single, unified consistent structure ready for us to build from
-
-    # We start by creating a query to read from each individual file
-    subqueries = [
-        f"""
+def validate_database(conn, force=False):
+    """
+    Compare the totals for each month in the database we've just built (attached as
+    "new") with those in the one it's replacing (attached as "old"), and raise an
+    `IngestValidationError` if they're too far apart
+
+    This is to catch a bad source file, or a bug in the ingest, before the data reaches
+    the site. If a large change is expected then VALIDATION_TOLERANCE and
+    NEW_MONTH_VALIDATION_TOLERANCE can be raised for that ingest. A forced ingest is
+    usually run to replace a database we know to be wrong, so then we only log any
+    anomalies.
+    """
+    anomalies = find_anomalies(
+        get_monthly_totals(conn, "old"), get_monthly_totals(conn, "new")
+    )
+    if anomalies and force:
+        log.warning(str(IngestValidationError(anomalies)))
+    elif anomalies:
+        raise IngestValidationError(anomalies)
+
+
+def get_monthly_totals(conn, database):
+    if has_stable_keys(conn, database):
+        # We total up the `prescribing_norm` table by `date_key` and only then join to
+        # the (small) `date` table. This is much faster than reading from the
+        # `prescribing` view, which joins every row to the other tables.
+        sql = f"""
         SELECT
-            -- We know the relevant date for each file so we add it as fixed column
-            {escape(date)}::DATE AS date,
-            -- Map an inconsistently named column to something consistent
-            COLUMNS('(BNF_CODE|BNF_PRESENTATION_CODE)') AS our_bnf_code,
-            *
-        FROM read_parquet({escape(filename)})
+            date.date,
+            totals.* EXCLUDE (date_key)
+        FROM (
+            SELECT
+                date_key,
+                SUM(items),
+                SUM(net_cost),
+                SUM(actual_cost),
+                COUNT(DISTINCT practice_key),
+                COUNT(DISTINCT presentation_id)
+            FROM {database}.prescribing_norm
+            GROUP BY date_key
+        ) AS totals
+        JOIN {database}.date ON totals.date_key = date.key
         """
-        for date, filename in prescribing_files_by_date.items()
+    else:
+        # A database built before dates had stable keys has the old structure, which the
+        # `prescribing` view hides from us
+        sql = f"""
+        SELECT
+            date,
+            SUM(items),
+            SUM(net_cost),
+            SUM(actual_cost),
+            COUNT(DISTINCT practice_id),
+            COUNT(DISTINCT presentation_id)
+        FROM {database}.prescribing
+        GROUP BY date
+        """
+    rows = conn.sql(sql).fetchall()
+    return {date: dict(zip(VALIDATED_TOTALS, totals)) for date, *totals in rows}
+
+
+def find_anomalies(old_totals, new_totals):
+    """
+    Given the totals for each month in the old and new databases, return a list of
+    descriptions of any differences which are too large to accept
+    """
+    anomalies = [
+        f"{date}: missing from new database"
+        for date in sorted(old_totals.keys() - new_totals.keys())
     ]
-    # We combine these all into a single table (columns which are not present in a given
-    # file will just have NULL values)
-    combined = " UNION ALL BY NAME ".join(subqueries)
+    # There's nothing to compare new months with
+    if not old_totals:
+        return anomalies
+
+    for date, totals in sorted(new_totals.items()):
+        if date in old_totals:
+            expected = old_totals[date]
+            tolerance = VALIDATION_TOLERANCE
+            compared_with = ""
+        else:
+            nearest_date = min(old_totals, key=lambda d: abs(d - date))
+            expected = old_totals[nearest_date]
+            tolerance = NEW_MONTH_VALIDATION_TOLERANCE
+            compared_with = f" compared with {nearest_date}"
+        for name in VALIDATED_TOTALS:
+            change = get_relative_change(expected[name], totals[name])
+            if abs(change) > tolerance:
+                anomalies.append(
+                    f"{date}: {name} {expected[name]:,} -> {totals[name]:,} "
+                    f"({change:+.0%}){compared_with}"
+                )
+    return anomalies
 
-    # Read from the above union, map the column names to the ones we want to use and
-    # where necessary apply transformations
-    return f"""\
-    SELECT
-        our_bnf_code AS bnf_code,
-        -- Not every file has SNOMED codes so we use zero as a placeholder
-        COALESCE(CAST(SNOMED_CODE AS INT8), 0) AS snomed_code,
-        date AS date,
-        PRACTICE_CODE AS practice_code,
-        QUANTITY AS quantity_value,
-        ITEMS AS items,
-        TOTAL_QUANTITY AS quantity,
-        -- We want prices in pence not pounds so we can use integers later
-        CAST(NIC AS DOUBLE) * 100 AS net_cost,
-        CAST(ACTUAL_COST AS DOUBLE) * 100 AS actual_cost
-    FROM
-        ({combined})
+
+def get_relative_change(old, new):
+    if old == 0:
+        return 0 if new == 0 else float("inf")
+    return (new - old) / old
+
+
+@contextlib.contextmanager
+def sample_resources(conn):
+    """
+    Sample the memory and temporary files that DuckDB is using every
+    RESOURCE_SAMPLE_INTERVAL seconds while the enclosed block runs, and yield a dict
+    with the highest values seen
+
+    When we hit DuckDB's memory or temporary directory limits this tells us how close
+    the previous ingests came, which we wouldn't otherwise know.
+    """
+    peaks = {"peak_memory_bytes": 0, "peak_temp_directory_bytes": 0}
+    stop = threading.Event()
+
+    def sample(cursor):
+        memory_bytes, temp_directory_bytes = cursor.sql(
+            """
+            SELECT
+                (SELECT SUM(memory_usage_bytes) FROM duckdb_memory()),
+                (SELECT COALESCE(SUM(size), 0) FROM duckdb_temporary_files())
+            """
+        ).fetchone()
+        peaks["peak_memory_bytes"] = max(peaks["peak_memory_bytes"], memory_bytes)
+        peaks["peak_temp_directory_bytes"] = max(
+            peaks["peak_temp_directory_bytes"], temp_directory_bytes
+        )
+
+    def run(cursor):
+        while not stop.wait(RESOURCE_SAMPLE_INTERVAL):
+            sample(cursor)
+
+    with conn.cursor() as cursor:
+        thread = threading.Thread(target=run, args=(cursor,), daemon=True)
+        thread.start()
+        try:
+            yield peaks
+        finally:
+            stop.set()
+            thread.join()
+            # Make sure we have at least one sample, however quick the ingest was
+            sample(cursor)
+
+
+def get_ingest_report(timings, resources):
+    """
+    Return a JSON-serialisable summary of an ingest, from the `timing.span()`s recorded
+    in `timings` and the peaks recorded by `sample_resources`
+
+    For example:
+
+        {
+            "stages": {"date": {"seconds": 0.1, "rows": 24}, ...},
+            "bnf_ranges": [
+                {
+                    "bnf_codes": "0101 -> 0202",
+                    "seconds": 1.5,
+                    "rows": 300000,
+                    "rows_per_second": 200000,
+                },
+                ...
+            ],
+            "peak_memory_bytes": 123456789,
+            "peak_temp_directory_bytes": 0,
+        }
     """
+    stages = {}
+    bnf_ranges = []
+    for name, duration in timings.durations.items():
+        kind, _, name = name.partition(".")
+        seconds = round(duration, 3)
+        rows = timings.counts[f"{kind}.{name}"].get("rows")
+        if kind == "stage":
+            stages[name] = {"seconds": seconds}
+            if rows is not None:
+                stages[name]["rows"] = rows
+        elif kind == "bnf_range":
+            bnf_start, _, bnf_end = name.partition(":")
+            bnf_ranges.append(
+                {
+                    "bnf_codes": f"{bnf_start} -> {bnf_end}",
+                    "seconds": seconds,
+                    "rows": rows,
+                    "rows_per_second": round(rows / duration) if duration else None,
+                }
+            )
+    # Ranges are recorded in the order in which they finish, which varies from run to run
+    bnf_ranges.sort(key=lambda bnf_range: bnf_range["bnf_codes"])
+    return {"stages": stages, "bnf_ranges": bnf_ranges, **resources}
+
+
+def is_resumable(conn, tmp_file, all_files):
+    conn.sql(f"ATTACH {escape(tmp_file)} AS partial (READONLY)")
+    try:
+        # The checkpoint table is created along with `ingested_file` and dropped when the
+        # build finishes
+        has_checkpoints = conn.sql(
+            """
+            SELECT COUNT(*) FROM duckdb_tables()
+            WHERE database_name = 'partial' AND table_name = 'build_checkpoint'
+            """
+        ).fetchone()[0]
+        if not has_checkpoints:
+            return False
+        filenames = {
+            row[0]
+            for row in conn.sql("SELECT filename FROM partial.ingested_file").fetchall()
+        }
+    finally:
+        conn.sql("DETACH partial")
+    return filenames == {f.name for f in all_files}
+
+
+def update_database(
+    conn, target_file, tmp_file, new_files, prescribing_files, list_size_files
+):
+    """
+    Build the new database in `tmp_file` by adding the data in `new_files` to a copy of
+    the existing database in `target_file`, rather than by ingesting everything again
+
+    This relies on the keys which `prescribing_norm` and `list_size_norm` use to refer to
+    dates, practices and presentations never changing once they've been allocated (see
+    `sql_for_date_table`), so that none of the existing data needs rewriting.
+
+    We only ever get files for dates we haven't already ingested. This is because each
+    date has exactly one current file, and so if all the files we've ingested are still
+    current, the new ones must be for other dates.
+    """
+    new_filenames = {f.name for f in new_files}
+    new_prescribing_files = {
+        date: f for date, f in prescribing_files.items() if f.name in new_filenames
+    }
+    new_list_size_files = {
+        date: f for date, f in list_size_files.items() if f.name in new_filenames
+    }
+
+    log.info("Copying existing database")
+    with timing.span("stage.copy"):
+        shutil.copyfile(target_file, tmp_file)
+    conn.sql(f"ATTACH {escape(tmp_file)} AS new")
+    conn.sql("USE new")
+
+    # Restore the presentation table to the state it was in before we applied BNF and
+    # VMP code changes, so that we can match new data against the original codes. We
+    # reapply the code changes (which might have changed since) at the end.
+    conn.sql(
+        """
+        CREATE OR REPLACE TABLE presentation AS
+        SELECT
+            id,
+            original_bnf_code AS bnf_code,
+            original_snomed_code AS snomed_code,
+            last_prescribed_date
+        FROM presentation
+        """
+    )
+
+    if new_prescribing_files:
+        conn.sql(
+            "CREATE TEMPORARY VIEW prescribing_source AS "
+            + sql_for_prescribing_source_view(new_prescribing_files)
+        )
+        update_id_tables(conn)
+
+        # We can't add rows to the middle of `prescribing_norm` without rewriting it, so
+        # the new rows go at the end. They're sorted in the same way as the existing
+        # rows (see `ingest_sources`) so, while the table is no longer in order as a
+        # whole, it's made up of a few long sorted runs and DuckDB's zonemaps still let
+        # queries skip most of each run. After MAX_APPENDED_RUNS of these we rebuild it.
+        log.info("Appending to `prescribing_norm` table")
+        with timing.span("stage.prescribing_norm") as counts:
+            counts["rows"] = conn.execute(
+                "INSERT INTO prescribing_norm "
+                + sql_for_prescribing_normalised()
+                + " ORDER BY presentation_id, date_key, practice_key"
+            ).fetchone()[0]
+        log.info(f"Ingested {counts['rows']:,} prescribing rows")
+        # This tells later ingests when it's time to rebuild the table in order (see
+        # `can_update_database`)
+        conn.sql(f"CREATE TABLE IF NOT EXISTS appended_run ({APPENDED_RUN_COLUMNS})")
+        conn.sql("INSERT INTO appended_run VALUES (now())")
+
+    if new_list_size_files:
+        conn.sql(
+            "CREATE TEMPORARY VIEW list_size_source AS "
+            + sql_for_list_size_source_view(new_list_size_files)
+        )
+        log.info("Appending to `list_size_norm` table")
+        with timing.span("stage.list_size_norm") as counts:
+            counts["rows"] = conn.execute(
+                "INSERT INTO list_size_norm " + sql_for_list_size_normalised()
+            ).fetchone()[0]
+        log.info(f"Ingested {counts['rows']:,} list size rows")
+
+    with timing.span("stage.code_changes"):
+        create_code_changes_sources(conn)
+        apply_code_changes(conn)
+
+    conn.executemany(
+        "INSERT INTO ingested_file VALUES (?)", [(f.name,) for f in new_files]
+    )
+
+
+def update_id_tables(conn):
+    """
+    Add the dates, practices and presentations in `prescribing_source` to the existing
+    tables
+
+    Existing keys and presentation IDs are kept and new ones allocated after them,
+    while the date and practice IDs are renumbered just as when we build the tables
+    from scratch.
+    """
+    tables = {
+        "date": sql_for_date_table(
+            source="(SELECT date FROM date UNION ALL SELECT date FROM prescribing_source)"
+        ),
+        "practice": sql_for_practice_table(existing=True),
+        "presentation": sql_for_presentation_table(existing=True),
+    }
+    for table, sql in tables.items():
+        with timing.span(f"stage.{table}") as counts:
+            conn.sql(f"CREATE OR REPLACE TABLE {table} AS {sql}")
+            counts["rows"] = count_table(conn, table)
+        log.info(f"Ingested {counts['rows']:,} {table} rows")
+
+
+def sql_for_prescribing_source_view(prescribing_files_by_date):
+    # Return a query which reads from the supplied files and converts them into a
+    # single, unified consistent structure ready for us to build from
+    #
+    # Where the fetcher has written a sorted copy of a file (see `write_sorted_file`)
+    # we read that instead. It's already in the structure we want, and because it's
+    # sorted by BNF code we only need to read a small part of it for any range of BNF
+    # codes.
+    raw_files = {}
+    sorted_files = []
+    for date, filename in prescribing_files_by_date.items():
+        sorted_filename = get_sorted_filename_for(filename)
+        if sorted_filename.exists():
+            sorted_files.append(sorted_filename)
+        else:
+            raw_files[date] = filename
+
+    queries = []
+    if raw_files:
+        queries.append(sql_for_raw_prescribing_files(raw_files))
+    if sorted_files:
+        filenames = ", ".join(escape(filename) for filename in sorted_files)
+        queries.append(f"SELECT * FROM read_parquet([{filenames}])")
+    return " UNION ALL BY NAME ".join(f"SELECT * FROM ({query})" for query in queries)
 
 
 def sql_for_list_size_source_view(list_size_files_by_date):
@@ -199,26 +700,38 @@ def sql_for_list_size_source_view(list_size_files_by_date):
 
 
 def ingest_sources(conn):
-    log.info("Building `date` table")
-    conn.sql("CREATE TABLE date AS " + sql_for_date_table())
-    log.info(f"Ingested {count_table(conn, 'date'):,} dates")
-
-    log.info("Building `practice` table")
-    conn.sql("CREATE TABLE practice AS " + sql_for_practice_table())
-    log.info(f"Ingested {count_table(conn, 'practice'):,} practices")
-
-    log.info("Building `presentation` table")
-    conn.sql("CREATE TABLE presentation AS " + sql_for_presentation_table())
-    log.info(f"Ingested {count_table(conn, 'presentation'):,} presentations")
+    # Each stage of the build happens in a transaction which also records in the
+    # `build_checkpoint` table that the stage is complete. So if the build is
+    # interrupted (e.g. by being OOM killed, or running out of temporary disk space)
+    # then the database is left with whole stages complete, and the next build can carry
+    # on from the first incomplete one (see `build_database`).
+    conn.sql(f"CREATE TABLE IF NOT EXISTS build_checkpoint ({CHECKPOINT_COLUMNS})")
+    completed_stages = {
+        row[0] for row in conn.sql("SELECT stage FROM build_checkpoint").fetchall()
+    }
 
-    log.info("Building `list_size_norm` table")
-    conn.sql("CREATE TABLE list_size_norm AS " + sql_for_list_size_normalised())
-    log.info(f"Ingested {count_table(conn, 'list_size_norm'):,} list size rows")
+    for table, sql, description in [
+        ("date", sql_for_date_table(), "dates"),
+        ("practice", sql_for_practice_table(), "practices"),
+        ("presentation", sql_for_presentation_table(), "presentations"),
+        ("list_size_norm", sql_for_list_size_normalised(), "list size rows"),
+    ]:
+        if table in completed_stages:
+            log.info(f"Already built `{table}` table")
+            continue
+        log.info(f"Building `{table}` table")
+        with timing.span(f"stage.{table}") as counts, transaction(conn):
+            conn.sql(f"CREATE TABLE {table} AS {sql}")
+            conn.sql("INSERT INTO build_checkpoint (stage) VALUES (?)", params=[table])
+            counts["rows"] = count_table(conn, table)
+        log.info(f"Ingested {counts['rows']:,} {description}")
 
     # We store the prescribing data in a fully normalised table ("prescribing_norm") so
     # that date and practice and presentation (bnf and snomed code) are stored as
     # integer foreign keys to other tables. This is crucial to getting the performance
-    # we need out of DuckDB.
+    # we need out of DuckDB. Dates and practices are referred to by their stable keys
+    # rather than their IDs, so that adding new data never means rewriting this table
+    # (see `sql_for_date_table`).
     #
     # The types below are chosen to be as small as possible while still being able to
     # represent the range of values we need. If ever we exceed these (e.g. we try to
@@ -228,10 +741,10 @@ def ingest_sources(conn):
     # types though, so it shouldn't be a disruptive change.
     conn.sql(
         """
-        CREATE TABLE prescribing_norm (
+        CREATE TABLE IF NOT EXISTS prescribing_norm (
             presentation_id INT4,
-            date_id UTINYINT,
-            practice_id USMALLINT,
+            date_key USMALLINT,
+            practice_key USMALLINT,
             quantity_value FLOAT4,
             items USMALLINT,
             quantity FLOAT4,
@@ -246,56 +759,140 @@ def ingest_sources(conn):
     # We want data primarily ordered by `presentation_id` as that's what we most
     # frequently query on and it's also the highest cardinality column (i.e. querying on
     # it allows us to quickly discard a large proportion of the data). After that,
-    # `date_id` is the next most important as we will sometimes limit our queries by
-    # date. Finally we order by `practice_id`; we rarely query on this but it's better to
-    # have the data ordered than not.
+    # `date_key` is the next most important as we will sometimes limit our queries by
+    # date. Finally we order by `practice_key`; we rarely query on this but it's better
+    # to have the data ordered than not.
     #
     # Due to the size of the prescribing data we can't just issue a single query to
     # fetch, sort and insert the data: DuckDB ends up spilling to disk while doing the
     # sort which makes the whole process grind to a (near) halt. However, we can exploit
     # the fact that presentations are ordered by BNF code and so we can process the data
-    # in smaller chunks by filtering on ranges of BNF codes. As long as we process these
-    # ranges in order, and as long as we correctly order the data in each chunk, then
-    # the overall table ends up correctly ordered as well.
+    # in smaller chunks by filtering on ranges of BNF codes. As long as we correctly
+    # order the data in each chunk, and add the chunks to the table in order, the
+    # overall table ends up correctly ordered as well.
     #
     # This also relies on the fact that filtering the incoming data by BNF code is
     # relatively cheap. If these were CSV files we'd need to do a full scan over all the
     # data every time. But thanks the magic of Parquet these queries are reasonably
     # efficient.
-
-    # This will create an empty table, and duckdb will resolve the column types
-    conn.sql(
-        "CREATE TEMP TABLE prescribing_norm_tmp AS "
-        + sql_for_prescribing_normalised()
-        + " WHERE false"
-    )
-
-    for bnf_start, bnf_end in get_bnf_code_ranges(
-        conn, batch_size=BNF_RANGE_BATCH_SIZE
-    ):
-        log.info(f"Building `prescribing_norm_tmp` table: {bnf_start} -> {bnf_end}")
-        conn.sql(
-            "INSERT INTO prescribing_norm_tmp "
-            + sql_for_prescribing_normalised()
-            + " WHERE prescribing_source.bnf_code >= ? AND prescribing_source.bnf_code < ?",
-            params=[bnf_start, bnf_end],
+    #
+    # A query over a single range can't keep all our cores busy, so several workers
+    # each sort a range at a time and insert it straight into `prescribing_norm`. Rows
+    # are added to the table in the order in which the transactions that inserted them
+    # commit, so each worker waits until the range before its own has been committed
+    # before committing.
+    #
+    # Each range's transaction also records the end of the range as a checkpoint. As
+    # ranges are committed in order, we only need to insert the data from the last
+    # checkpoint onwards.
+    min_bnf_code = conn.sql(
+        "SELECT MAX(bnf_code) FROM build_checkpoint WHERE stage = 'prescribing_norm'"
+    ).fetchone()[0]
+    if min_bnf_code is not None:
+        log.info(f"Already built `prescribing_norm` table up to {min_bnf_code}")
+    bnf_code_ranges = list(
+        get_bnf_code_ranges(
+            conn, max_rows=get_max_rows_per_range(), min_bnf_code=min_bnf_code or ""
         )
-
-    conn.sql(
-        "INSERT INTO prescribing_norm SELECT * FROM prescribing_norm_tmp "
-        " ORDER BY presentation_id, date_id, practice_id"
     )
-    conn.sql("DROP TABLE prescribing_norm_tmp ")
-    log.info(f"Ingested {count_table(conn, 'prescribing_norm'):,} prescribing rows")
-
-    # To make ad-hoc queries of the data easier we create denormalised views which
-    # include the practice codes, dates etc rather than just foreign keys
-    log.info("Building `prescribing` view")
-    conn.sql("CREATE VIEW prescribing AS " + sql_for_prescribing_denormalised())
+    finished = [threading.Event() for _ in bnf_code_ranges]
+    committed = [False for _ in bnf_code_ranges]
+    # Set as soon as any range fails, so that ranges which haven't started yet don't
+    # spend time and memory inserting data which would only be rolled back
+    failed = threading.Event()
+
+    # Each worker has its own connection, which needs to find tables in the same place
+    # as ours does
+    database, search_path = conn.sql(
+        "SELECT current_database(), current_setting('search_path')"
+    ).fetchone()
+
+    def insert_range(i, bnf_code_range):
+        bnf_start, bnf_end = bnf_code_range
+        try:
+            if failed.is_set():
+                return
+            log.info(f"Building `prescribing_norm` table: {bnf_start} -> {bnf_end}")
+            with conn.cursor() as cursor:
+                cursor.sql(f'USE "{database}"')
+                cursor.sql(f"SET search_path = {escape(search_path)}")
+                cursor.sql("BEGIN")
+                with timing.span(f"bnf_range.{bnf_start}:{bnf_end}") as counts:
+                    counts["rows"] = cursor.execute(
+                        "INSERT INTO prescribing_norm "
+                        + sql_for_prescribing_normalised()
+                        + " WHERE prescribing_source.bnf_code >= ? AND prescribing_source.bnf_code < ?"
+                        + " ORDER BY presentation_id, date_key, practice_key",
+                        parameters=[bnf_start, bnf_end],
+                    ).fetchone()[0]
+                cursor.sql(
+                    "INSERT INTO build_checkpoint VALUES ('prescribing_norm', ?)",
+                    params=[bnf_end],
+                )
+                if i > 0:
+                    finished[i - 1].wait()
+                # If an earlier range failed then the ingest has failed, and closing the
+                # cursor rolls back this range too. (Committing it would leave a gap in
+                # the data which the next build wouldn't know to fill.)
+                if i == 0 or committed[i - 1]:
+                    cursor.sql("COMMIT")
+                    committed[i] = True
+        except BaseException:
+            failed.set()
+            raise
+        finally:
+            finished[i].set()
+
+    with (
+        timing.span("stage.prescribing_norm") as counts,
+        concurrent.futures.ThreadPoolExecutor(INGEST_WORKERS) as executor,
+    ):
+        # Each worker gets a copy of our context so that timings still work
+        futures = [
+            executor.submit(contextvars.copy_context().run, insert_range, i, bnf_range)
+            for i, bnf_range in enumerate(bnf_code_ranges)
+        ]
+        # Wait for the results in order so that any worker's exception is raised here,
+        # as soon as it happens rather than after every other range has run
+        try:
+            for future in futures:
+                future.result()
+        except BaseException:
+            failed.set()
+            executor.shutdown(cancel_futures=True)
+            raise
+        counts["rows"] = count_table(conn, "prescribing_norm")
+    log.info(f"Ingested {counts['rows']:,} prescribing rows")
+
+    # Applying code changes twice would lose the original codes, so we do this in the
+    # same transaction as dropping the checkpoints which would let it be repeated
+    with timing.span("stage.views"), transaction(conn):
+        # To make ad-hoc queries of the data easier we create denormalised views which
+        # include the practice codes, dates etc rather than just foreign keys. These
+        # also translate keys into IDs, which is what the query code works with.
+        log.info("Building `prescribing` view")
+        conn.sql("CREATE VIEW prescribing AS " + sql_for_prescribing_denormalised())
+
+        log.info("Building `list_size` view")
+        conn.sql("CREATE VIEW list_size AS " + sql_for_list_size_denormalised())
+
+        apply_code_changes(conn)
+
+        conn.sql("DROP TABLE build_checkpoint")
+
+
+@contextlib.contextmanager
+def transaction(conn):
+    conn.begin()
+    try:
+        yield
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
 
-    log.info("Building `list_size` view")
-    conn.sql("CREATE VIEW list_size AS " + sql_for_list_size_denormalised())
 
+def apply_code_changes(conn):
     # To support BNF codes and VMP codes changing we need to update the presentation
     # table with the codes that a presentation would have, if it had been prescribed
     # today.  We keep the originals in the original_bnf_code and original_snomed_code
@@ -318,14 +915,20 @@ def ingest_sources(conn):
     """)
 
 
-def sql_for_date_table():
+def sql_for_date_table(source="prescribing_source"):
     # Return a series of all unique dates present in the prescribing data together with
-    # an integer ID.
+    # an integer ID and an integer key.
     #
-    # A couple of oddities here:
+    # The prescribing and list size data refer to dates (and practices) by key. A key
+    # never changes once it's been allocated, so that we can add a new month of data
+    # without having to rewrite the data we've already got. A date's key is the number
+    # of months since DATE_KEY_EPOCH, which is the same however much data we have.
     #
-    #  1. We start the IDs at 0 rather than 1 because we're going to use them as column
-    #     indexes in a matrix and these are zero-indexed.
+    # The ID is for the query code, which uses it as a column index in a matrix. A
+    # couple of oddities here:
+    #
+    #  1. We start the IDs at 0 rather than 1 because matrix column indexes are
+    #     zero-indexed.
     #
     #  2. We sort the dates in descending order. When we filter by date we generally
     #     want to filter to just the more recent dates. By using a descending order this
@@ -335,59 +938,87 @@ def sql_for_date_table():
     #     in the database unless we're actually querying it.
     #
     # Nothing will break if we don't do these things; we'll just waste memory and CPU
-    # time.
-    return """\
+    # time. But it does mean that IDs change as new dates are added, which is why we
+    # don't store them anywhere else. We only ever have a few hundred dates, so it's
+    # cheap to renumber them and to translate keys into IDs when querying.
+    return f"""\
     SELECT
         CAST(
             (row_number() OVER (ORDER BY date DESC)) - 1
             AS UTINYINT)
         AS id,
+        CAST(
+            date_diff('month', {escape(DATE_KEY_EPOCH)}::DATE, date)
+            AS USMALLINT)
+        AS key,
         date
     FROM (
-        SELECT DISTINCT date FROM prescribing_source
+        SELECT DISTINCT date FROM {source}
     )
     """
 
 
-def sql_for_practice_table():
+def sql_for_practice_table(existing=False):
     # Return a series of all unique practice codes in the prescribing data together with
-    # an integer ID.
-    #
-    # A couple of oddities here:
+    # an integer ID and an integer key. If `existing` is set, the practices in the
+    # current `practice` table are included too and keep their keys.
     #
-    #  1. We start the IDs at 0 rather than 1 because we're going to use them as row
-    #     indexes in a matrix and these are zero-indexed.
+    # As with dates (see `sql_for_date_table`), the prescribing and list size data refer
+    # to practices by key, which never changes, and the query code uses the ID as a row
+    # index in a matrix. We sort practices by the date they last prescribed in
+    # descending order to allocate IDs. This means that if we're only interested in
+    # prescribing after, say, January 2025 then we can ignore all practices that haven't
+    # prescribed since December 2024 and this will translate into ignoring all practices
+    # with IDs greater than, say, 1234. This means we don't have to allocate rows for
+    # these practices when building a results matrix.
     #
-    #  2. We sort practices by the date they last prescribed in descending order. This
-    #     means that if we're only interested in prescribing after, say, January 2025
-    #     then we can ignore all practices that haven't prescribed since December 2024
-    #     and this will translate into ignoring all practices with IDs greater than,
-    #     say, 1234. This means we don't have to allocate rows for these practices when
-    #     building a results matrix. And this means we don't pay a cost for having
-    #     historical data in the database unless we're actually querying it.
-    #
-    # Nothing will break if we don't do these things; we'll just waste memory and CPU
-    # time.
-    return """\
+    # New practices get keys after all the existing ones, allocated in the same order as
+    # IDs, so that when we build the table from scratch each practice's key is the same
+    # as its ID.
+    existing_practices = (
+        """
+            UNION ALL
+            SELECT latest_prescribing_date, code, key FROM practice
+        """
+        if existing
+        else ""
+    )
+    return f"""\
+    WITH practices AS (
+        SELECT MAX(date) AS max_date, practice_code, MAX(key) AS key
+        FROM (
+            SELECT date, practice_code, NULL::USMALLINT AS key FROM prescribing_source
+            {existing_practices}
+        )
+        WHERE practice_code != '-'
+        GROUP BY practice_code
+    )
     SELECT
         CAST(
             (row_number() OVER (ORDER BY max_date DESC, practice_code)) - 1
             AS USMALLINT)
         AS id,
+        CAST(
+            COALESCE(
+                key,
+                (SELECT COALESCE(MAX(key), -1) FROM practices)
+                + row_number() OVER (
+                    PARTITION BY key IS NULL ORDER BY max_date DESC, practice_code
+                )
+            )
+            AS USMALLINT)
+        AS key,
         practice_code AS code,
         max_date AS latest_prescribing_date
-    FROM (
-        SELECT MAX(date) AS max_date, practice_code
-        FROM prescribing_source
-        WHERE practice_code != '-'
-        GROUP BY practice_code
-    )
+    FROM practices
     """
 
 
-def sql_for_presentation_table():
+def sql_for_presentation_table(existing=False):
     # Return a series of all unqiue presentations in the prescribing data (by which we
-    # mean all <BNF code, SNOMED code> pairs) together with an integer ID.
+    # mean all <BNF code, SNOMED code> pairs) together with an integer ID. If `existing`
+    # is set, the presentations in the current `presentation` table are included too and
+    # keep their IDs.
     #
     # We order by BNF code first because the hierarchical nature of BNF codes means that
     # clinically associated codes get lexically clustered together. And then, because we
@@ -395,18 +1026,43 @@ def sql_for_presentation_table():
     # ends up clustered together on disk. This isn't essential for query performance,
     # but given that it's going to ordered by _something_ this is the most sensible
     # option.
-    return """\
+    #
+    # Presentation IDs never change once they've been allocated, so that we can add new
+    # data without having to rewrite the data we've already got. This means that new
+    # presentations get IDs after all the existing ones, and so aren't clustered with
+    # related presentations until we next build the database from scratch.
+    existing_presentations = (
+        """
+            UNION ALL
+            SELECT bnf_code, snomed_code, last_prescribed_date, id FROM presentation
+        """
+        if existing
+        else ""
+    )
+    return f"""\
+    WITH presentations AS (
+        SELECT bnf_code, snomed_code, MAX(date) AS last_prescribed_date, MAX(id) AS id
+        FROM (
+            SELECT bnf_code, snomed_code, date, NULL::INT4 AS id FROM prescribing_source
+            {existing_presentations}
+        )
+        GROUP BY bnf_code, snomed_code
+    )
     SELECT
         CAST(
-            (row_number() OVER (ORDER BY bnf_code, snomed_code))
+            COALESCE(
+                id,
+                (SELECT COALESCE(MAX(id), 0) FROM presentations)
+                + row_number() OVER (
+                    PARTITION BY id IS NULL ORDER BY bnf_code, snomed_code
+                )
+            )
             AS INT4)
         AS id,
         bnf_code,
         snomed_code,
         last_prescribed_date
-    FROM (
-        SELECT bnf_code, snomed_code, MAX(date) AS last_prescribed_date FROM prescribing_source GROUP BY bnf_code, snomed_code
-    )
+    FROM presentations
     """
 
 
@@ -414,8 +1070,8 @@ def sql_for_prescribing_normalised():
     return """\
     SELECT
         presentation.id AS presentation_id,
-        date.id AS date_id,
-        practice.id AS practice_id,
+        date.key AS date_key,
+        practice.key AS practice_key,
         prescribing_source.quantity_value,
         prescribing_source.items,
         prescribing_source.quantity,
@@ -429,9 +1085,9 @@ def sql_for_prescribing_normalised():
         prescribing_source.bnf_code = presentation.bnf_code
         AND prescribing_source.snomed_code = presentation.snomed_code
     JOIN
-        (SELECT date, id FROM date) AS date ON prescribing_source.date = date.date
+        (SELECT date, key FROM date) AS date ON prescribing_source.date = date.date
     JOIN
-        (SELECT id, code FROM practice) as practice ON prescribing_source.practice_code = practice.code
+        (SELECT key, code FROM practice) as practice ON prescribing_source.practice_code = practice.code
     """
 
 
@@ -441,9 +1097,9 @@ def sql_for_prescribing_denormalised():
         rx.presentation_id AS presentation_id,
         presentation.bnf_code AS bnf_code,
         presentation.snomed_code AS snomed_code,
-        rx.date_id AS date_id,
+        date.id AS date_id,
         date.date AS date,
-        rx.practice_id AS practice_id,
+        practice.id AS practice_id,
         practice.code AS practice_code,
         rx.quantity_value AS quantity_value,
         rx.items AS items,
@@ -459,19 +1115,19 @@ def sql_for_prescribing_denormalised():
     JOIN
         date
     ON
-        rx.date_id = date.id
+        rx.date_key = date.key
     JOIN
         practice
     ON
-        rx.practice_id = practice.id
+        rx.practice_key = practice.key
     """
 
 
 def sql_for_list_size_normalised():
     return """\
     SELECT
-        date.id AS date_id,
-        practice.id AS practice_id,
+        date.key AS date_key,
+        practice.key AS practice_key,
         CAST(list_size_source.total AS UINTEGER) AS total
     FROM
         list_size_source
@@ -480,16 +1136,16 @@ def sql_for_list_size_normalised():
     JOIN
         practice ON list_size_source.practice_code = practice.code
     ORDER BY
-        date_id, practice_id
+        date_key, practice_key
     """
 
 
 def sql_for_list_size_denormalised():
     return """\
     SELECT
-        lst.date_id AS date_id,
+        date.id AS date_id,
         date.date AS date,
-        lst.practice_id AS practice_id,
+        practice.id AS practice_id,
         practice.code AS practice_code,
         lst.total AS total
     FROM
@@ -497,14 +1153,24 @@ def sql_for_list_size_denormalised():
     JOIN
         date
     ON
-        lst.date_id = date.id
+        lst.date_key = date.key
     JOIN
         practice
     ON
-        lst.practice_id = practice.id
+        lst.practice_key = practice.key
     """
 
 
+def create_code_changes_sources(conn):
+    conn.sql(
+        "CREATE TEMPORARY VIEW bnf_code_changes_source AS "
+        + sql_for_bnf_code_changes_view(
+            settings.BNF_CODE_CHANGES_DIR / "bnf_code_mapping.csv"
+        )
+    )
+    create_vmp_code_changes_source(conn)
+
+
 def create_vmp_code_changes_source(conn):
     # VMP codes occasionally change.  Each VMP record carries its immediately previous
     # code in `vpidprev`, so a chain of changes A -> B -> C is recorded across multiple
@@ -566,15 +1232,41 @@ def sql_for_bnf_code_changes_view(csv_path):
     """
 
 
-def get_bnf_code_ranges(conn, batch_size):
-    query = conn.sql("SELECT DISTINCT bnf_code FROM presentation ORDER BY bnf_code")
-    bnf_codes = [row[0] for row in query.fetchall()]
-    for i in range(0, len(bnf_codes), batch_size):
-        next_i = i + batch_size
-        min_code = bnf_codes[i]
+def get_max_rows_per_range():
+    memory_limit = parse_memory_size(settings.DUCKDB_MEMORY_LIMIT)
+    return int(memory_limit * BNF_RANGE_MEMORY_FRACTION / ESTIMATED_BYTES_PER_ROW)
+
+
+def get_bnf_code_ranges(conn, max_rows, min_bnf_code=""):
+    # The number of rows per BNF code varies by orders of magnitude, so rather than
+    # having a fixed number of codes in each range we count the rows for each code and
+    # make each range as large as we can without it covering more than `max_rows` rows.
+    # (Unless a single code has more than that, in which case it gets a range of its
+    # own.) Counting only needs to read the BNF code column, so is much quicker than
+    # the queries we use the ranges for.
+    log.info("Counting prescribing rows for each BNF code")
+    query = conn.sql(
+        """
+        SELECT bnf_code, COUNT(*) FROM prescribing_source
+        WHERE bnf_code >= ?
+        GROUP BY bnf_code
+        ORDER BY bnf_code
+        """,
+        params=[min_bnf_code],
+    )
+    min_code = None
+    range_rows = 0
+    for bnf_code, rows in query.fetchall():
+        if min_code is not None and range_rows + rows > max_rows:
+            yield min_code, bnf_code
+            min_code = None
+            range_rows = 0
+        if min_code is None:
+            min_code = bnf_code
+        range_rows += rows
+    if min_code is not None:
         # We need some end value which is guaranteed larger than any valid BNF code
-        max_code = bnf_codes[next_i] if next_i < len(bnf_codes) else "ZZZZZZZZZZZZZZZ"
-        yield min_code, max_code
+        yield min_code, "ZZZZZZZZZZZZZZZ"
 
 
 def fetch_as_dicts(conn, query):
@@ -0,0 +1,83 @@
+import statistics
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from openprescribing.data import rxdb
+from openprescribing.data.bnf_query import BNFQuery
+from openprescribing.data.models import Org
+from openprescribing.data.queries import get_org_date_matrix, get_practice_date_matrix
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the time taken to produce org-level values by grouping a practice-date "
+        "matrix in Python with the time taken by grouping inside DuckDB"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "bnf_codes",
+            nargs="+",
+            metavar="BNF_CODE",
+            help="BNF codes (or prefixes) to query",
+        )
+        parser.add_argument(
+            "--org-type",
+            choices=Org.OrgType.values,
+            default=Org.OrgType.ICB,
+            help="Type of org to group practices into (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--date-count",
+            type=int,
+            default=None,
+            help="Restrict to the N most recent months (default: all months)",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=5,
+            help="Number of times to run each path (default: %(default)s)",
+        )
+
+    def handle(self, bnf_codes, org_type, date_count, repeat, **options):
+        query = BNFQuery(bnf_codes=bnf_codes)
+        org_id_to_practice_ids = Org.objects.filter(
+            org_type=org_type
+        ).with_practice_ids()
+
+        # We call the functions wrapped by the caches so that every run does the full
+        # amount of work
+        def group_in_python(cursor):
+            pdm = get_practice_date_matrix.__wrapped__(cursor, query, date_count)
+            return pdm.group_rows(org_id_to_practice_ids)
+
+        def group_in_duckdb(cursor):
+            return get_org_date_matrix.__wrapped__(
+                cursor, query, org_id_to_practice_ids, date_count
+            )
+
+        results = {}
+        for name, fn in [("python", group_in_python), ("duckdb", group_in_duckdb)]:
+            timings = []
+            for _ in range(repeat):
+                with rxdb.get_cursor() as cursor:
+                    start = time.perf_counter()
+                    results[name] = fn(cursor)
+                    timings.append(time.perf_counter() - start)
+            self.stdout.write(
+                f"{name}: "
+                f"min {min(timings) * 1000:.1f}ms, "
+                f"median {statistics.median(timings) * 1000:.1f}ms "
+                f"({repeat} runs)"
+            )
+
+        python_odm, duckdb_odm = results["python"], results["duckdb"]
+        if not (
+            python_odm.row_labels == duckdb_odm.row_labels
+            and python_odm.col_labels == duckdb_odm.col_labels
+            and np.allclose(python_odm.values, duckdb_odm.values)
+        ):
+            raise CommandError("Results from the two paths differ")
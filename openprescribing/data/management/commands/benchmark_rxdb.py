@@ -0,0 +1,274 @@
+import datetime
+import json
+import statistics
+import time
+from pathlib import Path
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+
+from openprescribing.data.bnf_query import BNFQuery
+from openprescribing.data.ingestors import prescribing
+from openprescribing.data.models import Org
+from openprescribing.data.queries import get_practice_date_matrix
+from openprescribing.data.rxdb import connection
+from openprescribing.data.rxdb.labelled_matrix import create_row_grouper
+from openprescribing.data.utils import cache_metrics
+from openprescribing.data.utils.filename_utils import (
+    get_latest_files_by_date,
+    get_temp_filename_for,
+)
+
+
+# The levels of the BNF hierarchy we query at, from narrowest to widest, with the length
+# of their codes
+BNF_LEVELS = {
+    "presentation": 15,
+    "product": 11,
+    "chemical": 9,
+    "paragraph": 6,
+    "section": 4,
+    "chapter": 2,
+}
+
+# If there are no ICBs in the database we group practices into this many made-up orgs
+SYNTHETIC_ORG_COUNT = 42
+
+
+class Command(BaseCommand):
+    help = (
+        "Time ingesting prescribing data, the core rxdb queries and each API view, "
+        "and write the results as JSON for comparison across commits"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--source-dir",
+            type=Path,
+            help=(
+                "Directory of source files (e.g. from `generate_synthetic_data`) to "
+                "ingest into DIR/prescribing.duckdb and benchmark against (default: "
+                "benchmark the existing database without ingesting)"
+            ),
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=3,
+            help="Number of times to run each benchmark (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--date-count",
+            type=int,
+            default=None,
+            help="Restrict queries to the N most recent months (default: all months)",
+        )
+        parser.add_argument(
+            "--output",
+            type=Path,
+            help="File to write results to as JSON",
+        )
+        parser.add_argument(
+            "--compare",
+            type=Path,
+            help="JSON results of an earlier run to compare against",
+        )
+
+    def handle(self, source_dir, repeat, date_count, output, compare, **options):
+        self.repeat = repeat
+        self.results = {}
+
+        if source_dir is not None:
+            database = source_dir / "prescribing.duckdb"
+            # Ingesting takes a long time and there's only one run of it
+            self.record("ingest", [time_ingest(source_dir, database)])
+        else:
+            database = settings.PRESCRIBING_DATABASE
+        if not database.exists():
+            raise CommandError(f"No database at {database}")
+
+        # Point rxdb at the database we're benchmarking, so that the API views use it
+        manager = connection.ConnectionManager(
+            duckdb_file=database,
+            sqlite_file=settings.SQLITE_DATABASE,
+            init_sql=connection.CREATE_VIEWS_PATH.read_text(),
+            materialised_views=connection.MATERIALISED_VIEWS,
+        )
+        previous_manager = connection.CONNECTION_MANAGER
+        connection.CONNECTION_MANAGER = manager
+        try:
+            with manager.get_cursor() as cursor:
+                database_info = get_database_info(cursor)
+                bnf_code = get_most_prescribed_bnf_code(cursor)
+                self.benchmark_queries(cursor, bnf_code, date_count)
+            self.benchmark_api(bnf_code)
+        finally:
+            connection.CONNECTION_MANAGER = previous_manager
+
+        report = {
+            "version": settings.VERSION,
+            "created_at": datetime.datetime.now(datetime.UTC).isoformat(),
+            "database": database_info,
+            "repeat": repeat,
+            "results": self.results,
+        }
+        if output is not None:
+            output.write_text(json.dumps(report, indent=2))
+        if compare is not None:
+            self.compare(json.loads(compare.read_text()))
+
+    def benchmark_queries(self, cursor, bnf_code, date_count):
+        for level, length in BNF_LEVELS.items():
+            query = BNFQuery(bnf_codes=[bnf_code[:length]])
+            # We call the function wrapped by the cache so every run does all the work
+            timings = self.time(
+                lambda: get_practice_date_matrix.__wrapped__(cursor, query, date_count)
+            )
+            self.record(f"get_practice_date_matrix[{level}]", timings)
+
+        # The widest query gives us the biggest matrix to work with
+        pdm = get_practice_date_matrix.__wrapped__(cursor, query, date_count)
+        org_id_to_practice_ids = get_org_id_to_practice_ids(pdm.row_labels)
+
+        def group_rows():
+            create_row_grouper.cache_clear()
+            return pdm.group_rows(org_id_to_practice_ids)
+
+        self.record("group_rows", self.time(group_rows))
+        self.record("get_centiles", self.time(pdm.get_centiles))
+
+    def benchmark_api(self, bnf_code):
+        numerator = {"bnf_codes": [bnf_code[: BNF_LEVELS["chemical"]]]}
+        denominator = {"bnf_codes": [bnf_code[: BNF_LEVELS["section"]]]}
+        analysis_vs_list_size = {"queries": [{"numerator": numerator}]}
+        analysis_vs_prescribing = {
+            "queries": [{"numerator": numerator, "denominator": denominator}]
+        }
+        urls = {
+            "prescribing_deciles": ("/api/prescribing-deciles/", analysis_vs_list_size),
+            "prescribing_deciles[prescribing]": (
+                "/api/prescribing-deciles/",
+                analysis_vs_prescribing,
+            ),
+            "prescribing_all_orgs": (
+                "/api/prescribing-all-orgs/",
+                analysis_vs_list_size,
+            ),
+            "prescribing_medications": (
+                "/api/prescribing-medications/",
+                analysis_vs_list_size,
+            ),
+            "metadata_medications": ("/api/metadata/medications/", None),
+            "metadata_dmd": ("/api/metadata/dmd/", None),
+            "metadata_bnf": ("/api/metadata/bnf/", None),
+        }
+
+        client = Client()
+        for name, (url, analysis) in urls.items():
+            if analysis is not None:
+                url += "?" + urlencode({"analysis": json.dumps(analysis)})
+
+            def get():
+                # We want to time the work of answering each request from scratch
+                for cache in cache_metrics.CACHES.values():
+                    cache.cache_clear()
+                rsp = client.get(url)
+                assert rsp.status_code == 200, f"{url} returned {rsp.status_code}"
+
+            self.record(f"api.{name}", self.time(get))
+
+    def time(self, fn):
+        timings = []
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - start)
+        return timings
+
+    def record(self, name, timings):
+        result = {
+            "min_ms": min(timings) * 1000,
+            "median_ms": statistics.median(timings) * 1000,
+            "runs": len(timings),
+        }
+        self.results[name] = result
+        self.stdout.write(
+            f"{name}: "
+            f"min {result['min_ms']:.1f}ms, "
+            f"median {result['median_ms']:.1f}ms "
+            f"({result['runs']} runs)"
+        )
+
+    def compare(self, previous):
+        self.stdout.write(f"\nCompared with {previous['version']}:")
+        for name, result in self.results.items():
+            if name not in previous["results"]:
+                continue
+            old = previous["results"][name]["median_ms"]
+            new = result["median_ms"]
+            change = (new - old) / old if old else 0
+            self.stdout.write(f"  {name}: {old:.1f}ms -> {new:.1f}ms ({change:+.0%})")
+
+
+def time_ingest(source_dir, database):
+    prescribing_files = get_latest_files_by_date(source_dir.glob("prescribing/*"))
+    list_size_files = get_latest_files_by_date(source_dir.glob("list_size/*_v2_*"))
+    list_size_files = {
+        date: filename
+        for date, filename in list_size_files.items()
+        if date in prescribing_files
+    }
+    all_files = sorted([*prescribing_files.values(), *list_size_files.values()])
+
+    conn = prescribing.connect()
+    tmp_file = get_temp_filename_for(database)
+    try:
+        start = time.perf_counter()
+        prescribing.build_database(
+            conn, tmp_file, all_files, prescribing_files, list_size_files
+        )
+        conn.close()
+        duration = time.perf_counter() - start
+        tmp_file.replace(database)
+    finally:
+        tmp_file.unlink(missing_ok=True)
+    return duration
+
+
+def get_database_info(cursor):
+    return {
+        table: cursor.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        for table in ["date", "practice", "presentation", "prescribing_norm"]
+    }
+
+
+def get_most_prescribed_bnf_code(cursor):
+    # Queries only match presentations which are in the BNF, which synthetic ones
+    # aren't unless we've added them
+    return cursor.execute(
+        """
+        SELECT presentation.bnf_code
+        FROM prescribing_norm
+        JOIN presentation ON prescribing_norm.presentation_id = presentation.id
+        WHERE presentation.bnf_code IN (SELECT code FROM bnf_code)
+        GROUP BY presentation.bnf_code
+        ORDER BY SUM(prescribing_norm.items) DESC, presentation.bnf_code
+        LIMIT 1
+        """
+    ).fetchone()[0]
+
+
+def get_org_id_to_practice_ids(practice_codes):
+    org_id_to_practice_ids = Org.objects.filter(
+        org_type=Org.OrgType.ICB
+    ).with_practice_ids()
+    if org_id_to_practice_ids:
+        return org_id_to_practice_ids
+    # Without any orgs (e.g. if we've only got synthetic practices) we make some up
+    practice_codes = [code for code in practice_codes if code is not None]
+    return tuple(
+        (f"ORG{i:02}", frozenset(practice_codes[i::SYNTHETIC_ORG_COUNT]))
+        for i in range(SYNTHETIC_ORG_COUNT)
+    )
@@ -0,0 +1,111 @@
+import datetime
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from openprescribing.data import synthetic_data
+from openprescribing.data.models import BNFCode, Org
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate synthetic prescribing and list size source files with the shape of "
+        "the production data, for benchmarking (see `benchmark_rxdb`)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "output_dir",
+            type=Path,
+            help="Directory to write `prescribing/` and `list_size/` files to",
+        )
+        parser.add_argument(
+            "--practices",
+            type=int,
+            default=synthetic_data.PRACTICE_COUNT,
+            help="Number of practices (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--months",
+            type=int,
+            default=synthetic_data.MONTH_COUNT,
+            help="Number of months (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--presentations",
+            type=int,
+            default=synthetic_data.PRESENTATION_COUNT,
+            help="Number of presentations (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--rows-per-month",
+            type=int,
+            default=synthetic_data.ROWS_PER_MONTH,
+            help="Approximate number of prescribing rows per month (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--end-date",
+            type=datetime.date.fromisoformat,
+            default=None,
+            help="Date in the most recent month to generate (default: last month)",
+        )
+        parser.add_argument(
+            "--seed",
+            type=int,
+            default=0,
+            help="Random seed (default: %(default)s)",
+        )
+
+    def handle(
+        self,
+        output_dir,
+        practices,
+        months,
+        presentations,
+        rows_per_month,
+        end_date,
+        seed,
+        **options,
+    ):
+        # Where we have real BNF codes and practices we use them, so that queries and
+        # API requests made against the synthetic data behave as they would against the
+        # real data. We make up any more we need.
+        bnf_codes = get_codes(
+            BNFCode.objects.filter(level=BNFCode.Level.PRESENTATION).values_list(
+                "code", flat=True
+            ),
+            synthetic_data.get_synthetic_bnf_codes,
+            presentations,
+        )
+        practice_codes = get_codes(
+            Org.objects.filter(org_type=Org.OrgType.PRACTICE).values_list(
+                "id", flat=True
+            ),
+            synthetic_data.get_synthetic_practice_codes,
+            practices,
+        )
+
+        synthetic_data.generate(
+            output_dir,
+            bnf_codes=bnf_codes,
+            practice_codes=practice_codes,
+            month_count=months,
+            rows_per_month=rows_per_month,
+            end_date=end_date,
+            seed=seed,
+        )
+        self.stdout.write(
+            f"Generated {months} months of data for {len(practice_codes)} practices "
+            f"and {len(bnf_codes)} presentations in {output_dir}"
+        )
+
+
+def get_codes(real_codes, get_synthetic_codes, count):
+    codes = sorted(real_codes)[:count]
+    seen = set(codes)
+    # We might need more synthetic codes than `count - len(codes)` if some of them
+    # collide with real ones
+    extra = [
+        code for code in get_synthetic_codes(count + len(codes)) if code not in seen
+    ]
+    return sorted(codes + extra[: count - len(codes)])
@@ -1,3 +1,5 @@
+import json
+
 from django.core.management.base import BaseCommand
 from django.db.utils import OperationalError
 
@@ -57,8 +59,16 @@ class Command(BaseCommand):
             max_name_width=max(len(name) for name in ingestor_names),
         )
 
+        # Ingestors may return a report of what they did (see `prescribing.ingest`),
+        # which we write as JSON at the end so that it's easy to pick out of the logs
+        reports = {}
         for name in ingestor_names:
             ingestor = self.available_ingestors[name]
             with log_handler.capture_logs_as(name):
-                ingestor(force=force)
+                report = ingestor(force=force)
                 ensure_main_database_file_is_updated()
+            if report is not None:
+                reports[name] = report
+
+        if reports:
+            self.stdout.write(json.dumps({"ingest_report": reports}, indent=2))
@@ -0,0 +1,171 @@
+import collections
+import concurrent.futures
+import dataclasses
+import json
+import re
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlencode
+
+import numpy as np
+import requests
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay requests captured by `RequestCaptureMiddleware` (see "
+        "OPENPRESCRIBING_REQUEST_CAPTURE_FILE) against a server, and report throughput, "
+        "latency and cache hit ratios"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "capture_file",
+            type=Path,
+            help="File of captured requests, one JSON object per line",
+        )
+        parser.add_argument(
+            "--base-url",
+            default="http://localhost:8000",
+            help="URL of the server to send requests to (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=8,
+            help="Number of requests to have in flight at once (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--limit",
+            type=int,
+            default=None,
+            help="Replay only the first N requests (default: all requests)",
+        )
+        parser.add_argument(
+            "--timeout",
+            type=float,
+            default=60,
+            help="Seconds to wait for each response (default: %(default)s)",
+        )
+
+    def handle(self, capture_file, base_url, concurrency, limit, timeout, **options):
+        with capture_file.open() as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        records = records[:limit]
+        if not records:
+            raise CommandError(f"No requests in {capture_file}")
+
+        urls = [get_url(base_url, record) for record in records]
+        # Sessions aren't guaranteed to be thread-safe, so each thread has its own
+        local = threading.local()
+
+        def replay(url):
+            if not hasattr(local, "session"):
+                local.session = requests.Session()
+            start = time.perf_counter()
+            try:
+                rsp = local.session.get(url, timeout=timeout)
+            except requests.RequestException as e:
+                return Result(url, type(e).__name__, time.perf_counter() - start, {})
+            return Result(
+                url,
+                rsp.status_code,
+                time.perf_counter() - start,
+                parse_server_timing(rsp.headers.get("Server-Timing", "")),
+            )
+
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            results = list(executor.map(replay, urls))
+        elapsed = time.perf_counter() - start
+
+        self.report(records, results, elapsed, concurrency)
+
+    def report(self, records, results, elapsed, concurrency):
+        self.stdout.write(
+            f"{len(results)} requests in {elapsed:.1f}s with concurrency {concurrency}: "
+            f"{len(results) / elapsed:.1f} requests/s"
+        )
+
+        statuses = collections.Counter(str(result.status) for result in results)
+        self.stdout.write(
+            "Statuses: "
+            + ", ".join(f"{status}={n}" for status, n in sorted(statuses.items()))
+        )
+
+        self.stdout.write("Latency:")
+        by_endpoint = collections.defaultdict(list)
+        for record, result in zip(records, results):
+            by_endpoint[record["endpoint"]].append(result.duration)
+        self.stdout.write(
+            "  " + format_latencies("all", [result.duration for result in results])
+        )
+        for endpoint, durations in sorted(by_endpoint.items()):
+            self.stdout.write("  " + format_latencies(endpoint, durations))
+
+        # Every cache lookup made while answering a request is reported in its
+        # Server-Timing header (see `cache_metrics`), if the server sends one (see
+        # OPENPRESCRIBING_SEND_SERVER_TIMING)
+        hits = sum(result.timings.get("cache", {}).get("hits", 0) for result in results)
+        misses = sum(
+            result.timings.get("cache", {}).get("misses", 0) for result in results
+        )
+        if hits + misses:
+            self.stdout.write(
+                f"Cache: {hits} hits, {misses} misses "
+                f"({hits / (hits + misses):.0%} hit ratio)"
+            )
+        else:
+            self.stdout.write(
+                "Cache: no lookups reported (the server only reports them if "
+                "OPENPRESCRIBING_SEND_SERVER_TIMING is set)"
+            )
+
+
+@dataclasses.dataclass
+class Result:
+    url: str
+    # The response's status code, or the name of the exception if there wasn't one
+    status: int | str
+    duration: float
+    timings: dict
+
+
+def get_url(base_url, record):
+    url = base_url.rstrip("/") + record["endpoint"]
+    if record["analysis"] is not None:
+        url += "?" + urlencode({"analysis": json.dumps(record["analysis"])})
+    return url
+
+
+def format_latencies(name, durations):
+    p50, p90, p99 = np.percentile(durations, [50, 90, 99]) * 1000
+    return (
+        f"{name}: "
+        f"p50 {p50:.1f}ms, "
+        f"p90 {p90:.1f}ms, "
+        f"p99 {p99:.1f}ms, "
+        f"max {max(durations) * 1000:.1f}ms "
+        f"({len(durations)} requests)"
+    )
+
+
+def parse_server_timing(header):
+    """Parse a `Server-Timing` header as written by `Timings.to_server_timing()` into a
+    dict mapping each metric's name to its duration ("dur") and counts."""
+
+    timings = {}
+    for metric in filter(None, (m.strip() for m in header.split(","))):
+        name, *params = metric.split(";")
+        values = {}
+        for param in params:
+            key, _, value = param.partition("=")
+            if key == "dur":
+                values["dur"] = float(value)
+            elif key == "desc":
+                for count in re.findall(r"(\w+)=(\d+)", value):
+                    values[count[0]] = int(count[1])
+        timings[name] = values
+    return timings
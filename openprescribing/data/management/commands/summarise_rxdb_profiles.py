@@ -0,0 +1,94 @@
+import json
+from collections import defaultdict
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from openprescribing.data.rxdb import profiling
+
+
+class Command(BaseCommand):
+    help = (
+        "Summarise the query profiles written by the rxdb profiler, listing the "
+        "operators which took the most time and the slowest queries"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--profile-dir",
+            type=Path,
+            default=profiling.PROFILE_DIR or None,
+            help="Directory of profiles (default: OPENPRESCRIBING_RXDB_PROFILE_DIR)",
+        )
+        parser.add_argument(
+            "--limit",
+            type=int,
+            default=10,
+            help="Number of operators and queries to list (default: %(default)s)",
+        )
+
+    def handle(self, profile_dir, limit, **options):
+        if profile_dir is None:
+            raise CommandError("No profile directory given")
+
+        records = []
+        for path in sorted(profile_dir.glob("*.json")):
+            record = json.loads(path.read_text())
+            record["path"] = path
+            records.append(record)
+        self.stdout.write(f"{len(records)} profiles in {profile_dir}")
+        if not records:
+            return
+
+        # Group operators by type (e.g. TABLE_SCAN, HASH_GROUP_BY) across all profiles
+        operators = defaultdict(
+            lambda: {"count": 0, "time": 0.0, "max": 0.0, "rows": 0}
+        )
+        for record in records:
+            for operator in get_operators(record["profile"]):
+                totals = operators[operator["operator_type"]]
+                totals["count"] += 1
+                totals["time"] += operator["operator_timing"]
+                totals["max"] = max(totals["max"], operator["operator_timing"])
+                totals["rows"] += operator["operator_cardinality"]
+
+        self.stdout.write("\nSlowest operators (by total time):")
+        slowest_operators = sorted(
+            operators.items(), key=lambda item: item[1]["time"], reverse=True
+        )
+        for operator_type, totals in slowest_operators[:limit]:
+            self.stdout.write(
+                f"  {operator_type}: "
+                f"total {totals['time'] * 1000:.1f}ms, "
+                f"max {totals['max'] * 1000:.1f}ms, "
+                f"{totals['count']} occurrences, "
+                f"{totals['rows']:,} rows"
+            )
+
+        self.stdout.write("\nSlowest queries:")
+        slowest_records = sorted(records, key=lambda r: r["duration"], reverse=True)
+        for record in slowest_records[:limit]:
+            slowest_operator = max(
+                get_operators(record["profile"]),
+                key=lambda operator: operator["operator_timing"],
+                default=None,
+            )
+            line = (
+                f"  {record['duration'] * 1000:.1f}ms "
+                f"analysis={record['label']} "
+                f"({record['path'].name})"
+            )
+            if slowest_operator is not None:
+                line += (
+                    f", slowest operator {slowest_operator['operator_type']} "
+                    f"{slowest_operator['operator_timing'] * 1000:.1f}ms"
+                )
+            self.stdout.write(line)
+
+
+def get_operators(node):
+    """Yield every operator in a profile's tree of operators."""
+
+    for child in node.get("children", []):
+        yield child
+        yield from get_operators(child)
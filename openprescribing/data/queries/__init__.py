@@ -1,10 +1,12 @@
 from .get_medication_date_matrix import get_medication_date_matrix
+from .get_org_date_matrix import get_org_date_matrix
 from .get_org_date_ratio_matrix import get_org_date_ratio_matrix
 from .get_practice_date_matrix import get_practice_date_matrix
 
 
 __all__ = [
     "get_medication_date_matrix",
+    "get_org_date_matrix",
     "get_org_date_ratio_matrix",
     "get_practice_date_matrix",
 ]
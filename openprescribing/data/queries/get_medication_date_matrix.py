@@ -1,9 +1,15 @@
-import functools
-from collections import defaultdict
-
 from openprescribing.data.rxdb.labelled_matrix import LabelledMatrix
+from openprescribing.data.utils.cache_metrics import metered_cache
 
-from .query_utils import get_dates, get_grouped_sum_ndarray, get_index_tuple
+from .query_utils import (
+    get_bnf_code_to_presentation_ids,
+    get_dates,
+    get_grouped_sum_ndarray,
+    get_index_tuple,
+    get_presentation_id_partitions,
+    get_query_cost,
+    resolve_query,
+)
 
 
 __all__ = ["get_medication_date_matrix"]
@@ -14,7 +20,7 @@ __all__ = ["get_medication_date_matrix"]
 MEDICATION_DATE_MATRIX_CACHE_SIZE = 128
 
 
-@functools.lru_cache(maxsize=MEDICATION_DATE_MATRIX_CACHE_SIZE)
+@metered_cache(maxsize=MEDICATION_DATE_MATRIX_CACHE_SIZE)
 def get_medication_date_matrix(cursor, query, date_count=None):
     """
     Given a `BNFQuery`, sum the prescribed items for each medication and date and return
@@ -34,6 +40,8 @@ def get_medication_date_matrix(cursor, query, date_count=None):
     """
 
     presentation_ids, dates = get_presentation_ids_and_dates(cursor, date_count)
+    query_sql, codes = resolve_query(query)
+    partitions = get_presentation_id_partitions(cursor, codes)
 
     values = get_grouped_sum_ndarray(
         cursor,
@@ -46,8 +54,11 @@ def get_medication_date_matrix(cursor, query, date_count=None):
             CAST(presentation_id AS UINTEGER) AS row_index,
             date_id AS column_index,
             value
-        FROM ({query.to_sql()})
+            {", presentation_id AS partition_key" if partitions else ""}
+        FROM ({query_sql})
         """,
+        partitions=partitions,
+        cost=get_query_cost(cursor, codes),
     )
 
     presentation_date_matrix = LabelledMatrix(
@@ -58,17 +69,14 @@ def get_medication_date_matrix(cursor, query, date_count=None):
 
     # Collapse presentations into one row per matching BNF code.
     code_to_ids = get_bnf_code_to_presentation_ids(cursor)
-    row_label_map = tuple(
-        (code, code_to_ids.get(code, ()))
-        for code in query.get_matching_presentation_codes()
-    )
+    row_label_map = tuple((code, code_to_ids.get(code, ())) for code in codes)
     grouped = presentation_date_matrix.group_rows(row_label_map)
 
     # Drop codes with no prescribing in the date range.
     return grouped.drop_zero_rows()
 
 
-@functools.cache
+@metered_cache()
 def get_presentation_ids_and_dates(cursor, date_count):
     """
     Find the N most recent dates for which we have prescribing data and return them as an
@@ -82,16 +90,3 @@ def get_presentation_ids_and_dates(cursor, date_count):
     results = cursor.execute("SELECT id, id FROM presentation")
     presentation_ids = get_index_tuple(results.fetchall())
     return presentation_ids, dates
-
-
-@functools.cache
-def get_bnf_code_to_presentation_ids(cursor):
-    """
-    Return a dict mapping each BNF code to the tuple of presentation IDs which have that
-    code.
-    """
-    results = cursor.execute("SELECT id, bnf_code FROM presentation")
-    code_to_ids = defaultdict(list)
-    for presentation_id, bnf_code in results.fetchall():
-        code_to_ids[bnf_code].append(presentation_id)
-    return {code: tuple(ids) for code, ids in code_to_ids.items()}
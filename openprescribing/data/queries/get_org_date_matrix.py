@@ -0,0 +1,117 @@
+from openprescribing.data.rxdb.labelled_matrix import LabelledMatrix
+from openprescribing.data.utils.cache_metrics import metered_cache
+from openprescribing.data.utils.duckdb_utils import FLOAT_TYPES
+
+from .get_practice_date_matrix import get_practice_codes_and_dates
+from .query_utils import get_grouped_sum_ndarray, get_query_cost, resolve_query
+
+
+__all__ = ["get_org_date_matrix"]
+
+
+# Org-level matrices are tiny compared to practice-level ones (42 ICBs rather than 15,000
+# practices) so caching the same number of them costs almost nothing.
+ORG_DATE_MATRIX_CACHE_SIZE = 128
+
+# There's one mapping for each type of org we group practices into, but the practice
+# codes change with each new generation of the data, and old mappings are never used
+# again once it does
+PRACTICE_ID_TO_ORG_INDEX_MAPPING_CACHE_SIZE = 16
+
+
+@metered_cache(maxsize=ORG_DATE_MATRIX_CACHE_SIZE)
+def get_org_date_matrix(cursor, query, org_id_to_practice_ids, date_count=None):
+    """
+    Given BNFQuery or ListSizeQuery and a mapping of org IDs to practice codes (in the
+    form produced by `OrgQuerySet.with_practice_ids()`), sum all the values for each org
+    and date and return a `LabelledMatrix` of these values, where the rows are labelled
+    with org IDs and the columns are labelled with dates.
+
+    The result is the same as:
+
+        get_practice_date_matrix(cursor, query, date_count).group_rows(
+            org_id_to_practice_ids
+        )
+
+    but rather than pulling a row per practice out of DuckDB and then collapsing these
+    rows in Python, we pass the practice-to-org mapping into the query and let DuckDB do
+    the grouping. This means far fewer rows need to cross into Python. The price is that
+    the result is specific to one type of org, whereas a practice-date matrix can be
+    grouped into any type of org.
+    """
+    practice_codes, dates = get_practice_codes_and_dates(cursor, date_count)
+    org_ids, practice_ids, org_indexes = get_practice_id_to_org_index_mapping(
+        practice_codes, org_id_to_practice_ids
+    )
+
+    query_sql, codes = resolve_query(query)
+    # DuckDB sums integers as HUGEINT, which Arrow has no equivalent for, so we need to
+    # cast the sum to something we can handle. We use the widest types that NumPy
+    # supports, as these are what `get_grouped_sum_ndarray` would accumulate into anyway.
+    query_relation = cursor.sql(query_sql)
+    value_type = query_relation.types[query_relation.columns.index("value")]
+    sum_type = "DOUBLE" if value_type.id in FLOAT_TYPES else "BIGINT"
+
+    values = get_grouped_sum_ndarray(
+        cursor,
+        row_count=len(org_ids),
+        col_count=len(dates),
+        sql=f"""
+        SELECT
+            CAST(org_map.org_index AS UINTEGER) AS row_index,
+            query.date_id AS column_index,
+            CAST(SUM(query.value) AS {sum_type}) AS value
+        FROM ({query_sql}) AS query
+        JOIN (
+            SELECT
+                unnest($practice_ids) AS practice_id,
+                unnest($org_indexes) AS org_index
+        ) AS org_map
+        ON query.practice_id = org_map.practice_id
+        GROUP BY org_map.org_index, query.date_id
+        """,
+        params={"practice_ids": list(practice_ids), "org_indexes": list(org_indexes)},
+        cost=get_query_cost(cursor, codes),
+    )
+
+    return LabelledMatrix(
+        values,
+        row_labels=org_ids,
+        col_labels=dates,
+    )
+
+
+@metered_cache(maxsize=PRACTICE_ID_TO_ORG_INDEX_MAPPING_CACHE_SIZE)
+def get_practice_id_to_org_index_mapping(practice_codes, org_id_to_practice_ids):
+    """
+    Given an index tuple of practice codes (see `get_practice_codes_and_dates()`) and a
+    mapping of org IDs to practice codes, return a tuple of org IDs together with a pair
+    of parallel tuples giving, for each practice ID, the index of the org it belongs to.
+
+    As with `LabelledMatrix.group_rows()`, practices which don't appear in the index
+    tuple are ignored, and orgs with no matching practices are still included (and so
+    will end up with all zero values).
+    """
+    practice_code_to_id = {
+        code: practice_id
+        for practice_id, code in enumerate(practice_codes)
+        if code is not None
+    }
+
+    org_ids = []
+    practice_ids = []
+    org_indexes = []
+    for org_index, (org_id, org_practice_codes) in enumerate(org_id_to_practice_ids):
+        org_ids.append(org_id)
+        for code in sorted(org_practice_codes):
+            if code in practice_code_to_id:
+                practice_ids.append(practice_code_to_id[code])
+                org_indexes.append(org_index)
+
+    # As in `create_row_grouper()`, this is a guard against accidental misuse: a
+    # practice mapped to more than one org would have its values counted twice.
+    assert len(practice_ids) == len(set(practice_ids)), (
+        "Single practice mapped to multiple orgs"
+    )
+
+    return tuple(org_ids), tuple(practice_ids), tuple(org_indexes)
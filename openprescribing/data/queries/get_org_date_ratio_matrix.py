@@ -1,20 +1,36 @@
+import os
+
 from openprescribing.data.list_size_query import ListSizeQuery
 from openprescribing.data.models import Org
 
 from ..bnf_query import BNFQuery
+from .get_org_date_matrix import get_org_date_matrix
 from .get_practice_date_matrix import get_practice_date_matrix
 
 
-def get_org_date_ratio_matrix(cursor, analysis, date_count=None):
+# There are two ways of getting from prescribing data to org-level values. We can either
+# build a practice-date matrix and group its rows into orgs in Python, or we can have
+# DuckDB do the grouping and return org-level values directly (see
+# `get_org_date_matrix`). The latter moves far less data around, but the former produces
+# cached practice-date matrices which can be reused when the same query is viewed for a
+# different type of org. The default can be changed without redeploying so that we can
+# compare the two in production.
+AGGREGATE_ORGS_IN_DUCKDB = (
+    os.environ.get("OPENPRESCRIBING_AGGREGATE_ORGS_IN_DUCKDB", "False") == "True"
+)
+
+
+def get_org_date_ratio_matrix(
+    cursor, analysis, date_count=None, aggregate_in_duckdb=None
+):
     """Return a matrix with one row per org and one column per date, giving ratio
-    between numerator and denominator values specified by queries in given analysis."""
+    between numerator and denominator values specified by queries in given analysis.
 
-    ntr_pdm = get_practice_date_matrix(
-        cursor, analysis.ntr_query, date_count=date_count
-    )
-    dtr_pdm = get_practice_date_matrix(
-        cursor, analysis.dtr_query, date_count=date_count
-    )
+    If `aggregate_in_duckdb` is not specified then `AGGREGATE_ORGS_IN_DUCKDB` determines
+    how practice values are grouped into orgs."""
+
+    if aggregate_in_duckdb is None:
+        aggregate_in_duckdb = AGGREGATE_ORGS_IN_DUCKDB
 
     if analysis.org_id is not None:
         org_type = Org.objects.get(id=analysis.org_id).org_type
@@ -23,8 +39,22 @@ def get_org_date_ratio_matrix(cursor, analysis, date_count=None):
 
     org_id_to_practice_ids = Org.objects.filter(org_type=org_type).with_practice_ids()
 
-    ntr_odm = ntr_pdm.group_rows(org_id_to_practice_ids)
-    dtr_odm = dtr_pdm.group_rows(org_id_to_practice_ids)
+    if aggregate_in_duckdb:
+        ntr_odm = get_org_date_matrix(
+            cursor, analysis.ntr_query, org_id_to_practice_ids, date_count=date_count
+        )
+        dtr_odm = get_org_date_matrix(
+            cursor, analysis.dtr_query, org_id_to_practice_ids, date_count=date_count
+        )
+    else:
+        ntr_pdm = get_practice_date_matrix(
+            cursor, analysis.ntr_query, date_count=date_count
+        )
+        dtr_pdm = get_practice_date_matrix(
+            cursor, analysis.dtr_query, date_count=date_count
+        )
+        ntr_odm = ntr_pdm.group_rows(org_id_to_practice_ids)
+        dtr_odm = dtr_pdm.group_rows(org_id_to_practice_ids)
 
     # For prescribing vs prescribing queries, we want to show the numerator values
     # as a percentage of the denominator values.  For prescribing vs list size
@@ -1,20 +1,27 @@
-import functools
-
 from openprescribing.data.rxdb.labelled_matrix import LabelledMatrix
+from openprescribing.data.utils.cache_metrics import metered_cache
 
-from .query_utils import get_dates, get_grouped_sum_ndarray, get_index_tuple
+from .query_utils import (
+    get_dates,
+    get_grouped_sum_ndarray,
+    get_index_tuple,
+    get_presentation_id_partitions,
+    get_query_cost,
+    resolve_query,
+)
 
 
 __all__ = ["get_practice_date_matrix"]
 
 
 # The largest of these matrices are about 16MB in size (140 dates x 15,000 practices x 8
-# bytes per value). Caching the most recently used 128 only takes 2GB of RAM and should
-# mean we can serve common queries from the cache.
+# bytes per value), and item counts usually fit in 4 bytes per value which halves this.
+# Caching the most recently used 128 takes at most 2GB of RAM and should mean we can
+# serve common queries from the cache.
 PRACTICE_DATE_MATRIX_CACHE_SIZE = 128
 
 
-@functools.lru_cache(maxsize=PRACTICE_DATE_MATRIX_CACHE_SIZE)
+@metered_cache(maxsize=PRACTICE_DATE_MATRIX_CACHE_SIZE)
 def get_practice_date_matrix(cursor, query, date_count=None):
     """
     Given BNFQuery or ListSizeQuery, sum all the values for each practice and date and
@@ -25,6 +32,9 @@ def get_practice_date_matrix(cursor, query, date_count=None):
     prescribing data.
     """
     practice_codes, dates = get_practice_codes_and_dates(cursor, date_count)
+    query_sql, codes = resolve_query(query)
+    # Only prescribing queries can be split up by presentation
+    partitions = get_presentation_id_partitions(cursor, codes)
 
     values = get_grouped_sum_ndarray(
         cursor,
@@ -35,8 +45,11 @@ def get_practice_date_matrix(cursor, query, date_count=None):
             practice_id AS row_index,
             date_id AS column_index,
             value
-        FROM ({query.to_sql()})
+            {", presentation_id AS partition_key" if partitions else ""}
+        FROM ({query_sql})
         """,
+        partitions=partitions,
+        cost=get_query_cost(cursor, codes),
     )
 
     return LabelledMatrix(
@@ -46,7 +59,7 @@ def get_practice_date_matrix(cursor, query, date_count=None):
     )
 
 
-@functools.cache
+@metered_cache()
 def get_practice_codes_and_dates(cursor, date_count):
     """
     Find the N most recent dates for which we have prescribing data and all the practice
@@ -1,6 +1,17 @@
+import contextlib
+import contextvars
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from scipy.sparse._sparsetools import coo_todense
 
+from openprescribing.data.bnf_query import BNFQuery
+from openprescribing.data.rxdb.admission import Overloaded, admit, is_enabled
+from openprescribing.data.utils import timing
+from openprescribing.data.utils.cache_metrics import metered_cache
 from openprescribing.data.utils.duckdb_utils import (
     FLOAT_TYPES,
     NUMERIC_TYPES,
@@ -8,6 +19,20 @@ from openprescribing.data.utils.duckdb_utils import (
 )
 
 
+# Integer types narrow enough that sums of their values will usually fit in `int32`, so
+# that's what we start off summing them as
+NARROW_INTEGER_TYPES = {
+    "utinyint",
+    "usmallint",
+    "uinteger",
+    "tinyint",
+    "smallint",
+    "integer",
+}
+
+INT32_MAX = np.iinfo(np.int32).max
+
+
 # Sets the number of rows we fetch in each batch from DuckDB. There's no perfect answer
 # to what size these batches should be, but here are some considerations:
 #
@@ -25,6 +50,26 @@ from openprescribing.data.utils.duckdb_utils import (
 # land on what looked like the optimal value. It may well be possible to improve it.
 RECORD_BATCH_SIZE = 2048 * 64
 
+# Sets the maximum number of partitions (and hence threads) into which we split large
+# queries (see `get_grouped_sum_ndarray`). Partitioning pays off for broad queries
+# (e.g. whole BNF chapters) on machines with cores to spare, but each partition is a
+# separate DuckDB query and so it's pure overhead for small queries, hence the
+# minimum partition size. We default to no partitioning and enable it by setting an
+# environment variable so that the setting can be tuned without redeploying.
+PARTITION_COUNT = int(os.environ.get("OPENPRESCRIBING_RXDB_PARTITION_COUNT", "1"))
+MIN_PRESENTATIONS_PER_PARTITION = 200
+
+# The number of presentations which a query must match to have each additional unit of
+# cost when deciding whether to admit it (see `rxdb.admission`). This is crude: it
+# ignores how much each presentation is prescribed. But it's cheap to work out and it
+# tells apart the chapter-wide scans, which are the ones we need to hold back, from
+# queries for a handful of products.
+PRESENTATIONS_PER_COST_UNIT = 1000
+
+# If set, this is called with the number of rows in each batch of results as we consume
+# it, which lets long-running callers (see `openprescribing.web.jobs`) report progress
+batch_callback = contextvars.ContextVar("batch_callback", default=None)
+
 
 def get_dates(cursor, date_count):
     results = cursor.execute(
@@ -49,13 +94,16 @@ def get_index_tuple(index_value_pairs):
     return tuple(index_to_value.get(index) for index in all_indexes)
 
 
-def get_grouped_sum_ndarray(cursor, row_count, col_count, sql):
+def get_grouped_sum_ndarray(
+    cursor, row_count, col_count, sql, params=None, partitions=None, cost=1
+):
     """
     Given a SQL query of the form:
 
         SELECT row_index, column_index, value FROM ...
 
-    Build a two-dimensional `np.ndarray` from the results.
+    Build a two-dimensional `np.ndarray` from the results. Any `params` are passed
+    through to DuckDB as query parameters.
 
     It's expected that we'll see multiple values for the same coordinate in the array
     and these values will be summed together. The effect is thus the same as doing:
@@ -66,36 +114,196 @@ def get_grouped_sum_ndarray(cursor, row_count, col_count, sql):
 
     This is the key data-heavy operation which OpenPrescribing needs to perform and so
     it's worth a bit of complexity here to make this fast.
+
+    Integer results are summed as `int32` where possible, which halves the memory used
+    by the (cached) results compared with `int64`. Before adding each batch of results
+    we check whether the sums could overflow and, if they could, switch to `int64`.
+
+    Consuming the results is single-threaded, and for large queries this can become the
+    bottleneck while DuckDB's other threads sit idle. If `partitions` is supplied then
+    the query must have an additional `partition_key` column and `partitions` must be a
+    sequence of non-overlapping `(start, end)` ranges of this key. We then run a
+    separate query for each range in its own thread, each summing into its own array,
+    and add these together at the end.
+
+    The query isn't started until it has been admitted with the supplied `cost` (see
+    `rxdb.admission`), which may mean waiting for other queries to finish. We never
+    wait beyond the cursor's deadline: if it passes while we're waiting then we raise
+    `QueryTimeout` rather than start the query (and if it passes while the query runs
+    then the query is interrupted, see `CursorCacheKeyWrapper`).
+    """
+    with contextlib.ExitStack() as stack:
+        # We time waiting for admission separately from the query itself, but we must
+        # hold on to our admission until the query has finished
+        with timing.span("rxdb.admission"):
+            try:
+                stack.enter_context(admit(cost, deadline=cursor.deadline))
+            except Overloaded:
+                # If we gave up waiting because the deadline passed, then say so
+                cursor.check_deadline()
+                raise
+        cursor.check_deadline()
+        with timing.span("rxdb.query") as counts:
+            counts["partitions"] = len(partitions) if partitions else 1
+            return _get_grouped_sum_ndarray(
+                cursor, row_count, col_count, sql, params, partitions
+            )
+
+
+def _get_grouped_sum_ndarray(cursor, row_count, col_count, sql, params, partitions):
+    if not partitions:
+        results, dtype = get_filtered_results(cursor, row_count, col_count, sql, params)
+        # Make a zero-valued accumulator matrix of the right type
+        accumulator = np.zeros(shape=(row_count, col_count), dtype=dtype)
+        with cursor.profiled():
+            return accumulate_results(results, accumulator)
+
+    def get_partition_ndarray(partition_cursor, start, end):
+        results, dtype = get_filtered_results(
+            partition_cursor, row_count, col_count, sql, params, partition=(start, end)
+        )
+        accumulator = np.zeros(shape=(row_count, col_count), dtype=dtype)
+        with partition_cursor.profiled():
+            return accumulate_results(results, accumulator)
+
+    # DuckDB cursors can't be shared between threads so each partition needs its own,
+    # and we create them here rather than in the threads so that the original cursor is
+    # only ever used from this thread
+    with contextlib.ExitStack() as stack:
+        partition_cursors = [
+            stack.enter_context(cursor.duplicate()) for _ in partitions
+        ]
+        with ThreadPoolExecutor(max_workers=len(partitions)) as executor:
+            # Each thread gets a copy of our context so that `batch_callback` and timings
+            # still work
+            futures = [
+                executor.submit(
+                    contextvars.copy_context().run,
+                    get_partition_ndarray,
+                    partition_cursor,
+                    start,
+                    end,
+                )
+                for partition_cursor, (start, end) in zip(partition_cursors, partitions)
+            ]
+            accumulators = [future.result() for future in futures]
+
+    accumulator = accumulators[0]
+    for other in accumulators[1:]:
+        if accumulator.dtype == np.int32 and other.dtype == np.int32:
+            if get_abs_max(accumulator) + get_abs_max(other) > INT32_MAX:
+                accumulator = accumulator.astype(np.int64)
+        accumulator = np.add(accumulator, other, out=None)
+    return accumulator
+
+
+def get_filtered_results(cursor, row_count, col_count, sql, params, partition=None):
+    """
+    Return a lazy DuckDB relation for the supplied query, checked to have the structure
+    that `get_grouped_sum_ndarray` expects and filtered to just those results that fall
+    within the array (and within the partition, if supplied), together with the NumPy
+    dtype needed to hold the sums of its values
     """
     # The `sql` method is lazy so it parses the query and determines the column types
     # but doesn't yet execute it
-    results = cursor.sql(sql)
+    results = cursor.sql(sql, params=params)
+
+    if partition is None:
+        assert results.columns == ["row_index", "column_index", "value"]
+    else:
+        assert results.columns == [
+            "row_index",
+            "column_index",
+            "value",
+            "partition_key",
+        ]
+        start, end = partition
+        results = results.filter(
+            f"partition_key >= {int(start)} AND partition_key < {int(end)}"
+        ).project("row_index, column_index, value")
 
-    assert results.columns == ["row_index", "column_index", "value"]
     row_type, col_type, value_type = results.types
     assert row_type.id in UNSIGNED_INTEGER_TYPES
     assert col_type.id in UNSIGNED_INTEGER_TYPES
     assert value_type.id in NUMERIC_TYPES
-    value_is_float = value_type.id in FLOAT_TYPES
 
     # Add a filter so that we can guarantee the row and column indexes will be in range
     results = results.filter(f"row_index < {row_count} AND column_index < {col_count}")
 
-    # Make a zero-valued accumulator matrix of the right type
-    accumulator = np.zeros(
-        shape=(row_count, col_count),
-        dtype=np.float64 if value_is_float else np.int64,
-    )
+    # We always sum floats as `float64`: the values we store as floats (e.g. quantities)
+    # have wide ranges and summing them at lower precision would lose too much
+    # accuracy. Narrow integers (like item counts) start off as `int32` and get promoted
+    # if necessary (see `accumulate_results`). Anything else needs `int64` from the
+    # start.
+    if value_type.id in FLOAT_TYPES:
+        dtype = np.float64
+    elif value_type.id in NARROW_INTEGER_TYPES:
+        dtype = np.int32
+    else:
+        dtype = np.int64
+
+    return results, dtype
+
+
+def accumulate_results(results, accumulator):
+    """
+    Sum the values from a relation returned by `get_filtered_results` into the
+    supplied accumulator array and return it
+
+    If the accumulator is `int32` and the sums could overflow, we switch to an `int64`
+    copy part way through, so callers must use the returned array rather than the one
+    they supplied.
+    """
+    row_count, col_count = accumulator.shape
 
     # Prepare some values that `coo_todense` needs (based on reading the SciPy source)
     accumulator_ravel = accumulator.ravel("A")
     is_fortran_order = int(accumulator.flags.f_contiguous)
 
-    for batch in results.to_arrow_reader(batch_size=RECORD_BATCH_SIZE):
+    # An upper bound on the absolute value of every entry in the accumulator. Keeping
+    # track of this lets us check for possible overflow without having to scan the
+    # whole accumulator for every batch.
+    abs_max_bound = 0
+
+    callback = batch_callback.get()
+
+    # We time separately how long we spend waiting for DuckDB to produce each batch of
+    # results (which includes converting them to Arrow) and how long we spend adding
+    # them up
+    fetch_duration = 0
+    sum_duration = 0
+    rows = 0
+    batches = 0
+    nbytes = 0
+
+    reader = results.to_arrow_reader(batch_size=RECORD_BATCH_SIZE)
+    fetch_start = time.perf_counter()
+    for batch in reader:
+        sum_start = time.perf_counter()
+        fetch_duration += sum_start - fetch_start
+        rows += batch.num_rows
+        batches += 1
+        nbytes += batch.nbytes
+
         row_indexes = batch.column(0).to_numpy()
         col_indexes = batch.column(1).to_numpy()
         values = batch.column(2).to_numpy()
 
+        if accumulator.dtype == np.int32:
+            # No entry can grow by more than the sum of all the values in the batch
+            batch_abs_sum = int(np.abs(values.astype(np.int64)).sum())
+            if abs_max_bound + batch_abs_sum > INT32_MAX:
+                # Our bound may be too pessimistic, so find the actual maximum
+                abs_max_bound = get_abs_max(accumulator)
+            if abs_max_bound + batch_abs_sum > INT32_MAX:
+                accumulator = accumulator.astype(np.int64)
+                accumulator_ravel = accumulator.ravel("A")
+            else:
+                abs_max_bound += batch_abs_sum
+                # `coo_todense` requires that values can be safely cast to the type of
+                # the accumulator, and we've just checked that they fit
+                values = values.astype(np.int32, copy=False)
+
         # Add each batch of results into our accumulator matrix using a fast routine
         # borrowed from `scipy.sparse`
         coo_todense(
@@ -109,4 +317,101 @@ def get_grouped_sum_ndarray(cursor, row_count, col_count, sql):
             is_fortran_order,
         )
 
+        if callback is not None:
+            callback(len(values))
+
+        fetch_start = time.perf_counter()
+        sum_duration += fetch_start - sum_start
+
+    fetch_duration += time.perf_counter() - fetch_start
+    timing.record(
+        "rxdb.fetch", fetch_duration, rows=rows, batches=batches, bytes=nbytes
+    )
+    timing.record("coo_todense", sum_duration)
+
     return accumulator
+
+
+def get_abs_max(array):
+    if array.size == 0:
+        return 0
+    return max(int(array.max()), -int(array.min()))
+
+
+def resolve_query(query):
+    """
+    Return the SQL for the supplied `BNFQuery` or `ListSizeQuery`, along with the list
+    of BNF codes which it matches (or `None` if it isn't a `BNFQuery`)
+
+    Finding the matching codes means querying the database, so we do it once and pass
+    the codes to `get_presentation_id_partitions` and `get_query_cost` rather than have
+    each of them resolve the query again.
+    """
+    if not isinstance(query, BNFQuery):
+        return query.to_sql(), None
+    codes = query.get_matching_presentation_codes()
+    return query.to_sql(codes=codes), codes
+
+
+def get_presentation_id_partitions(cursor, codes):
+    """
+    Split the IDs of the presentations with the supplied BNF codes (as returned by
+    `resolve_query`) into at most `PARTITION_COUNT` contiguous, non-overlapping
+    `(start, end)` ranges, each containing a similar number of presentations, suitable
+    for passing as the `partitions` argument to `get_grouped_sum_ndarray`
+
+    Return `None` if partitioning is disabled, there are no codes because the query
+    isn't a `BNFQuery`, or the query isn't big enough to be worth splitting up.
+    """
+    if PARTITION_COUNT < 2 or codes is None:
+        return None
+    presentation_ids = get_presentation_ids(cursor, codes)
+    partition_count = min(
+        PARTITION_COUNT, len(presentation_ids) // MIN_PRESENTATIONS_PER_PARTITION
+    )
+    if partition_count < 2:
+        return None
+    return tuple(
+        (int(chunk[0]), int(chunk[-1]) + 1)
+        for chunk in np.array_split(presentation_ids, partition_count)
+    )
+
+
+def get_query_cost(cursor, codes):
+    """
+    Return an estimate of the cost of scanning the data for a query matching the
+    supplied BNF codes (as returned by `resolve_query`), for passing as the `cost`
+    argument to `get_grouped_sum_ndarray`
+    """
+    # The cost is only used for admission control, so we don't bother working it out
+    # if that's disabled. List size data (which has no codes) is tiny compared with
+    # prescribing data.
+    if not is_enabled() or codes is None:
+        return 1
+    presentation_count = len(get_presentation_ids(cursor, codes))
+    return 1 + presentation_count // PRESENTATIONS_PER_COST_UNIT
+
+
+def get_presentation_ids(cursor, codes):
+    """
+    Return a sorted list of the IDs of the presentations with the supplied BNF codes
+    """
+    code_to_ids = get_bnf_code_to_presentation_ids(cursor)
+    return sorted(
+        presentation_id
+        for code in codes
+        for presentation_id in code_to_ids.get(code, ())
+    )
+
+
+@metered_cache()
+def get_bnf_code_to_presentation_ids(cursor):
+    """
+    Return a dict mapping each BNF code to the tuple of presentation IDs which have that
+    code.
+    """
+    results = cursor.execute("SELECT id, bnf_code FROM presentation")
+    code_to_ids = defaultdict(list)
+    for presentation_id, bnf_code in results.fetchall():
+        code_to_ids[bnf_code].append(presentation_id)
+    return {code: tuple(ids) for code, ids in code_to_ids.items()}
@@ -1,7 +1,8 @@
-from .connection import get_cache_key, get_cursor
+from .connection import QueryTimeout, get_cache_key, get_cursor
 
 
 __all__ = [
+    "QueryTimeout",
     "get_cache_key",
     "get_cursor",
 ]
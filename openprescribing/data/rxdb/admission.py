@@ -0,0 +1,109 @@
+import contextlib
+import os
+import threading
+import time
+
+
+__all__ = ["admit", "is_enabled", "Overloaded"]
+
+
+# Every gunicorn thread can start a DuckDB scan at once and, under a burst of uncached
+# requests, they all slow down together and memory use climbs. To prevent this we give
+# each scan a "cost" (see `query_utils.get_query_cost`) and only admit scans while their
+# total cost is within `ADMISSION_CAPACITY`. Other scans wait (for at most
+# `ADMISSION_TIMEOUT` seconds) and, if too many are already waiting, we give up straight
+# away rather than join the queue.
+#
+# Cached results never reach the point where we admit scans, so cheap requests aren't
+# held up behind expensive ones.
+#
+# A capacity of zero disables admission control. As with partitioning, these are set by
+# environment variables so that they can be tuned without redeploying.
+ADMISSION_CAPACITY = int(os.environ.get("OPENPRESCRIBING_RXDB_ADMISSION_CAPACITY", "0"))
+ADMISSION_TIMEOUT = float(
+    os.environ.get("OPENPRESCRIBING_RXDB_ADMISSION_TIMEOUT", "10")
+)
+MAX_WAITING = int(os.environ.get("OPENPRESCRIBING_RXDB_ADMISSION_MAX_WAITING", "16"))
+
+ADMISSION_CONTROLLER = None
+
+
+class Overloaded(Exception):
+    pass
+
+
+def admit(cost, deadline=None):
+    """Return a context manager which blocks until a scan of the given cost can be
+    admitted, raising `Overloaded` if that isn't going to happen soon enough.
+
+    If `deadline` (a `time.monotonic()` value) is supplied then we never wait beyond
+    it."""
+
+    if not is_enabled():
+        return contextlib.nullcontext()
+    return _get_admission_controller().admit(cost, deadline=deadline)
+
+
+def is_enabled():
+    return ADMISSION_CAPACITY > 0
+
+
+def _get_admission_controller():
+    global ADMISSION_CONTROLLER
+    if ADMISSION_CONTROLLER is None:
+        ADMISSION_CONTROLLER = AdmissionController(
+            capacity=ADMISSION_CAPACITY,
+            max_waiting=MAX_WAITING,
+            timeout=ADMISSION_TIMEOUT,
+        )
+    return ADMISSION_CONTROLLER
+
+
+class AdmissionController:
+    """
+    A semaphore where each holder takes a number of units (its cost) rather than just
+    one
+
+    Waiters aren't served in order: whenever capacity is freed, any waiter whose cost
+    now fits is admitted. This means a cheap scan never waits behind an expensive one
+    for which there isn't yet room. Expensive scans can't be starved indefinitely,
+    because they give up after the timeout.
+    """
+
+    def __init__(self, capacity, max_waiting, timeout):
+        self.capacity = capacity
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.in_use = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def admit(self, cost, deadline=None):
+        # A scan costing more than the total capacity would otherwise never run, so we
+        # treat it as needing everything
+        cost = min(max(cost, 1), self.capacity)
+        timeout = self.timeout
+        if deadline is not None:
+            timeout = max(min(timeout, deadline - time.monotonic()), 0)
+        with self.condition:
+            if self.in_use + cost > self.capacity:
+                if self.waiting >= self.max_waiting:
+                    raise Overloaded("Too many queries waiting to run")
+                self.waiting += 1
+                try:
+                    admitted = self.condition.wait_for(
+                        lambda: self.in_use + cost <= self.capacity,
+                        timeout=timeout,
+                    )
+                finally:
+                    self.waiting -= 1
+                if not admitted:
+                    raise Overloaded("Timed out waiting for query to be admitted")
+            self.in_use += cost
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_use -= cost
+                self.condition.notify_all()
@@ -1,14 +1,23 @@
 import contextlib
+import dataclasses
+import heapq
+import itertools
+import os
 import pathlib
 import sys
+import threading
+import time
 
 import duckdb
 from django.conf import settings
 
 from openprescribing.data.utils.duckdb_utils import escape
 
+from .file_watcher import FileWatcher
+from .profiling import get_profiler
 
-__all__ = ["get_cursor", "get_cache_key"]
+
+__all__ = ["get_cursor", "get_cache_key", "QueryTimeout"]
 
 # Force DuckDB to look for extension modules in the virtualenv rather than the user's
 # home directory (!)
@@ -16,11 +25,51 @@ DUCKDB_EXTENSION_DIR = f"{sys.prefix}/duckdb"
 
 CREATE_VIEWS_PATH = pathlib.Path(__file__).parent / "create_views.sql"
 
+# Views (defined in `create_views.sql`) which are expensive to evaluate and so which we
+# evaluate once per connection and store as in-memory tables. The `medications` view
+# has two correlated subqueries per row, all run against SQLite, and it gets queried on
+# every BNF query involving dm+d fields.
+MATERIALISED_VIEWS = ("medications",)
+
+# Tables in the SQLite database which we query through DuckDB. DuckDB's SQLite scanner
+# reads these a row at a time, and can't make use of any of DuckDB's columnar
+# optimisations. We can instead copy these tables into the in-memory database when we
+# connect. This costs memory and makes connecting slower, and so it's optional.
+SNAPSHOT_SQLITE_TABLES = (
+    "amp",
+    "bnf_code",
+    "dmd_bnf_map",
+    "ing",
+    "ont",
+    "ont_form_route",
+    "vmp",
+    "vpi",
+    "vtm",
+)
+# Rather than check the modification times of the database files every time we need a
+# cursor, we can watch for changes in a background thread (see `FileWatcher`) and
+# reconnect there, off the request path. The poll interval bounds how long it takes to
+# notice changes where inotify can't tell us about them.
+WATCH_FILES = os.environ.get("OPENPRESCRIBING_RXDB_WATCH_FILES", "True") == "True"
+WATCH_POLL_INTERVAL = float(
+    os.environ.get("OPENPRESCRIBING_RXDB_WATCH_POLL_INTERVAL", "5")
+)
+
+SNAPSHOT_SQLITE = (
+    os.environ.get("OPENPRESCRIBING_RXDB_SNAPSHOT_SQLITE", "False") == "True"
+)
+
 CONNECTION_MANAGER = None
 
+WATCHDOG = None
+
 
-def get_cursor():
-    return _get_connection_manager().get_cursor()
+class QueryTimeout(Exception):
+    pass
+
+
+def get_cursor(deadline=None, label=None):
+    return _get_connection_manager().get_cursor(deadline=deadline, label=label)
 
 
 def get_cache_key():  # pragma: no cover
@@ -36,19 +85,59 @@ def _get_connection_manager():
             duckdb_file=settings.PRESCRIBING_DATABASE,
             sqlite_file=settings.SQLITE_DATABASE,
             init_sql=CREATE_VIEWS_PATH.read_text(),
+            materialised_views=MATERIALISED_VIEWS,
+            snapshot_tables=SNAPSHOT_SQLITE_TABLES if SNAPSHOT_SQLITE else (),
+            watch_poll_interval=WATCH_POLL_INTERVAL if WATCH_FILES else None,
+            profiler=get_profiler(),
         )
     return CONNECTION_MANAGER
 
 
 class ConnectionManager:
-    def __init__(self, duckdb_file, sqlite_file, init_sql=""):
+    def __init__(
+        self,
+        duckdb_file,
+        sqlite_file,
+        init_sql="",
+        materialised_views=(),
+        snapshot_tables=(),
+        watch_poll_interval=None,
+        profiler=None,
+    ):
+        """
+        If `watch_poll_interval` is supplied then we watch for changes to the database
+        files in a background thread, checking at least this often, rather than
+        checking whenever we need a cursor.
+
+        If `profiler` is supplied then it profiles a sample of queries run with
+        `CursorCacheKeyWrapper.profiled()` (see `Profiler`).
+        """
         self.duckdb_file = duckdb_file
         self.sqlite_file = sqlite_file
         self.init_sql = init_sql
-        self.duckdb_last_modified = None
-        self.reconnect_if_duckdb_modified()
-
-    def reconnect_if_duckdb_modified(self):
+        self.materialised_views = materialised_views
+        self.snapshot_tables = snapshot_tables
+        self.profiler = profiler
+        self.generation = None
+        self.reconnect_lock = threading.Lock()
+        self.reconnect_if_modified()
+        if watch_poll_interval is not None:
+            self.watcher = FileWatcher(
+                [duckdb_file, sqlite_file],
+                callback=self.reconnect_if_modified,
+                poll_interval=watch_poll_interval,
+            ).start()
+        else:
+            self.watcher = None
+
+    # The details of the current connection are held in a single `Generation` object
+    # which is replaced whenever we reconnect, so that the watcher thread can't change
+    # them while we're reading them
+    @property
+    def last_modified(self):
+        return self.generation.last_modified
+
+    def reconnect_if_modified(self):
         # Because DuckDB doesn't allow for simultaneously connected writers and readers
         # we can't update database files in-place while the site is running. Instead, we
         # have to treat them as effectively immutable and perform updates by creating a
@@ -58,13 +147,30 @@ class ConnectionManager:
         # DuckDB file and, when that changes, we create a new connection pointing to the
         # new file.
         #
+        # The SQLite file can be updated in place, and queries against it see its
+        # current contents. But any views we've materialised (see below) hold a copy of
+        # SQLite data (as do any SQLite tables we've snapshotted), so we also need a new
+        # connection whenever the SQLite file changes.
+        #
         # We don't explicitly close the old connection as it's possbile another thread
         # is still using it at the point we open the new file. We just let it get
         # garbage-collected naturally once all references to it disappear.
-        duckdb_last_modified = self.duckdb_file.stat().st_mtime
-        if self.duckdb_last_modified == duckdb_last_modified:
-            return
+        last_modified = self.get_last_modified()
+        # Only one thread needs to do the work of reconnecting
+        with self.reconnect_lock:
+            if (
+                self.generation is None
+                or self.generation.last_modified != last_modified
+            ):
+                self.generation = self.connect(last_modified)
+
+    def get_last_modified(self):
+        return (
+            self.duckdb_file.stat().st_mtime,
+            self.sqlite_file.stat().st_mtime,
+        )
 
+    def connect(self, last_modified):
         # We make an in-memory connection and then attach our database files into it as
         # read-only
         connection = duckdb.connect(
@@ -85,9 +191,21 @@ class ConnectionManager:
         # possibility of issuing SQL queries which modify any external state.
         connection.execute("SET enable_external_access = false")
 
-        # Run the initialisation SQL to create any views we might need
         self.set_search_path(connection)
+
+        # Copy any SQLite tables we want to snapshot into the in-memory database, where
+        # they'll be found ahead of the originals on the search path. We do this before
+        # running the initialisation SQL so that materialised views are built from the
+        # snapshots.
+        for table_name in self.snapshot_tables:
+            connection.execute(
+                f"CREATE TABLE memory.main.{table_name} AS FROM sqlite_db.{table_name}"
+            )
+
+        # Run the initialisation SQL to create any views we might need
         connection.execute(self.init_sql)
+        for view_name in self.materialised_views:
+            self.materialise_view(connection, view_name)
 
         # Ideally we'd also switch the mode of the in-memory database to read-only
         # using:
@@ -101,8 +219,23 @@ class ConnectionManager:
         # feature when we get there. See the discussion at:
         # https://github.com/duckdb/duckdb/discussions/19341
 
-        self.duckdb_last_modified = duckdb_last_modified
-        self.connection = connection
+        return Generation(
+            last_modified=last_modified,
+            connection=connection,
+        )
+
+    @staticmethod
+    def materialise_view(connection, view_name):
+        # We replace the view with a table of the same name in the in-memory database,
+        # so that queries don't need to know whether they're reading from one or the
+        # other
+        connection.execute(
+            f"""
+            CREATE TABLE memory.main.{view_name}__materialised AS FROM {view_name};
+            DROP VIEW memory.main.{view_name};
+            ALTER TABLE memory.main.{view_name}__materialised RENAME TO {view_name};
+            """
+        )
 
     @staticmethod
     def set_search_path(cursor):
@@ -118,31 +251,52 @@ class ConnectionManager:
         #
         # There's a harmless edge case here in that the contents of the SQLite database
         # could change between the time this is called and the time a query is executed.
-        # (The same is not true for DuckDB where each database file is immutable.) If
-        # this happens then we could end up caching newer data under an old cache key.
+        # (The same is not true for DuckDB where each database file is immutable, or for
+        # materialised views which are fixed for the life of the connection.) If this
+        # happens then we could end up caching newer data under an old cache key.
         # However subsequent queries will use the newer cache key and so the effect is
         # just a small amount of wasted work in storing a cached value that will never
         # be used. And given how short-lived the cursors are and how infrequently the
         # data changes I expect these to be extremely rare in any case.
-        self.reconnect_if_duckdb_modified()
-        return (
-            self.duckdb_last_modified,
-            self.sqlite_file.stat().st_mtime,
-        )
-
-    @contextlib.contextmanager
-    def get_cursor(self):
-        cache_key = self.get_cache_key()
-        cursor = self.connection.cursor()
+        #
+        # If we're watching for changes in the background then there's nothing to check
+        # here, and we just return the key for the current connection.
+        if self.watcher is None:
+            self.reconnect_if_modified()
+        return self.last_modified
+
+    def get_cursor(self, deadline=None, label=None):
+        """
+        Return a context manager giving a cursor over the current data
+
+        If `deadline` (a `time.monotonic()` value) is supplied then any query still
+        running on the cursor at that time is interrupted, and a `QueryTimeout` is
+        raised from the `with` block.
+
+        The `label` identifies what the cursor's queries are for in any profiles taken
+        of them.
+        """
+        if self.watcher is None:
+            self.reconnect_if_modified()
+        generation = self.generation
+        cursor = generation.connection.cursor()
         # Search path needs to be set per-cursor for some reason; it isn't persistent on
         # the connection.
         self.set_search_path(cursor)
         # Wrap the cursor in a class that allows it to function as a cache key
-        wrapped = CursorCacheKeyWrapper(cursor, cache_key=cache_key)
-        try:
-            yield wrapped
-        finally:
-            wrapped.close()
+        return CursorCacheKeyWrapper(
+            cursor,
+            cache_key=generation.last_modified,
+            deadline=deadline,
+            profiler=self.profiler,
+            label=label,
+        )
+
+
+@dataclasses.dataclass(frozen=True)
+class Generation:
+    last_modified: tuple
+    connection: duckdb.DuckDBPyConnection
 
 
 class CursorCacheKeyWrapper:
@@ -164,11 +318,38 @@ class CursorCacheKeyWrapper:
 
     This will naturally do the right thing, so long as we ensure that wrapped cursors
     compare equal if and only if their cache keys are equal.
+
+    It also acts as a context manager which closes the cursor on exit, and enforces the
+    cursor's deadline (if it has one) using the `Watchdog`.
     """
 
-    def __init__(self, cursor, cache_key):
+    def __init__(
+        self,
+        cursor,
+        cache_key,
+        deadline=None,
+        profiler=None,
+        label=None,
+    ):
         self.cursor = cursor
         self.cache_key = cache_key
+        self.deadline = deadline
+        self.profiler = profiler
+        self.label = label
+        self.interrupted = False
+        if deadline is not None:
+            _get_watchdog().watch(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        # An interrupted query fails with an `InterruptException` if it's interrupted
+        # while executing, but if it's interrupted while we're streaming its results
+        # then the error comes back via Arrow as an `OSError`
+        if self.interrupted and isinstance(exc_value, (duckdb.Error, OSError)):
+            raise QueryTimeout("Query exceeded its deadline") from exc_value
 
     def __eq__(self, other):
         return isinstance(other, self.__class__) and self.cache_key == other.cache_key
@@ -177,6 +358,8 @@ class CursorCacheKeyWrapper:
         return hash(self.cache_key)
 
     def close(self):
+        if self.deadline is not None:
+            _get_watchdog().unwatch(self)
         self.cursor.close()
         # We expect the wrapper object to hang around for some time as it's designed to
         # get stored as part of the cache. However we very much don't want the
@@ -185,8 +368,114 @@ class CursorCacheKeyWrapper:
         # to it immediately after closing.
         self.cursor = None
 
+    def interrupt(self):
+        self.interrupted = True
+        self.cursor.interrupt()
+
+    def check_deadline(self):
+        """Raise `QueryTimeout` if the cursor's deadline has passed."""
+
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise QueryTimeout("Query exceeded its deadline")
+
+    def duplicate(self):
+        """
+        Return a new cursor over the same data, with the same cache key, deadline and
+        profiling, for use in a different thread (DuckDB cursors must not be used by
+        more than one thread at once)
+        """
+        # The search path isn't inherited by new cursors so we copy it across
+        search_path = self.cursor.execute(
+            "SELECT current_setting('search_path')"
+        ).fetchone()[0]
+        cursor = self.cursor.cursor()
+        cursor.execute(f"SET search_path = {escape(search_path)}")
+        return self.__class__(
+            cursor,
+            cache_key=self.cache_key,
+            deadline=self.deadline,
+            profiler=self.profiler,
+            label=self.label,
+        )
+
     def execute(self, *args, **kwargs):
         return self.cursor.execute(*args, **kwargs)
 
     def sql(self, *args, **kwargs):
         return self.cursor.sql(*args, **kwargs)
+
+    def profiled(self):
+        """
+        Return a context manager which, if profiling is enabled and the query is picked
+        for profiling, records a profile of the last query run in the enclosed block
+        """
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.profile(self.cursor, self.label)
+
+
+def _get_watchdog():
+    global WATCHDOG
+    if WATCHDOG is None:
+        WATCHDOG = Watchdog()
+    return WATCHDOG
+
+
+class Watchdog:
+    """
+    Interrupts queries on cursors which are still open when their deadline passes
+
+    A single background thread sleeps until the earliest deadline of the cursors it's
+    watching. Cursors stop being watched when they're closed, so the thread only has
+    anything to do when a query overruns.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        # A heap of (deadline, sequence number, wrapper) tuples. Entries for cursors
+        # which have since been closed are left in place and skipped over when they
+        # reach the top.
+        self.heap = []
+        self.counter = itertools.count()
+        # Cursor wrappers compare equal when their cache keys are equal, so we track
+        # them by identity instead
+        self.watched = {}
+        self.thread = None
+
+    def watch(self, wrapper):
+        with self.condition:
+            self.watched[id(wrapper)] = wrapper
+            heapq.heappush(self.heap, (wrapper.deadline, next(self.counter), wrapper))
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="rxdb-watchdog", daemon=True
+                )
+                self.thread.start()
+            self.condition.notify()
+
+    def unwatch(self, wrapper):
+        # Holding the lock here means we can't interrupt a cursor while it's being
+        # closed
+        with self.condition:
+            self.watched.pop(id(wrapper), None)
+
+    def run(self):
+        with self.condition:
+            while True:
+                self.interrupt_overdue(time.monotonic())
+                if self.heap:
+                    self.condition.wait(timeout=self.heap[0][0] - time.monotonic())
+                else:
+                    self.condition.wait()
+
+    def interrupt_overdue(self, now):
+        while self.heap:
+            deadline, _, wrapper = self.heap[0]
+            if self.watched.get(id(wrapper)) is not wrapper:
+                heapq.heappop(self.heap)
+            elif deadline <= now:
+                heapq.heappop(self.heap)
+                del self.watched[id(wrapper)]
+                wrapper.interrupt()
+            else:
+                break
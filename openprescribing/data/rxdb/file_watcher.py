@@ -0,0 +1,127 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+
+
+__all__ = ["FileWatcher"]
+
+log = logging.getLogger(__name__)
+
+
+# Constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_CLOEXEC = 0o2000000
+
+# We watch the directories containing the files rather than the files themselves,
+# because database files get updated by swapping a new file into place and a watch on
+# the old file would stop telling us anything
+INOTIFY_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+# Each event is a `struct inotify_event` (int wd; uint32 mask, cookie, len) followed by
+# a null-padded name of `len` bytes
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class FileWatcher:
+    """
+    Calls `callback` from a background thread whenever any of `paths` may have changed
+
+    On Linux we use inotify to hear about changes as soon as they happen. We also call
+    `callback` every `poll_interval` seconds regardless, because inotify isn't
+    available everywhere and doesn't see changes made by other machines to files on
+    network filesystems. The callback is expected to check for itself whether anything
+    has actually changed.
+    """
+
+    def __init__(self, paths, callback, poll_interval):
+        self.paths = paths
+        self.callback = callback
+        self.poll_interval = poll_interval
+        self.filenames = {os.fsencode(path.name) for path in paths}
+        self.inotify_fd = get_inotify_fd({path.parent for path in paths})
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, name="rxdb-file-watcher", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop the watcher thread (which may take up to `poll_interval` seconds)."""
+
+        self.stopped.set()
+
+    def run(self):
+        while True:
+            self.wait_for_change()
+            if self.stopped.is_set():
+                return
+            # An exception here would kill the thread and we'd stop noticing changes
+            # altogether, so we keep going and try again next time
+            try:
+                self.callback()
+            except Exception:
+                log.exception("Error handling change to watched files")
+
+    def wait_for_change(self):
+        """Block until one of our files may have changed, or `poll_interval` passes."""
+
+        if self.inotify_fd is None:
+            self.stopped.wait(self.poll_interval)
+            return
+        readable, _, _ = select.select([self.inotify_fd], [], [], self.poll_interval)
+        if readable:
+            # Wait until we've seen an event for one of our files, but don't wait longer
+            # than the poll interval as we would if we'd seen nothing at all
+            while not self.filenames & parse_inotify_names(
+                os.read(self.inotify_fd, 64 * 1024)
+            ):
+                readable, _, _ = select.select(
+                    [self.inotify_fd], [], [], self.poll_interval
+                )
+                if not readable:
+                    return
+
+
+def get_inotify_fd(directories):
+    """Return an inotify file descriptor watching `directories`, or None if inotify
+    isn't available."""
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        inotify_init1 = libc.inotify_init1
+        inotify_add_watch = libc.inotify_add_watch
+    except (OSError, AttributeError):  # pragma: no cover
+        return None
+
+    fd = inotify_init1(IN_CLOEXEC)
+    if fd < 0:  # pragma: no cover
+        return None
+    for directory in directories:
+        if inotify_add_watch(fd, os.fsencode(directory), INOTIFY_MASK) < 0:
+            os.close(fd)
+            return None
+    return fd
+
+
+def parse_inotify_names(data):
+    """Return the set of filenames mentioned by the inotify events in `data`."""
+
+    names = set()
+    offset = 0
+    while offset < len(data):
+        _, _, _, name_length = INOTIFY_EVENT.unpack_from(data, offset)
+        offset += INOTIFY_EVENT.size
+        names.add(data[offset : offset + name_length].rstrip(b"\0"))
+        offset += name_length
+    return names
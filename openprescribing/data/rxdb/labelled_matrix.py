@@ -1,11 +1,13 @@
 import dataclasses
-import functools
 import reprlib
 from collections.abc import Hashable
 
 import numpy as np
 import scipy.sparse
 
+from openprescribing.data.utils import timing
+from openprescribing.data.utils.cache_metrics import metered_cache
+
 
 type Label = Hashable | None
 LabelGroup = tuple[Label, ...] | frozenset[Label, ...]
@@ -96,8 +98,12 @@ class LabelledMatrix:
         Finally, we require the mapping to be an immutable type because we want to use
         caching and we can't use mutable values directly as cache keys.
         """
-        row_grouper, new_row_labels = create_row_grouper(self.row_labels, row_label_map)
-        grouped_values = row_grouper(self.values)
+        with timing.span("group_rows") as counts:
+            row_grouper, new_row_labels = create_row_grouper(
+                self.row_labels, row_label_map
+            )
+            grouped_values = row_grouper(self.values)
+            counts["rows"] = len(new_row_labels)
         return self.__class__(grouped_values, new_row_labels, self.col_labels)
 
     def get_row(self, row_label):
@@ -111,7 +117,8 @@ class LabelledMatrix:
 
     def get_centiles(self):
         centiles = (10, 20, 30, 40, 50, 60, 70, 80, 90)
-        values = np.nanpercentile(self.values, centiles, axis=0)
+        with timing.span("centiles"):
+            values = np.nanpercentile(self.values, centiles, axis=0)
         return LabelledMatrix(values, centiles, self.col_labels)
 
     def drop_zero_rows(self):
@@ -128,7 +135,7 @@ class LabelledMatrix:
 # These "row groupers" are pure functions of their inputs, are not entirely trivial to
 # construct, and are expected to be used repeatedly, so it makes sense to cache them
 # rather than constantly rebuild them.
-@functools.cache
+@metered_cache()
 def create_row_grouper(input_labels, label_map):
     """
     Construct a function which efficiently sums together groups of rows in a matrix
@@ -0,0 +1,116 @@
+import contextlib
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from pathlib import Path
+
+
+__all__ = ["Profiler", "get_profiler"]
+
+log = logging.getLogger(__name__)
+
+
+# Profiling is disabled unless a directory to write profiles to is configured
+PROFILE_DIR = os.environ.get("OPENPRESCRIBING_RXDB_PROFILE_DIR", "")
+# The fraction of queries to profile regardless of how long they take
+PROFILE_SAMPLE_RATE = float(
+    os.environ.get("OPENPRESCRIBING_RXDB_PROFILE_SAMPLE_RATE", "0")
+)
+# If set, we also profile any query taking at least this long. Since we can't know in
+# advance which queries these will be, this means collecting profiling information for
+# every query, which has a small cost.
+PROFILE_THRESHOLD_SECONDS = os.environ.get(
+    "OPENPRESCRIBING_RXDB_PROFILE_THRESHOLD_SECONDS", ""
+)
+# Once there are more than this many profiles, we delete the oldest
+PROFILE_MAX_FILES = int(
+    os.environ.get("OPENPRESCRIBING_RXDB_PROFILE_MAX_FILES", "1000")
+)
+
+
+def get_profiler():
+    """Return a `Profiler` configured from the environment, or None if profiling is
+    disabled."""
+
+    if not PROFILE_DIR:
+        return None
+    if PROFILE_THRESHOLD_SECONDS:
+        threshold = float(PROFILE_THRESHOLD_SECONDS)
+    else:
+        threshold = None
+    return Profiler(
+        PROFILE_DIR,
+        sample_rate=PROFILE_SAMPLE_RATE,
+        threshold=threshold,
+        max_files=PROFILE_MAX_FILES,
+    )
+
+
+class Profiler:
+    """
+    Writes DuckDB's JSON profiling information for a sample of queries to a directory
+
+    A query is profiled if it's picked at random (with probability `sample_rate`) or if
+    it takes at least `threshold` seconds. Each profile is written to its own file,
+    along with the label of the cursor that ran it (the hash of the analysis it was run
+    for, see `Analysis.get_hash()`), and the directory is kept to at most `max_files`
+    files. The `summarise_rxdb_profiles` management command reports on the results.
+    """
+
+    def __init__(self, directory, sample_rate=0, threshold=None, max_files=1000):
+        self.directory = Path(directory)
+        self.sample_rate = sample_rate
+        self.threshold = threshold
+        self.max_files = max_files
+
+    @contextlib.contextmanager
+    def profile(self, cursor, label=None):
+        """Profile the last query run on `cursor` in the enclosed block, if it's picked
+        for sampling or is slow enough."""
+
+        sampled = random.random() < self.sample_rate
+        if not sampled and self.threshold is None:
+            yield
+            return
+
+        # Profiling settings are per-cursor, and "no_output" stops DuckDB printing each
+        # profile to stdout so that we can fetch it ourselves
+        cursor.execute("SET enable_profiling = 'no_output'")
+        try:
+            start = time.perf_counter()
+            yield
+            duration = time.perf_counter() - start
+            if sampled or duration >= self.threshold:
+                self.write(cursor.get_profiling_information(), label, duration, sampled)
+        finally:
+            cursor.execute("RESET enable_profiling")
+
+    def write(self, profile_json, label, duration, sampled):
+        # Errors here shouldn't stop us returning the results of the query
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            # Filenames sort in the order the profiles were written
+            timestamp = time.strftime("%Y%m%dT%H%M%S")
+            name = f"{timestamp}-{label or 'unlabelled'}-{uuid.uuid4().hex[:8]}.json"
+            record = {
+                "label": label,
+                "duration": duration,
+                "sampled": sampled,
+                "profile": json.loads(profile_json),
+            }
+            # Write to a temporary file and rename so that readers never see a partial
+            # profile
+            tmp_path = self.directory / f".{name}.tmp"
+            tmp_path.write_text(json.dumps(record))
+            tmp_path.replace(self.directory / name)
+            self.rotate()
+        except OSError:
+            log.exception("Error writing query profile")
+
+    def rotate(self):
+        paths = sorted(self.directory.glob("*.json"))
+        for path in paths[: max(len(paths) - self.max_files, 0)]:
+            path.unlink(missing_ok=True)
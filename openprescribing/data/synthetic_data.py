@@ -0,0 +1,222 @@
+"""
+Generate synthetic prescribing and list size data with the shape of the real thing
+
+The files written here look like those produced by the `prescribing` and `list_size`
+fetchers (same filenames, same columns, all values as strings) and so can be ingested
+in exactly the same way. This gives us a repeatable dataset, of whatever size we choose,
+for measuring performance (see the `benchmark_rxdb` command).
+
+The defaults approximate the production data: ~15,000 practices, ~140 months,
+~40,000 presentations, and enough rows per month to give a database of similar size.
+The data is skewed in the same ways as the real data, which matters for performance:
+
+ * a few presentations account for most prescribing, and most presentations are
+   prescribed rarely (popularity follows a Zipf distribution);
+
+ * practices vary in size, and bigger practices prescribe more presentations, more
+   items and to more patients (sizes follow a log-normal distribution);
+
+ * some practices open or close during the period covered, and so only have data for
+   some months.
+"""
+
+import datetime
+import logging
+import string
+
+import numpy as np
+import pyarrow
+import pyarrow.compute
+import pyarrow.parquet
+
+from openprescribing.data.utils.filename_utils import get_temp_filename_for
+
+
+__all__ = ["generate", "get_synthetic_bnf_codes", "get_synthetic_practice_codes"]
+
+log = logging.getLogger(__name__)
+
+
+PRACTICE_COUNT = 15_000
+MONTH_COUNT = 140
+PRESENTATION_COUNT = 40_000
+ROWS_PER_MONTH = 17_000_000
+
+# Exponent of the Zipf distribution of presentation popularity
+PRESENTATION_SKEW = 1.1
+# Sigma of the log-normal distribution of practice sizes
+PRACTICE_SIZE_SIGMA = 0.6
+# Fraction of practices which open or close part way through the period
+PRACTICE_TURNOVER = 0.2
+MEAN_LIST_SIZE = 9_000
+PACK_SIZES = np.array([1, 7, 14, 28, 30, 56, 60, 84, 100, 200])
+
+
+def generate(
+    output_dir,
+    bnf_codes,
+    practice_codes,
+    month_count=MONTH_COUNT,
+    rows_per_month=ROWS_PER_MONTH,
+    end_date=None,
+    seed=0,
+):
+    """
+    Write a month of synthetic prescribing and list size data for each of the
+    `month_count` months up to `end_date` (default: last month) to
+    `output_dir/prescribing/` and `output_dir/list_size/`.
+
+    The same arguments (including `seed`) always produce the same data.
+    """
+    rng = np.random.default_rng(seed)
+    if end_date is None:
+        end_date = datetime.date.today().replace(day=1) - datetime.timedelta(days=1)
+    dates = get_month_starts(end_date, month_count)
+
+    # Fixed properties of each presentation
+    presentation_count = len(bnf_codes)
+    bnf_codes = pyarrow.array(bnf_codes)
+    snomed_codes = pyarrow.array(
+        (np.arange(presentation_count) + 100_000_000).astype(str)
+    )
+    # Popularity ranks are shuffled so that popular presentations are spread across the
+    # BNF, rather than all being in chapter 1
+    ranks = rng.permutation(presentation_count) + 1
+    popularity = ranks.astype(np.float64) ** -PRESENTATION_SKEW
+    popularity /= popularity.sum()
+    pack_sizes = rng.choice(PACK_SIZES, size=presentation_count)
+    unit_costs = rng.lognormal(mean=-2.5, sigma=1.5, size=presentation_count)
+
+    # Fixed properties of each practice
+    practice_count = len(practice_codes)
+    practice_codes = pyarrow.array(practice_codes)
+    sizes = rng.lognormal(mean=0, sigma=PRACTICE_SIZE_SIGMA, size=practice_count)
+    sizes /= sizes.mean()
+    first_month = np.zeros(practice_count, dtype=np.int64)
+    last_month = np.full(practice_count, month_count - 1)
+    turnover = rng.random(practice_count) < PRACTICE_TURNOVER
+    opens = rng.random(practice_count) < 0.5
+    first_month[turnover & opens] = rng.integers(
+        1, max(month_count, 2), size=(turnover & opens).sum()
+    )
+    last_month[turnover & ~opens] = rng.integers(
+        0, month_count, size=(turnover & ~opens).sum()
+    )
+
+    prescribing_dir = output_dir / "prescribing"
+    list_size_dir = output_dir / "list_size"
+    prescribing_dir.mkdir(parents=True, exist_ok=True)
+    list_size_dir.mkdir(parents=True, exist_ok=True)
+
+    for month, date in enumerate(dates):
+        log.info(f"Generating data for {date}")
+        active = np.flatnonzero((first_month <= month) & (month <= last_month))
+
+        # Share the month's rows between the practices according to their size, and
+        # pick the presentations each practice prescribes according to their popularity
+        rows = np.maximum(
+            np.round(rows_per_month * sizes[active] / sizes[active].sum()), 1
+        ).astype(np.int64)
+        practice_ix = np.repeat(active, rows)
+        presentation_ix = rng.choice(
+            presentation_count, size=len(practice_ix), p=popularity
+        )
+        # A practice prescribes each presentation at most once a month (the underlying
+        # data is already aggregated), so we drop any duplicates. This is much faster
+        # than `np.unique` for arrays this size.
+        keys = practice_ix * presentation_count + presentation_ix
+        keys.sort()
+        keys = keys[np.concatenate([[True], keys[1:] != keys[:-1]])]
+        practice_ix = keys // presentation_count
+        presentation_ix = keys % presentation_count
+
+        items = rng.poisson(lam=2 * sizes[practice_ix]) + 1
+        quantity_value = pack_sizes[presentation_ix]
+        total_quantity = items * quantity_value
+        nic = np.round(total_quantity * unit_costs[presentation_ix], 2)
+        actual_cost = np.round(nic * 0.93, 2)
+
+        write_parquet(
+            prescribing_dir / f"prescribing_{date}_v1_synthetic.parquet",
+            {
+                "BNF_CODE": bnf_codes.take(presentation_ix),
+                "SNOMED_CODE": snomed_codes.take(presentation_ix),
+                "PRACTICE_CODE": practice_codes.take(practice_ix),
+                "QUANTITY": quantity_value,
+                "ITEMS": items,
+                "TOTAL_QUANTITY": total_quantity,
+                "NIC": nic,
+                "ACTUAL_COST": actual_cost,
+            },
+        )
+
+        list_sizes = np.round(MEAN_LIST_SIZE * sizes[active]).astype(np.int64)
+        write_parquet(
+            list_size_dir / f"list_size_{date}_v2_synthetic.parquet",
+            {
+                "ORG_TYPE": pyarrow.array(["GP"] * len(active)),
+                "ORG_CODE": practice_codes.take(active),
+                "SEX": pyarrow.array(["ALL"] * len(active)),
+                "AGE_GROUP_5": pyarrow.array(["ALL"] * len(active)),
+                "NUMBER_OF_PATIENTS": list_sizes,
+            },
+        )
+
+
+def write_parquet(path, columns):
+    # The fetchers convert CSV files to Parquet without any type inference, so every
+    # column is a string
+    table = pyarrow.table(
+        {
+            name: pyarrow.compute.cast(pyarrow.array(values), pyarrow.string())
+            for name, values in columns.items()
+        }
+    )
+    tmp_path = get_temp_filename_for(path)
+    pyarrow.parquet.write_table(table, tmp_path)
+    tmp_path.replace(path)
+
+
+def get_month_starts(end_date, month_count):
+    """Return the first days of the `month_count` months up to and including the month
+    of `end_date`, oldest first."""
+
+    month_index = end_date.year * 12 + end_date.month - 1
+    return [
+        datetime.date(i // 12, i % 12 + 1, 1)
+        for i in range(month_index - month_count + 1, month_index + 1)
+    ]
+
+
+def get_synthetic_bnf_codes(count):
+    """Return `count` sorted presentation-level BNF codes, structured like real ones.
+
+    Chemicals are spread evenly over 15 chapters, each of 10 sections of 5 paragraphs,
+    and each chemical has three products (the first generic) in three strengths.
+    """
+    paragraph_count = 15 * 10 * 5
+    codes = []
+    for chemical in range(-(-count // 9)):
+        chemical_ix, paragraph = divmod(chemical, paragraph_count)
+        chapter, rest = divmod(paragraph, 50)
+        section, paragraph_ix = divmod(rest, 5)
+        prefix = (
+            f"{chapter + 1:02}{section + 1:02}{paragraph_ix + 1:02}0"
+            f"{to_base36(chemical_ix)}"
+        )
+        for product in ["AA", "BA", "BB"]:
+            for strength in ["AA", "AB", "AC"]:
+                codes.append(f"{prefix}{product}{strength}{strength}")
+    return sorted(codes)[:count]
+
+
+def get_synthetic_practice_codes(count):
+    """Return `count` practice codes, in the same format as real ones."""
+
+    letters = string.ascii_uppercase
+    return [f"{letters[i // 100_000 % 26]}{i % 100_000:05}" for i in range(count)]
+
+
+def to_base36(n):
+    digits = string.digits + string.ascii_uppercase
+    return digits[n // 36 % 36] + digits[n % 36]
@@ -0,0 +1,193 @@
+"""
+In-memory caches which keep track of how well they're working
+
+`metered_cache` is a drop-in replacement for `functools.lru_cache` (and, with no
+`maxsize`, for `functools.cache`) which also counts hits, misses and evictions, keeps
+track of how many entries it holds and roughly how much memory they take up, and times
+how long each miss takes to compute.
+
+Every cache registers itself when it's created, and the figures for all of them are
+exported through OpenTelemetry metrics, labelled with the name of the cached function.
+These are no-ops unless a meter provider has been configured, as it is in
+`gunicorn.conf.py`.
+
+Hits and misses are also recorded in the `timing.Timings` for the current request, so
+that the `Server-Timing` header shows how many of the request's lookups were hits (and
+how long was spent computing the misses).
+"""
+
+import dataclasses
+import functools
+import sys
+import threading
+import time
+import types
+from collections import OrderedDict
+
+import numpy as np
+import scipy.sparse
+from opentelemetry import metrics
+from opentelemetry.metrics import Observation
+
+from openprescribing.data.utils import timing
+
+
+__all__ = ["get_cache_stats", "metered_cache"]
+
+
+CACHES = {}
+
+# Separates positional from keyword arguments in cache keys (as `functools.lru_cache`
+# does) so that e.g. f(1, "a", 2) and f(1, a=2) don't share an entry
+KWARGS_MARK = object()
+
+
+@dataclasses.dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    entries: int = 0
+    bytes: int = 0
+
+
+class MeteredCache:
+    def __init__(self, fn, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.stats = CacheStats()
+        functools.update_wrapper(self, fn)
+
+    def __call__(self, *args, **kwargs):
+        key = args if not kwargs else (*args, KWARGS_MARK, *kwargs.items())
+        with self.lock:
+            hit = key in self.entries
+            if hit:
+                self.entries.move_to_end(key)
+                self.stats.hits += 1
+                value = self.entries[key][0]
+            else:
+                self.stats.misses += 1
+        if hit:
+            timing.record("cache", 0, hits=1)
+            return value
+
+        # As with `functools.lru_cache`, we don't hold the lock while computing so two
+        # threads which miss at the same time will both compute the value
+        start = time.perf_counter()
+        value = self.__wrapped__(*args, **kwargs)
+        duration = time.perf_counter() - start
+        COMPUTE_DURATION.record(duration, {"cache.name": self.name})
+        timing.record("cache", duration, misses=1)
+        size = get_size(value)
+
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = value, size
+                self.stats.bytes += size
+                while self.maxsize is not None and len(self.entries) > self.maxsize:
+                    _, (_, evicted_size) = self.entries.popitem(last=False)
+                    self.stats.bytes -= evicted_size
+                    self.stats.evictions += 1
+                self.stats.entries = len(self.entries)
+        return value
+
+    def cache_clear(self):
+        # Hits, misses and evictions are exported as counters and so must never go down
+        with self.lock:
+            self.entries.clear()
+            self.stats.entries = 0
+            self.stats.bytes = 0
+
+
+def metered_cache(maxsize=None, name=None):
+    """Cache a function's results as `functools.lru_cache(maxsize)` would, and register
+    the cache so that its metrics are exported.
+
+    The cache is named after the function unless `name` is given.
+    """
+
+    def decorator(fn):
+        cache = MeteredCache(fn, name or f"{fn.__module__}.{fn.__qualname__}", maxsize)
+        CACHES[cache.name] = cache
+        return cache
+
+    return decorator
+
+
+def get_cache_stats():
+    """Return a dict mapping the name of each cache to a copy of its `CacheStats`."""
+
+    stats = {}
+    for name, cache in list(CACHES.items()):
+        with cache.lock:
+            stats[name] = dataclasses.replace(cache.stats)
+    return stats
+
+
+def get_size(value):
+    """Return the approximate number of bytes of memory used by `value`.
+
+    This counts the contents of the arrays and containers we actually cache, and falls
+    back to `sys.getsizeof` for anything else. Objects shared between several values
+    (e.g. the tuple of practice codes which labels many matrices) are counted in each.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if scipy.sparse.issparse(value):
+        return sum(v.nbytes for v in vars(value).values() if isinstance(v, np.ndarray))
+    if isinstance(value, types.MethodType):
+        # e.g. the row groupers returned by `create_row_grouper`
+        return get_size(value.__self__)
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return sum(
+            get_size(getattr(value, field.name)) for field in dataclasses.fields(value)
+        )
+    if isinstance(value, (tuple, list, frozenset, set)):
+        return sys.getsizeof(value) + sum(get_size(item) for item in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(
+            get_size(k) + get_size(v) for k, v in value.items()
+        )
+    return sys.getsizeof(value)
+
+
+def observe(attribute):
+    def callback(options):
+        return [
+            Observation(getattr(stats, attribute), {"cache.name": name})
+            for name, stats in get_cache_stats().items()
+        ]
+
+    return callback
+
+
+meter = metrics.get_meter(__name__)
+
+meter.create_observable_counter(
+    "cache.hits", callbacks=[observe("hits")], description="Cache hits"
+)
+meter.create_observable_counter(
+    "cache.misses", callbacks=[observe("misses")], description="Cache misses"
+)
+meter.create_observable_counter(
+    "cache.evictions",
+    callbacks=[observe("evictions")],
+    description="Entries evicted to make room for new ones",
+)
+meter.create_observable_gauge(
+    "cache.entries", callbacks=[observe("entries")], description="Entries in cache"
+)
+meter.create_observable_gauge(
+    "cache.bytes",
+    callbacks=[observe("bytes")],
+    unit="By",
+    description="Approximate memory used by cached values",
+)
+COMPUTE_DURATION = meter.create_histogram(
+    "cache.compute.duration",
+    unit="s",
+    description="Time taken to compute values on cache misses",
+)
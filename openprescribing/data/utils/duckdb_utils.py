@@ -1,4 +1,5 @@
 import itertools
+import re
 from pathlib import Path
 
 
@@ -10,6 +11,20 @@ INTEGER_TYPES = UNSIGNED_INTEGER_TYPES | SIGNED_INTEGER_TYPES
 FLOAT_TYPES = {"float", "double"}
 NUMERIC_TYPES = FLOAT_TYPES | INTEGER_TYPES
 
+# Units accepted by DuckDB for memory sizes, see:
+# https://duckdb.org/docs/stable/configuration/overview
+MEMORY_UNITS = {
+    "b": 1,
+    "kb": 1000,
+    "mb": 1000**2,
+    "gb": 1000**3,
+    "tb": 1000**4,
+    "kib": 1024,
+    "mib": 1024**2,
+    "gib": 1024**3,
+    "tib": 1024**4,
+}
+
 
 def escape(s):
     # DuckDB doesn't accept parameter placeholders for filenames in queries so we have
@@ -17,6 +32,15 @@ def escape(s):
     return "'" + str(s).replace("'", "''") + "'"
 
 
+def parse_memory_size(size):
+    """Return the number of bytes in a memory size given as DuckDB accepts them (e.g.
+    in the `memory_limit` setting), such as "8GB" or "512 MiB"."""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([a-z]+)\s*", size.lower())
+    if not match or match.group(2) not in MEMORY_UNITS:
+        raise ValueError(f"Invalid memory size: {size!r}")
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2)])
+
+
 class ProfilingConnection:
     """
     This class wraps an instance of `DuckDBPyConnection` and writes profiling
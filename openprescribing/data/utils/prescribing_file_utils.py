@@ -0,0 +1,107 @@
+import duckdb
+from django.conf import settings
+
+from openprescribing.data.utils.duckdb_utils import escape
+from openprescribing.data.utils.filename_utils import get_temp_filename_for
+
+
+# Rows per row group in the sorted copies of the prescribing files (see
+# `write_sorted_file`). Each row group records the range of BNF codes in it, and smaller
+# row groups mean that queries for a range of BNF codes can skip more of the file.
+SORTED_ROW_GROUP_SIZE = 100_000
+
+# Sorted copies are written in the structure which `sql_for_raw_prescribing_files`
+# produces, so if that changes then this must be bumped. Copies are kept in a directory
+# for each version, so copies in an older structure are never read (and are deleted by
+# the fetcher).
+SORTED_FORMAT_VERSION = 1
+
+
+def get_sorted_dir(directory):
+    return directory / "prescribing_sorted"
+
+
+def get_sorted_filename_for(filename):
+    return (
+        get_sorted_dir(filename.parent.parent)
+        / f"v{SORTED_FORMAT_VERSION}"
+        / filename.name
+    )
+
+
+def write_sorted_file(date, filename, sorted_filename):
+    """
+    Write a copy of the prescribing file `filename` for `date`, converted into the
+    structure we ingest and sorted by BNF code
+    """
+    sorted_filename.parent.mkdir(parents=True, exist_ok=True)
+    tmp_filename = get_temp_filename_for(sorted_filename)
+    # Sorting a month of prescribing data needs as much memory as the ingestor has
+    conn = duckdb.connect(
+        config={
+            "memory_limit": settings.DUCKDB_MEMORY_LIMIT,
+            "temp_directory": str(settings.DUCKDB_TMP_DIRECTORY),
+        }
+    )
+    try:
+        conn.sql(
+            f"""
+            COPY (
+                {sql_for_raw_prescribing_files({date: filename})}
+                ORDER BY bnf_code, snomed_code, practice_code
+            )
+            TO {escape(tmp_filename)} (
+                FORMAT 'PARQUET',
+                CODEC 'zstd',
+                ROW_GROUP_SIZE {SORTED_ROW_GROUP_SIZE}
+            )
+            """
+        )
+        tmp_filename.replace(sorted_filename)
+    finally:
+        conn.close()
+        tmp_filename.unlink(missing_ok=True)
+
+
+def sql_for_raw_prescribing_files(prescribing_files_by_date):
+    # Return a query which reads from the supplied files and converts them into a
+    # single, unified consistent structure ready for us to build from
+
+    # We start by creating a query to read from each individual file
+    subqueries = [
+        f"""
+        SELECT
+            -- We know the relevant date for each file so we add it as fixed column
+            {escape(date)}::DATE AS date,
+            -- Map an inconsistently named column to something consistent
+            COLUMNS('(BNF_CODE|BNF_PRESENTATION_CODE)') AS our_bnf_code,
+            *
+        FROM read_parquet({escape(filename)})
+        """
+        for date, filename in prescribing_files_by_date.items()
+    ]
+    # Files from before SNOMED codes were published don't have a column for them, so we
+    # make sure there is one even if we're only reading from those files
+    subqueries.append("SELECT NULL::VARCHAR AS SNOMED_CODE WHERE false")
+    # We combine these all into a single table (columns which are not present in a given
+    # file will just have NULL values)
+    combined = " UNION ALL BY NAME ".join(subqueries)
+
+    # Read from the above union, map the column names to the ones we want to use and
+    # where necessary apply transformations
+    return f"""\
+    SELECT
+        our_bnf_code AS bnf_code,
+        -- Not every file has SNOMED codes so we use zero as a placeholder
+        COALESCE(CAST(SNOMED_CODE AS INT8), 0) AS snomed_code,
+        date AS date,
+        PRACTICE_CODE AS practice_code,
+        QUANTITY AS quantity_value,
+        ITEMS AS items,
+        TOTAL_QUANTITY AS quantity,
+        -- We want prices in pence not pounds so we can use integers later
+        CAST(NIC AS DOUBLE) * 100 AS net_cost,
+        CAST(ACTUAL_COST AS DOUBLE) * 100 AS actual_cost
+    FROM
+        ({combined})
+    """
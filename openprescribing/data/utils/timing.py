@@ -0,0 +1,111 @@
+"""
+Lightweight timing of the expensive steps involved in answering a request
+
+Code wraps each step in a `span()`, which does two things:
+
+ * creates an OpenTelemetry span (which is a no-op unless a tracer provider has been
+   configured, as it is in `gunicorn.conf.py`);
+
+ * records the step's duration, and any counts (rows, batches, bytes, etc) the step
+   supplies, in the `Timings` for the current request, if there is one.
+
+`web.middleware.ServerTimingMiddleware` sets up the `Timings` for each request, and
+reports the totals as attributes of the request's span and, where enabled, in a
+`Server-Timing` header. Where a step happens more than once in a request (e.g. one scan
+each for a numerator and a denominator) the durations and counts are summed.
+"""
+
+import collections
+import contextlib
+import contextvars
+import re
+import threading
+import time
+
+from opentelemetry import trace
+
+
+__all__ = ["Timings", "collect", "record", "span"]
+
+
+tracer = trace.get_tracer(__name__)
+
+current_timings = contextvars.ContextVar("current_timings", default=None)
+
+
+class Timings:
+    def __init__(self):
+        # Steps may run in more than one thread at once (see `get_grouped_sum_ndarray`)
+        self.lock = threading.Lock()
+        self.durations = collections.defaultdict(float)
+        self.counts = collections.defaultdict(lambda: collections.defaultdict(int))
+
+    def add(self, name, duration, **counts):
+        with self.lock:
+            self.durations[name] += duration
+            for key, value in counts.items():
+                self.counts[name][key] += value
+
+    def to_server_timing(self):
+        """Return the value of a `Server-Timing` header reporting these timings."""
+
+        metrics = []
+        for name, duration in self.durations.items():
+            metric = f"{to_token(name)};dur={duration * 1000:.1f}"
+            if self.counts[name]:
+                desc = " ".join(f"{k}={v}" for k, v in self.counts[name].items())
+                metric += f';desc="{desc}"'
+            metrics.append(metric)
+        return ", ".join(metrics)
+
+    def to_attributes(self):
+        """Return these timings as OpenTelemetry span attributes."""
+
+        attributes = {}
+        for name, duration in self.durations.items():
+            attributes[f"timing.{name}.ms"] = duration * 1000
+            for key, value in self.counts[name].items():
+                attributes[f"timing.{name}.{key}"] = value
+        return attributes
+
+
+@contextlib.contextmanager
+def collect():
+    """Collect the timings of all the spans in the enclosed block (and any threads it
+    starts which copy its context) and yield the resulting `Timings`."""
+
+    timings = Timings()
+    token = current_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        current_timings.reset(token)
+
+
+@contextlib.contextmanager
+def span(name):
+    """Time the enclosed block, recording it as `name`.
+
+    Yields a dict into which the block can put any counts it wants to record.
+    """
+    counts = {}
+    start = time.perf_counter()
+    with tracer.start_as_current_span(name) as otel_span:
+        try:
+            yield counts
+        finally:
+            otel_span.set_attributes(counts)
+            record(name, time.perf_counter() - start, **counts)
+
+
+def record(name, duration, **counts):
+    """Record a duration (in seconds) which has been timed some other way."""
+
+    timings = current_timings.get()
+    if timings is not None:
+        timings.add(name, duration, **counts)
+
+
+def to_token(name):
+    # Server-Timing metric names must be HTTP tokens
+    return re.sub(r"[^A-Za-z0-9!#$%&'*+.^_`|~-]", "-", name)
@@ -1,8 +1,16 @@
+import functools
 import json
 import math
+import os
+import time
 
 import numpy as np
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
 from django.http import JsonResponse as DjangoJsonResponse
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 
 from openprescribing.data import rxdb
 from openprescribing.data.analysis import Analysis
@@ -11,6 +19,8 @@ from openprescribing.data.queries import (
     get_medication_date_matrix,
     get_org_date_ratio_matrix,
 )
+from openprescribing.data.utils import timing
+from openprescribing.web import jobs
 from openprescribing.web.decorators import add_cache_headers, cache
 
 
@@ -25,6 +35,18 @@ INDEX_DATE = "2017-04-01"
 # stacked area chart.  Any further medications are summed into a single "Other" band.
 MEDICATIONS_TOP_N = 10
 
+# How long queries started by requests can run before we give up on them. Analyses run
+# as jobs (see `submit_analysis_job`) don't hold up a request thread and so we can let
+# them run for longer.
+QUERY_TIMEOUT_SECONDS = float(os.environ.get("OPENPRESCRIBING_QUERY_TIMEOUT", "30"))
+JOB_QUERY_TIMEOUT_SECONDS = float(
+    os.environ.get("OPENPRESCRIBING_JOB_QUERY_TIMEOUT", "300")
+)
+
+# How long clients should wait before resubmitting an analysis when there are too many
+# jobs in progress
+JOB_RETRY_AFTER_SECONDS = 5
+
 PRESENTATIONS_PRESCRIBED_AFTER_INDEX_DATE_SQL = f"""
     SELECT bnf_code FROM presentation WHERE last_prescribed_date > '{INDEX_DATE}'
 """
@@ -74,29 +96,103 @@ def _get_org_records(odm, org):
 def prescribing_all_orgs(request):
     analysis = Analysis.from_dict(json.loads(request.GET["analysis"]))
 
-    with rxdb.get_cursor() as cursor:
+    with rxdb.get_cursor(
+        deadline=_get_deadline(QUERY_TIMEOUT_SECONDS), label=analysis.get_hash()
+    ) as cursor:
         odm = get_org_date_ratio_matrix(cursor, analysis, date_count=DATE_COUNT)
     org = _get_org(analysis)
 
-    all_orgs_records = list(odm.to_records(row_name="org", col_name="month"))
-    nans_to_nones(all_orgs_records)
-    org_records = _get_org_records(odm, org)
-
-    return JsonResponse({"all_orgs": all_orgs_records, "org": org_records})
+    return JsonResponse(
+        {"all_orgs": _get_all_orgs_records(odm), "org": _get_org_records(odm, org)}
+    )
 
 
 def prescribing_deciles(request):
     analysis = Analysis.from_dict(json.loads(request.GET["analysis"]))
 
-    with rxdb.get_cursor() as cursor:
+    with rxdb.get_cursor(
+        deadline=_get_deadline(QUERY_TIMEOUT_SECONDS), label=analysis.get_hash()
+    ) as cursor:
         odm = get_org_date_ratio_matrix(cursor, analysis, date_count=DATE_COUNT)
     org = _get_org(analysis)
+
+    return JsonResponse(
+        {"deciles": _get_deciles_records(odm), "org": _get_org_records(odm, org)}
+    )
+
+
+def _get_all_orgs_records(odm):
+    all_orgs_records = list(odm.to_records(row_name="org", col_name="month"))
+    nans_to_nones(all_orgs_records)
+    return all_orgs_records
+
+
+def _get_deciles_records(odm):
     cdm = odm.get_centiles()
+    return list(cdm.to_records(row_name="centile", col_name="month"))
+
 
-    deciles_records = list(cdm.to_records(row_name="centile", col_name="month"))
-    org_records = _get_org_records(odm, org)
+@csrf_exempt
+@require_POST
+def submit_analysis_job(request):
+    """Start computing the results for an analysis in the background.
 
-    return JsonResponse({"deciles": deciles_records, "org": org_records})
+    The request body is an analysis dict (see `Analysis.from_dict`) and the response
+    gives the ID of the job, whose progress and results can then be polled for from
+    `analysis_job`.  Submitting an analysis which is already running or has recently
+    finished returns the existing job.
+
+    This is exempt from CSRF protection because it only reads data, and so there's
+    nothing for a forged request to do.
+    """
+    try:
+        analysis = Analysis.from_dict(json.loads(request.body))
+        analysis.validate()
+    except (ValueError, KeyError, TypeError, AssertionError) as e:
+        return JsonResponse({"error": f"Invalid analysis: {e}"}, status=400)
+
+    try:
+        job = jobs.get_job_manager().submit(
+            jobs.get_job_id(analysis), functools.partial(_analysis_payload, analysis)
+        )
+    except jobs.TooManyJobs:
+        return JsonResponse(
+            {"error": "Too many analyses in progress, please try again shortly"},
+            status=503,
+            headers={"Retry-After": str(JOB_RETRY_AFTER_SECONDS)},
+        )
+
+    return JsonResponse(
+        job.to_dict(),
+        status=202,
+        headers={"Location": reverse("api_analysis_job", args=[job.id])},
+    )
+
+
+def analysis_job(request, job_id):
+    job = jobs.get_job_manager().get(job_id)
+    if job is None:
+        return JsonResponse({"error": "No such job"}, status=404)
+    return HttpResponse(job.to_json(), content_type="application/json")
+
+
+def _analysis_payload(analysis):
+    """Return everything that the analysis page fetches from `prescribing_all_orgs` and
+    `prescribing_deciles`, encoded as JSON (see `jobs.Job`)."""
+
+    with rxdb.get_cursor(
+        deadline=_get_deadline(JOB_QUERY_TIMEOUT_SECONDS), label=analysis.get_hash()
+    ) as cursor:
+        odm = get_org_date_ratio_matrix(cursor, analysis, date_count=DATE_COUNT)
+    org = _get_org(analysis)
+
+    payload = {
+        "all_orgs": _get_all_orgs_records(odm),
+        "deciles": _get_deciles_records(odm),
+        "org": _get_org_records(odm, org),
+    }
+    with timing.span("json"):
+        return json.dumps(payload, cls=DjangoJSONEncoder, allow_nan=False).encode()
 
 
 def prescribing_medications(request):
@@ -108,7 +204,9 @@ def prescribing_medications(request):
     """
     analysis = Analysis.from_dict(json.loads(request.GET["analysis"]))
 
-    with rxdb.get_cursor() as cursor:
+    with rxdb.get_cursor(
+        deadline=_get_deadline(QUERY_TIMEOUT_SECONDS), label=analysis.get_hash()
+    ) as cursor:
         mdm = get_medication_date_matrix(
             cursor, analysis.ntr_query, date_count=DATE_COUNT
         )
@@ -125,6 +223,10 @@ def prescribing_medications(request):
     return JsonResponse({"medications": medications_records})
 
 
+def _get_deadline(timeout):
+    return time.monotonic() + timeout
+
+
 def _get_top_n_row_label_map(mdm, n):
     """Build a `group_rows` mapping that keeps the top N medications by total prescribing
     and rolls the remainder into a single "Other" group.
@@ -276,7 +378,8 @@ def _metadata_bnf_payload():
 class JsonResponse(DjangoJsonResponse):
     def __init__(self, *args, **kwargs):
         kwargs["json_dumps_params"] = {"allow_nan": False}
-        super().__init__(*args, **kwargs)
+        with timing.span("json"):
+            super().__init__(*args, **kwargs)
 
 
 def nans_to_nones(records):
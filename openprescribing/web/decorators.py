@@ -5,6 +5,7 @@ from django.views.decorators.cache import cache_control
 from django.views.decorators.http import etag
 
 from openprescribing.data import rxdb
+from openprescribing.data.utils.cache_metrics import metered_cache
 
 
 def cache(fn):
@@ -16,7 +17,7 @@ def cache(fn):
     be cleared.
     """
 
-    @functools.lru_cache(maxsize=1)
+    @metered_cache(maxsize=1, name=f"{fn.__module__}.{fn.__qualname__}")
     def cached(cache_key):
         return fn()
 
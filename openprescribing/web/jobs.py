@@ -0,0 +1,201 @@
+"""
+Support for running expensive analyses in the background
+
+Analyses with broad queries can take several seconds to compute when their results
+aren't already cached. Rather than tie up a request thread for all that time, clients
+can submit an analysis as a "job" and then poll for its progress and result.
+
+Jobs run on a small, fixed-size pool of threads so that a burst of expensive analyses
+can't starve the request threads. Jobs are identified by a hash of the analysis and the
+current data version, so submitting an analysis which is already running (or has
+already finished) just returns the existing job.
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connections
+
+from openprescribing.data import rxdb
+from openprescribing.data.queries.query_utils import batch_callback
+
+
+log = logging.getLogger(__name__)
+
+# Number of jobs which can run at once
+JOB_WORKERS = int(os.environ.get("OPENPRESCRIBING_JOB_WORKERS", "2"))
+
+# Number of jobs which can be waiting or running at once before we start rejecting new
+# ones
+MAX_UNFINISHED_JOBS = 32
+
+# Finished jobs are kept so that clients can fetch their results, until they're older
+# than this or until their results take up more than MAX_FINISHED_JOBS_BYTES in total,
+# at which point the oldest are discarded. Results of practice-level analyses can run
+# to tens of megabytes each.
+FINISHED_JOB_TTL_SECONDS = 600
+MAX_FINISHED_JOBS_BYTES = int(
+    os.environ.get("OPENPRESCRIBING_MAX_FINISHED_JOBS_BYTES", 256 * 1024**2)
+)
+
+JOB_MANAGER = None
+
+
+class TooManyJobs(Exception):
+    pass
+
+
+def get_job_manager():
+    global JOB_MANAGER
+    if JOB_MANAGER is None:
+        JOB_MANAGER = JobManager(max_workers=JOB_WORKERS)
+    return JOB_MANAGER
+
+
+def get_job_id(analysis):
+    """Return an ID which is the same for the same analysis run against the same data."""
+
+    cache_key_json = json.dumps(rxdb.get_cache_key(), default=str)
+    cache_key_hash = hashlib.sha256(cache_key_json.encode()).hexdigest()[:16]
+    return f"{analysis.get_hash()}{cache_key_hash}"
+
+
+class Job:
+    """
+    A function running in the background, and its progress
+
+    The function's result must already be encoded as JSON bytes, which take up far less
+    memory than the Python objects they encode while the job waits to be fetched.
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    COMPLETE = "complete"
+    FAILED = "failed"
+
+    def __init__(self, job_id):
+        self.id = job_id
+        self.status = self.PENDING
+        self.batches = 0
+        self.rows = 0
+        self.result = None
+        self.error = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_finished(self):
+        return self.status in (self.COMPLETE, self.FAILED)
+
+    @property
+    def result_size(self):
+        return len(self.result) if self.result is not None else 0
+
+    def to_dict(self):
+        job_dict = {
+            "id": self.id,
+            "status": self.status,
+            "progress": {"batches": self.batches, "rows": self.rows},
+        }
+        if self.status == self.FAILED:
+            job_dict["error"] = self.error
+        return job_dict
+
+    def to_json(self):
+        """Return the job as JSON bytes, including its result if it's complete."""
+
+        job_json = json.dumps(self.to_dict()).encode()
+        if self.status != self.COMPLETE:
+            return job_json
+        # The result is already encoded, so we splice it in rather than decoding it
+        return job_json[:-1] + b', "result": ' + self.result + b"}"
+
+    def report_batch(self, row_count):
+        # This gets called from whichever threads are consuming query results, so we
+        # need to hold the lock while updating the counts
+        with self._lock:
+            self.batches += 1
+            self.rows += row_count
+
+    def run(self, fn):
+        self._update(status=self.RUNNING)
+        token = batch_callback.set(self.report_batch)
+        try:
+            result = fn()
+        except Exception:
+            # The exception could include details (such as SQL or file paths) which we
+            # don't want to show to clients, so we just log it
+            log.exception("Job %s failed", self.id)
+            self._update(
+                status=self.FAILED,
+                error="Analysis failed",
+                finished_at=time.monotonic(),
+            )
+        else:
+            self._update(
+                status=self.COMPLETE, result=result, finished_at=time.monotonic()
+            )
+        finally:
+            batch_callback.reset(token)
+            # Job threads are long-lived and not managed by Django, so we need to tidy
+            # up any database connections ourselves
+            connections.close_all()
+
+    def _update(self, **attrs):
+        with self._lock:
+            for name, value in attrs.items():
+                setattr(self, name, value)
+
+
+class JobManager:
+    def __init__(self, max_workers):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="job"
+        )
+        self.jobs = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, job_id, fn):
+        """Return the job with the given ID, starting it if necessary by running `fn`
+        in the background."""
+
+        with self.lock:
+            job = self.jobs.get(job_id)
+            # We retry failed jobs, because the failure might have been transient
+            if job is not None and job.status != Job.FAILED:
+                return job
+
+            unfinished = sum(1 for job in self.jobs.values() if not job.is_finished)
+            if unfinished >= MAX_UNFINISHED_JOBS:
+                raise TooManyJobs()
+
+            job = Job(job_id)
+            self.jobs[job_id] = job
+            self.jobs.move_to_end(job_id)
+            self._discard_old_jobs()
+
+        self.executor.submit(job.run, fn)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def _discard_old_jobs(self):
+        now = time.monotonic()
+        finished = [job for job in self.jobs.values() if job.is_finished]
+        total_size = sum(job.result_size for job in finished)
+        # Jobs are in the order they were submitted, so the oldest go first
+        for job in finished:
+            if (
+                now - job.finished_at > FINISHED_JOB_TTL_SECONDS
+                or total_size > MAX_FINISHED_JOBS_BYTES
+            ):
+                del self.jobs[job.id]
+                total_size -= job.result_size
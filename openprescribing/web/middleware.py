@@ -0,0 +1,140 @@
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+from opentelemetry import trace
+
+from openprescribing.data.analysis import Analysis
+from openprescribing.data.rxdb import QueryTimeout
+from openprescribing.data.rxdb.admission import Overloaded
+from openprescribing.data.utils import timing
+
+
+log = logging.getLogger(__name__)
+
+
+# How long clients should wait before retrying a request which we turned away because
+# too many queries were already running
+OVERLOADED_RETRY_AFTER_SECONDS = 5
+
+# If set, requests to the API endpoints below are appended to this file, so that they
+# can be replayed with the `replay_requests` command
+REQUEST_CAPTURE_FILE = os.environ.get("OPENPRESCRIBING_REQUEST_CAPTURE_FILE", "")
+CAPTURED_PATH_PREFIXES = ("/api/prescribing-", "/api/metadata/")
+
+# The `Server-Timing` header reveals how we handle requests internally, so we only send
+# it in development or where it's been turned on
+SEND_SERVER_TIMING = os.environ.get("OPENPRESCRIBING_SEND_SERVER_TIMING") == "True"
+
+
+class ServerTimingMiddleware:
+    """Report how long each request spent in each of the steps timed with
+    `timing.span()` as attributes of the request's OpenTelemetry span, and (if
+    `SEND_SERVER_TIMING` is set or we're in DEBUG mode) in a `Server-Timing` header.
+
+    This should come early in `MIDDLEWARE` so that "total" covers as much of the
+    request as possible.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        with timing.collect() as timings:
+            response = self.get_response(request)
+        if timings.durations:
+            timings.add("total", time.perf_counter() - start)
+            if SEND_SERVER_TIMING or settings.DEBUG:
+                response.headers["Server-Timing"] = timings.to_server_timing()
+            trace.get_current_span().set_attributes(timings.to_attributes())
+        return response
+
+
+class QueryErrorMiddleware:
+    """Turn queries which weren't admitted (see `rxdb.admission`) into 503 responses,
+    and queries which exceeded their deadline into 504 responses."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_exception(self, request, exception):
+        if isinstance(exception, Overloaded):
+            return HttpResponse(
+                "The server is busy, please try again shortly",
+                status=503,
+                content_type="text/plain",
+                headers={"Retry-After": str(OVERLOADED_RETRY_AFTER_SECONDS)},
+            )
+        if isinstance(exception, QueryTimeout):
+            return HttpResponse(
+                "This query took too long to run",
+                status=504,
+                content_type="text/plain",
+            )
+        return None
+
+
+class RequestCaptureMiddleware:
+    """Append a record of each request to the prescribing and metadata API endpoints to
+    `REQUEST_CAPTURE_FILE`, one JSON object per line.
+
+    We record only what's needed to replay the request and to tell which requests are
+    for the same analysis: the endpoint, the analysis (normalised, so that equivalent
+    analyses are recorded identically) and its hash, and the org. Nothing about who
+    made the request is recorded.
+    """
+
+    def __init__(self, get_response):
+        if not REQUEST_CAPTURE_FILE:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.path = REQUEST_CAPTURE_FILE
+        # Records are written with a single call so that lines written by different
+        # processes don't interleave, and the lock does the same for threads
+        self.lock = threading.Lock()
+
+    def __call__(self, request):
+        if not request.path.startswith(CAPTURED_PATH_PREFIXES):
+            return self.get_response(request)
+
+        start = time.perf_counter()
+        response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        analysis = get_analysis(request)
+        record = {
+            "time": datetime.datetime.now(datetime.UTC).isoformat(),
+            "endpoint": request.path,
+            "analysis": analysis.to_dict() if analysis else None,
+            "analysis_hash": analysis.get_hash() if analysis else None,
+            "org_id": analysis.org_id if analysis else None,
+            "status": response.status_code,
+            "duration_ms": round(duration * 1000, 1),
+        }
+        # Errors here shouldn't stop us returning the response
+        try:
+            with self.lock, open(self.path, "a") as f:
+                f.write(json.dumps(record, default=str) + "\n")
+        except OSError:
+            log.exception("Error capturing request")
+        return response
+
+
+def get_analysis(request):
+    if "analysis" not in request.GET:
+        return None
+    try:
+        return Analysis.from_dict(json.loads(request.GET["analysis"]))
+    except Exception:
+        # The view will already have reported the error
+        return None
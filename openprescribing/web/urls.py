@@ -22,6 +22,16 @@ urlpatterns = [
         api.prescribing_medications,
         name="api_prescribing_medications",
     ),
+    path(
+        "api/analysis-jobs/",
+        api.submit_analysis_job,
+        name="api_submit_analysis_job",
+    ),
+    path(
+        "api/analysis-jobs/<str:job_id>/",
+        api.analysis_job,
+        name="api_analysis_job",
+    ),
     path(
         "api/metadata/medications/",
         api.metadata_medications,
@@ -47,7 +47,7 @@ def rxdb(data_db_with_transaction, monkeypatch):
 
 @pytest.fixture(scope="session", autouse=True)
 def prevent_rxdb_access():
-    def get_cursor():  # pragma: no cover
+    def get_cursor(*args, **kwargs):  # pragma: no cover
         raise RuntimeError(
             "Direct access to the rxdb database is not allowed in tests; "
             "use the `rxdb` fixture to enable it"
@@ -1,12 +1,14 @@
 import io
 import textwrap
 import zipfile
+from datetime import date
 
 import duckdb
 import responses
 from responses.matchers import query_param_matcher
 
 from openprescribing.data.fetchers import prescribing
+from openprescribing.data.utils.prescribing_file_utils import get_sorted_filename_for
 
 
 @responses.activate
@@ -69,9 +71,9 @@ def test_prescribing_fetch(tmp_path):
     # ZIP file containing CSV
     CSV_FILE = textwrap.dedent(
         """\
-        practice_code,practice_name,value
-        ABC123,"North Street",14
-        DEF456,"Éclair",25
+        BNF_CODE,SNOMED_CODE,PRACTICE_CODE,PRACTICE_NAME,QUANTITY,ITEMS,TOTAL_QUANTITY,NIC,ACTUAL_COST
+        0601023AWAAAAAA,1234,ABC123,"North Street",28,2,56,1.5,1.25
+        0101010G0AAABAB,5678,DEF456,"Éclair",14,1,14,2.0,1.75
         """
     )
     responses.get(
@@ -81,11 +83,16 @@ def test_prescribing_fetch(tmp_path):
         ),
     )
 
-    # Assume we've already downloaded these files
-    prescribing_dir = tmp_path / "prescribing"
-    prescribing_dir.mkdir()
-    (prescribing_dir / "prescribing_2025-07-01_v3_2025-09-19T1459.parquet").touch()
-    (prescribing_dir / "prescribing_2020-01-01_v2_2020-03-04T1213.parquet").touch()
+    # Assume we've already downloaded these files (and sorted them)
+    (tmp_path / "prescribing").mkdir()
+    for name in [
+        "prescribing_2025-07-01_v3_2025-09-19T1459.parquet",
+        "prescribing_2020-01-01_v2_2020-03-04T1213.parquet",
+    ]:
+        filename = tmp_path / "prescribing" / name
+        filename.touch()
+        get_sorted_filename_for(filename).parent.mkdir(parents=True, exist_ok=True)
+        get_sorted_filename_for(filename).touch()
 
     prescribing.fetch(tmp_path)
 
@@ -94,13 +101,106 @@ def test_prescribing_fetch(tmp_path):
     )
 
     results = duckdb.read_parquet(str(output_file))
-    assert results.columns == ["practice_code", "practice_name", "value"]
-    assert results.fetchall() == [
-        ("ABC123", "North Street", "14"),
+    assert results.select("BNF_CODE, PRACTICE_CODE, PRACTICE_NAME").fetchall() == [
+        ("0601023AWAAAAAA", "ABC123", "North Street"),
         # Use an accented character so we can check Latin-1 encoding is handled
         # correctly
-        ("DEF456", "Éclair", "25"),
+        ("0101010G0AAABAB", "DEF456", "Éclair"),
+    ]
+
+    # The new file also has a sorted copy
+    sorted_file = get_sorted_filename_for(output_file)
+    sorted_results = duckdb.read_parquet(str(sorted_file))
+    assert sorted_results.select("bnf_code, snomed_code, practice_code").fetchall() == [
+        ("0101010G0AAABAB", 5678, "DEF456"),
+        ("0601023AWAAAAAA", 1234, "ABC123"),
+    ]
+
+
+def test_sort_files(tmp_path):
+    prescribing_dir = tmp_path / "prescribing"
+    prescribing_dir.mkdir()
+    # Version 2 files have no SNOMED codes and name the BNF code column differently
+    v2_file = prescribing_dir / "prescribing_2020-01-01_v2_2020-03-04T1213.parquet"
+    duckdb.sql(
+        """
+        SELECT * FROM (VALUES
+            ('0601023AWAAAAAA', 'ABC123', '28', '2', '56', '1.5', '1.25'),
+            ('0101010G0AAABAB', 'DEF456', '14', '1', '14', '2.0', '1.75')
+        ) t(
+            BNF_PRESENTATION_CODE, PRACTICE_CODE, QUANTITY, ITEMS, TOTAL_QUANTITY,
+            NIC, ACTUAL_COST
+        )
+        """
+    ).write_parquet(str(v2_file))
+    v3_file = prescribing_dir / "prescribing_2025-07-01_v3_2025-09-19T1459.parquet"
+    duckdb.sql(
+        """
+        SELECT * FROM (VALUES
+            ('0601023AWAAAAAA', '1234', 'XYZ999', '28', '1', '28', '1.5', '1.25'),
+            ('0601023AWAAAAAA', '1234', 'ABC123', '28', '3', '84', '4.5', '3.75')
+        ) t(
+            BNF_CODE, SNOMED_CODE, PRACTICE_CODE, QUANTITY, ITEMS, TOTAL_QUANTITY,
+            NIC, ACTUAL_COST
+        )
+        """
+    ).write_parquet(str(v3_file))
+    # A sorted copy which already exists is left alone
+    existing_file = (
+        prescribing_dir / "prescribing_2025-08-01_v3_2025-10-16T1339.parquet"
+    )
+    existing_file.touch()
+    existing_sorted_file = get_sorted_filename_for(existing_file)
+    existing_sorted_file.parent.mkdir(parents=True)
+    existing_sorted_file.touch()
+    # Whereas stale copies are deleted: one of a file which has since been replaced,
+    # one in an older format, and one left over from a sort which failed
+    stale_files = [
+        get_sorted_filename_for(
+            prescribing_dir / "prescribing_2025-08-01_v3_2025-10-01T0900.parquet"
+        ),
+        tmp_path / "prescribing_sorted" / v3_file.name,
+        tmp_path / "prescribing_sorted" / "v0" / v3_file.name,
+        existing_sorted_file.with_name(f".{existing_sorted_file.name}.abc.tmp"),
+    ]
+    for stale_file in stale_files:
+        stale_file.parent.mkdir(parents=True, exist_ok=True)
+        stale_file.touch()
+
+    prescribing.sort_files(tmp_path)
+
+    assert duckdb.read_parquet(str(get_sorted_filename_for(v2_file))).fetchall() == [
+        ("0101010G0AAABAB", 0, date(2020, 1, 1), "DEF456", "14", "1", "14", 200, 175),
+        ("0601023AWAAAAAA", 0, date(2020, 1, 1), "ABC123", "28", "2", "56", 150, 125),
+    ]
+    assert duckdb.read_parquet(str(get_sorted_filename_for(v3_file))).fetchall() == [
+        (
+            "0601023AWAAAAAA",
+            1234,
+            date(2025, 7, 1),
+            "ABC123",
+            "28",
+            "3",
+            "84",
+            450,
+            375,
+        ),
+        (
+            "0601023AWAAAAAA",
+            1234,
+            date(2025, 7, 1),
+            "XYZ999",
+            "28",
+            "1",
+            "28",
+            150,
+            125,
+        ),
     ]
+    assert existing_sorted_file.read_bytes() == b""
+    assert not any(stale_file.exists() for stale_file in stale_files)
+    # Directories for older formats are removed once they're empty
+    assert not (tmp_path / "prescribing_sorted" / "v0").exists()
 
 
 def create_zip_archive(files):
@@ -193,3 +193,15 @@ def test_ods_ingest_multiple_pcns_missing_opEndDate(rxdb, tmp_path, settings):
         "ENGLAND",
         "U36779",
     }
+
+
+@freeze_time("2020-03-20")
+def test_ods_ingest_multiple_pcns_none_current(rxdb, tmp_path, settings):
+    duckdb_view_from_json_file(
+        rxdb.conn, "tests/data/ingestors/data/ods_ingest_multiple_pcn.json"
+    )
+
+    ods.ingest_ods(rxdb.conn)
+
+    # Neither PCN's relationship with the practice had started, so it has no PCN
+    assert {p.id for p in Org.objects.get(id="M85171").parents.all()} == {"ENGLAND"}
@@ -1,11 +1,22 @@
+import concurrent.futures
 import csv
 import datetime
+import json
+import logging
 
 import duckdb
 import pytest
 
 from openprescribing.data.ingestors import prescribing
+from openprescribing.data.ingestors.prescribing import count_table
+from openprescribing.data.utils import timing
+from openprescribing.data.utils.duckdb_utils import escape
+from openprescribing.data.utils.prescribing_file_utils import (
+    get_sorted_filename_for,
+    write_sorted_file,
+)
 from tests.utils.parquet_utils import parquet_from_dicts
+from tests.utils.rxdb_utils import rxdb_ingest
 
 
 def test_prescribing_ingest(tmp_path, settings, data_db):
@@ -38,7 +49,10 @@ def test_prescribing_ingest(tmp_path, settings, data_db):
         "list_size_norm",
         "list_size",
         "ingested_file",
+        "appended_run",
     }
+    # Nothing has been appended to a newly built database
+    assert tables.pop("appended_run") == []
     for name, table in tables.items():
         assert len(table) > 0, f"table '{name}' is empty"
 
@@ -290,6 +304,816 @@ def test_prescribing_ingest_cleans_up_tmp_file_on_failure(
         prescribing.ingest()
 
     assert list(settings.PRESCRIBING_DATABASE.parent.glob(".*.tmp")) == []
+    # The partly built database is kept so that the next ingest can resume it
+    assert prescribing.get_partial_filename_for(settings.PRESCRIBING_DATABASE).exists()
+
+
+def test_prescribing_ingest_cleans_up_tmp_file_on_failed_update(
+    ingest_settings, monkeypatch
+):
+    write_as_parquet_files(generate_prescribing_data(), ingest_settings.DOWNLOAD_DIR)
+    prescribing.ingest()
+    tables = get_all_tables(ingest_settings.PRESCRIBING_DATABASE)
+
+    write_as_parquet_files(
+        {
+            ("prescribing", "2025-02-01", "v3"): [
+                prescribing_row("01234ABC", "ABC123", "8")
+            ]
+        },
+        ingest_settings.DOWNLOAD_DIR,
+    )
+    monkeypatch.setattr(prescribing, "update_id_tables", raise_error)
+
+    with pytest.raises(RuntimeError):
+        prescribing.ingest()
+
+    assert list(ingest_settings.PRESCRIBING_DATABASE.parent.glob(".*.tmp")) == []
+    assert get_all_tables(ingest_settings.PRESCRIBING_DATABASE) == tables
+
+
+@pytest.fixture
+def ingest_settings(tmp_path, settings, data_db):
+    settings.DOWNLOAD_DIR = tmp_path / "downloads"
+    settings.PRESCRIBING_DATABASE = tmp_path / "data" / "prescribing.duckdb"
+    settings.DUCKDB_MEMORY_LIMIT = "8GB"
+    settings.DUCKDB_TMP_DIRECTORY = tmp_path / "duckdb_tmp"
+    settings.DUCKDB_TMP_DIRECTORY_LIMIT = "20GB"
+    return settings
+
+
+@pytest.fixture
+def build_database_calls(monkeypatch):
+    calls = []
+    build_database = prescribing.build_database
+
+    def wrapper(*args):
+        calls.append(args)
+        return build_database(*args)
+
+    monkeypatch.setattr(prescribing, "build_database", wrapper)
+    return calls
+
+
+def test_prescribing_ingest_sorts_prescribing_norm_across_ranges(
+    ingest_settings, monkeypatch
+):
+    # Put every BNF code in a range of its own, with several being inserted at once
+    monkeypatch.setattr(prescribing, "BNF_RANGE_MEMORY_FRACTION", 0)
+    monkeypatch.setattr(prescribing, "INGEST_WORKERS", 3)
+    write_as_parquet_files(
+        generate_prescribing_data_for_ranges(), ingest_settings.DOWNLOAD_DIR
+    )
+
+    prescribing.ingest()
+
+    conn = duckdb.connect(ingest_settings.PRESCRIBING_DATABASE)
+    rows = conn.sql(
+        "SELECT presentation_id, date_key, practice_key FROM prescribing_norm "
+        "ORDER BY rowid"
+    ).fetchall()
+    assert len(rows) == 20
+    assert rows == sorted(rows)
+
+
+def test_prescribing_ingest_fails_if_any_range_fails(ingest_settings, monkeypatch):
+    monkeypatch.setattr(prescribing, "BNF_RANGE_MEMORY_FRACTION", 0)
+    monkeypatch.setattr(prescribing, "INGEST_WORKERS", 3)
+    data = generate_prescribing_data_for_ranges()
+    # Too many items to store in the first range, so later ones must not be committed
+    data["prescribing", "2025-01-01", "v3"][-1]["ITEMS"] = "100000"
+    write_as_parquet_files(data, ingest_settings.DOWNLOAD_DIR)
+
+    with pytest.raises(duckdb.ConversionException):
+        prescribing.ingest()
+
+    assert not ingest_settings.PRESCRIBING_DATABASE.exists()
+
+
+@pytest.mark.parametrize("allow_cancel", [True, False])
+def test_prescribing_ingest_stops_building_ranges_after_failure(
+    ingest_settings, monkeypatch, caplog, allow_cancel
+):
+    monkeypatch.setattr(prescribing, "BNF_RANGE_MEMORY_FRACTION", 0)
+    monkeypatch.setattr(prescribing, "INGEST_WORKERS", 1)
+
+    class ThreadPoolExecutor(concurrent.futures.ThreadPoolExecutor):
+        def shutdown(self, wait=True, cancel_futures=False):
+            # Without cancelling the queued ranges, it's up to each range to check
+            # whether an earlier one has failed
+            super().shutdown(wait=wait, cancel_futures=cancel_futures and allow_cancel)
+
+    monkeypatch.setattr(
+        prescribing.concurrent.futures, "ThreadPoolExecutor", ThreadPoolExecutor
+    )
+    data = generate_prescribing_data_for_ranges()
+    # Too many items to store in the first range
+    data["prescribing", "2025-01-01", "v3"][-1]["ITEMS"] = "100000"
+    write_as_parquet_files(data, ingest_settings.DOWNLOAD_DIR)
+
+    with caplog.at_level(logging.INFO), pytest.raises(duckdb.ConversionException):
+        prescribing.ingest()
+
+    building = [
+        m for m in caplog.messages if m.startswith("Building `prescribing_norm`")
+    ]
+    assert building == ["Building `prescribing_norm` table: 0101 -> 0202"]
+
+
+def test_prescribing_ingest_reads_sorted_files(ingest_settings, monkeypatch):
+    monkeypatch.setattr(prescribing, "BNF_RANGE_MEMORY_FRACTION", 0)
+    write_as_parquet_files(
+        generate_prescribing_data_for_ranges(), ingest_settings.DOWNLOAD_DIR
+    )
+    prescribing.ingest()
+    tables = get_sorted_tables(ingest_settings.PRESCRIBING_DATABASE)
+
+    # Write sorted copies of one month's file, and then the other, and check that we
+    # get the same database reading a mixture of sorted and raw files, and just sorted
+    # ones
+    for date in [datetime.date(2025, 2, 1), datetime.date(2025, 1, 1)]:
+        filename = next(
+            (ingest_settings.DOWNLOAD_DIR / "prescribing").glob(f"prescribing_{date}_*")
+        )
+        sorted_filename = get_sorted_filename_for(filename)
+        write_sorted_file(date, filename, sorted_filename)
+        prescribing.ingest(force=True)
+
+        assert get_sorted_tables(ingest_settings.PRESCRIBING_DATABASE) == tables
+
+    conn = duckdb.connect()
+    bnf_codes = conn.sql(
+        f"SELECT bnf_code FROM read_parquet('{sorted_filename}')"
+    ).fetchall()
+    assert bnf_codes == sorted(bnf_codes)
+
+
+def test_prescribing_ingest_reports_resources(ingest_settings, monkeypatch):
+    monkeypatch.setattr(prescribing, "BNF_RANGE_MEMORY_FRACTION", 0)
+    # Sample often enough that we're sure to take some samples during the ingest
+    monkeypatch.setattr(prescribing, "RESOURCE_SAMPLE_INTERVAL", 0.001)
+    data = generate_prescribing_data_for_ranges()
+    write_as_parquet_files(data, ingest_settings.DOWNLOAD_DIR)
+
+    report = prescribing.ingest()
+
+    assert report["stages"].keys() == {
+        "date",
+        "practice",
+        "presentation",
+        "list_size_norm",
+        "prescribing_norm",
+        "views",
+    }
+    assert report["stages"]["date"]["rows"] == 2
+    assert report["stages"]["prescribing_norm"]["rows"] == 20
+    assert [
+        (bnf_range["bnf_codes"], bnf_range["rows"])
+        for bnf_range in report["bnf_ranges"]
+    ] == [
+        ("0101 -> 0202", 4),
+        ("0202 -> 0303", 4),
+        ("0303 -> 0404", 4),
+        ("0404 -> 0505", 4),
+        ("0505 -> ZZZZZZZZZZZZZZZ", 4),
+    ]
+    assert all(bnf_range["rows_per_second"] > 0 for bnf_range in report["bnf_ranges"])
+    assert report["peak_memory_bytes"] > 0
+    assert report["peak_temp_directory_bytes"] == 0
+    # The report is written out as JSON by the `ingest` command
+    assert json.loads(json.dumps(report)) == report
+
+    # Adding a new month has different stages
+    del data["prescribing", "2025-01-01", "v3"]
+    data["prescribing", "2025-03-01", "v3"] = data.pop(
+        ("prescribing", "2025-02-01", "v3")
+    )
+    write_as_parquet_files(data, ingest_settings.DOWNLOAD_DIR)
+    report = prescribing.ingest()
+    assert report["stages"].keys() == {
+        "copy",
+        "date",
+        "practice",
+        "presentation",
+        "prescribing_norm",
+        "code_changes",
+        "validate",
+    }
+    # Only the rows we appended, not the whole table
+    assert report["stages"]["prescribing_norm"]["rows"] == 10
+    assert report["bnf_ranges"] == []
+
+    # There's nothing to report if there's nothing new to ingest
+    assert prescribing.ingest() is None
+
+
+def test_prescribing_ingest_rejects_database_which_fails_validation(ingest_settings):
+    data = generate_prescribing_data_for_ranges()
+    write_as_parquet_files(data, ingest_settings.DOWNLOAD_DIR)
+    prescribing.ingest()
+    tables = get_all_tables(ingest_settings.PRESCRIBING_DATABASE)
+
+    # A new version of a file we've already ingested, which has lost most of its rows
+    republished_file = (
+        ingest_settings.DOWNLOAD_DIR
+        / "prescribing"
+        / "prescribing_2025-02-01_v3_republished.parquet"
+    )
+    parquet_from_dicts(
+        republished_file,
+        [
+            prescribing_row("0101", "ABC123", "1"),
+            prescribing_row("0101", "XYZ999", "1"),
+        ],
+    )
+    with pytest.raises(prescribing.IngestValidationError) as exc_info:
+        prescribing.ingest()
+
+    assert exc_info.value.anomalies == [
+        "2025-02-01: items 10 -> 2 (-80%)",
+        "2025-02-01: net_cost 12,340 -> 2,468 (-80%)",
+        "2025-02-01: actual_cost 15,340 -> 3,068 (-80%)",
+        "2025-02-01: presentations 5 -> 1 (-80%)",
+    ]
+    assert "2025-02-01: items 10 -> 2 (-80%)" in str(exc_info.value)
+    # The existing database is left as it was
+    assert get_all_tables(ingest_settings.PRESCRIBING_DATABASE) == tables
+
+    # Likewise for a new month which is much smaller than the ones we already have
+    republished_file.unlink()
+    write_as_parquet_files(
+        {("prescribing", "2025-03-01", "v3"): [prescribing_row("0101", "ABC123", "1")]},
+        ingest_settings.DOWNLOAD_DIR,
+    )
+    with pytest.raises(prescribing.IngestValidationError) as exc_info:
+        prescribing.ingest()
+
+    assert "2025-03-01: items 10 -> 1 (-90%) compared with 2025-02-01" in (
+        exc_info.value.anomalies
+    )
+    assert get_all_tables(ingest_settings.PRESCRIBING_DATABASE) == tables
+    assert list(ingest_settings.PRESCRIBING_DATABASE.parent.glob(".*.tmp")) == []
+
+
+def test_prescribing_ingest_logs_anomalies_when_forced(ingest_settings, caplog):
+    data = generate_prescribing_data_for_ranges()
+    write_as_parquet_files(data, ingest_settings.DOWNLOAD_DIR)
+    prescribing.ingest()
+
+    # We're forcing a rebuild to fix the data, which means it can change a lot
+    parquet_from_dicts(
+        ingest_settings.DOWNLOAD_DIR
+        / "prescribing"
+        / "prescribing_2025-02-01_v3_republished.parquet",
+        [prescribing_row("0101", "ABC123", "1")],
+    )
+    prescribing.ingest(force=True)
+
+    assert "2025-02-01: items 10 -> 1 (-90%)" in caplog.text
+    tables = get_all_tables(ingest_settings.PRESCRIBING_DATABASE)
+    assert [
+        row["items"]
+        for row in tables["prescribing"]
+        if str(row["date"]) == "2025-02-01"
+    ] == [1]
+
+
+def test_find_anomalies():
+    def totals(items, practices=1):
+        return {
+            "items": items,
+            "net_cost": 100,
+            "actual_cost": 100,
+            "practices": practices,
+            "presentations": 1,
+        }
+
+    jan, feb, mar, apr = [datetime.date(2025, month, 1) for month in [1, 2, 3, 4]]
+    old_totals = {jan: totals(100), feb: totals(0), mar: totals(100)}
+    new_totals = {
+        # Within VALIDATION_TOLERANCE
+        jan: totals(104),
+        # Anything is a large change from nothing
+        feb: totals(1),
+        # Compared with the nearest month we already have, and within
+        # NEW_MONTH_VALIDATION_TOLERANCE
+        apr: totals(120, practices=2),
+    }
+
+    assert prescribing.find_anomalies(old_totals, new_totals) == [
+        "2025-03-01: missing from new database",
+        "2025-02-01: items 0 -> 1 (+inf%)",
+        "2025-04-01: practices 1 -> 2 (+100%) compared with 2025-03-01",
+    ]
+    # There's nothing to compare with if we didn't have any prescribing before
+    assert prescribing.find_anomalies({}, new_totals) == []
+
+
+def test_get_monthly_totals_for_both_layouts(ingest_settings):
+    write_as_parquet_files(generate_prescribing_data(), ingest_settings.DOWNLOAD_DIR)
+    prescribing.ingest()
+
+    def get_monthly_totals():
+        conn = duckdb.connect()
+        conn.sql(
+            f"ATTACH {escape(ingest_settings.PRESCRIBING_DATABASE)} AS old (READ_ONLY)"
+        )
+        try:
+            return prescribing.get_monthly_totals(conn, "old")
+        finally:
+            conn.close()
+
+    totals = get_monthly_totals()
+    convert_to_layout_without_stable_keys(ingest_settings.PRESCRIBING_DATABASE)
+
+    assert len(totals) > 0
+    assert get_monthly_totals() == totals
+
+
+def test_get_ingest_report_for_empty_range():
+    timings = timing.Timings()
+    timings.add("bnf_range.0101:0202", 0, rows=0)
+    # Timings of anything other than stages and ranges are left out
+    timings.add("cache", 0.5, hits=1)
+
+    report = prescribing.get_ingest_report(timings, {})
+
+    assert report["stages"] == {}
+    assert report["bnf_ranges"] == [
+        {"bnf_codes": "0101 -> 0202", "seconds": 0, "rows": 0, "rows_per_second": None}
+    ]
+
+
+def test_prescribing_ingest_resumes_interrupted_build(
+    ingest_settings, monkeypatch, caplog
+):
+    monkeypatch.setattr(prescribing, "BNF_RANGE_MEMORY_FRACTION", 0)
+    monkeypatch.setattr(prescribing, "INGEST_WORKERS", 3)
+    data = generate_prescribing_data_for_ranges()
+    # Too many items to store in the third range, so the first two are committed
+    bad_row = data["prescribing", "2025-01-01", "v3"][4]
+    assert bad_row["BNF_CODE"] == "0303"
+    bad_row["ITEMS"] = "100000"
+    write_as_parquet_files(data, ingest_settings.DOWNLOAD_DIR)
+    with pytest.raises(duckdb.ConversionException):
+        prescribing.ingest()
+
+    # The same files, but with data we can ingest
+    bad_row["ITEMS"] = "1"
+    write_as_parquet_files(data, ingest_settings.DOWNLOAD_DIR)
+    caplog.clear()
+    with caplog.at_level(logging.INFO):
+        prescribing.ingest()
+
+    assert "Resuming partly built database" in caplog.messages
+    assert "Already built `presentation` table" in caplog.messages
+    assert "Already built `prescribing_norm` table up to 0303" in caplog.messages
+    assert "Building `prescribing_norm` table: 0202 -> 0303" not in caplog.messages
+    assert "Building `prescribing_norm` table: 0303 -> 0404" in caplog.messages
+    assert not prescribing.get_partial_filename_for(
+        ingest_settings.PRESCRIBING_DATABASE
+    ).exists()
+    tables = assert_same_as_rebuilt_database(ingest_settings.PRESCRIBING_DATABASE)
+    assert "build_checkpoint" not in tables
+    assert len(tables["prescribing_norm"]) == 20
+
+
+def test_prescribing_ingest_resumes_build_which_failed_in_last_stage(
+    ingest_settings, monkeypatch, caplog
+):
+    write_as_parquet_files(generate_prescribing_data(), ingest_settings.DOWNLOAD_DIR)
+    monkeypatch.setattr(prescribing, "apply_code_changes", raise_error)
+    with pytest.raises(RuntimeError):
+        prescribing.ingest()
+    monkeypatch.undo()
+
+    with caplog.at_level(logging.INFO):
+        prescribing.ingest()
+
+    assert "Already built `prescribing_norm` table up to ZZZZZZZZZZZZZZZ" in (
+        caplog.messages
+    )
+    # The views created before the failure were rolled back, so creating them again
+    # doesn't fail
+    assert_same_as_rebuilt_database(ingest_settings.PRESCRIBING_DATABASE)
+
+
+@pytest.mark.parametrize("partial_build", ["different_files", "empty"])
+def test_prescribing_ingest_discards_partial_build(
+    ingest_settings, monkeypatch, caplog, partial_build
+):
+    data = generate_prescribing_data_for_ranges()
+    partial_file = prescribing.get_partial_filename_for(
+        ingest_settings.PRESCRIBING_DATABASE
+    )
+    if partial_build == "different_files":
+        monkeypatch.setattr(prescribing, "ingest_sources", raise_error)
+        write_as_parquet_files(data, ingest_settings.DOWNLOAD_DIR)
+        with pytest.raises(RuntimeError):
+            prescribing.ingest()
+        monkeypatch.undo()
+        # A new file means the partial build is for different files
+        data = {
+            ("prescribing", "2025-03-01", "v3"): [
+                prescribing_row("0101", "ABC123", "1")
+            ]
+        }
+    else:
+        # As if we were killed right after creating the file
+        partial_file.parent.mkdir(parents=True)
+        duckdb.connect(partial_file).close()
+    write_as_parquet_files(data, ingest_settings.DOWNLOAD_DIR)
+
+    with caplog.at_level(logging.INFO):
+        prescribing.ingest()
+
+    assert "Discarding partly built database which can't be resumed" in caplog.messages
+    assert "Resuming partly built database" not in caplog.messages
+    assert not partial_file.exists()
+    assert_same_as_rebuilt_database(ingest_settings.PRESCRIBING_DATABASE)
+
+
+def raise_error(*args):
+    raise RuntimeError()
+
+
+def generate_prescribing_data_for_ranges():
+    bnf_codes = ["0101", "0202", "0303", "0404", "0505"]
+    return {
+        ("prescribing", date, "v3"): [
+            prescribing_row(bnf_code, practice_code, "1")
+            # Rows which aren't in the order we want them stored
+            for bnf_code in reversed(bnf_codes)
+            for practice_code in ["ABC123", "XYZ999"]
+        ]
+        for date in ["2025-01-01", "2025-02-01"]
+    } | {("list_size", "2025-01-01", "v2"): [list_size_row("ABC123", "12400")]}
+
+
+def test_get_bnf_code_ranges():
+    conn = duckdb.connect()
+    conn.sql(
+        """
+        CREATE TABLE prescribing_source AS
+        SELECT bnf_code FROM (
+            VALUES ('A', 5), ('B', 1), ('C', 1), ('D', 10), ('E', 2)
+        ) AS counts(bnf_code, n), range(n)
+        """
+    )
+
+    assert list(prescribing.get_bnf_code_ranges(conn, max_rows=3)) == [
+        # More rows than `max_rows` in a single code
+        ("A", "B"),
+        ("B", "D"),
+        ("D", "E"),
+        ("E", "ZZZZZZZZZZZZZZZ"),
+    ]
+    assert list(prescribing.get_bnf_code_ranges(conn, max_rows=100)) == [
+        ("A", "ZZZZZZZZZZZZZZZ"),
+    ]
+    assert list(
+        prescribing.get_bnf_code_ranges(conn, max_rows=3, min_bnf_code="C")
+    ) == [
+        ("C", "D"),
+        ("D", "E"),
+        ("E", "ZZZZZZZZZZZZZZZ"),
+    ]
+
+
+def test_get_max_rows_per_range(settings, monkeypatch):
+    settings.DUCKDB_MEMORY_LIMIT = "8GB"
+    monkeypatch.setattr(prescribing, "BNF_RANGE_MEMORY_FRACTION", 0.25)
+    monkeypatch.setattr(prescribing, "ESTIMATED_BYTES_PER_ROW", 100)
+
+    assert prescribing.get_max_rows_per_range() == 20_000_000
+
+
+def test_ingest_sources_without_prescribing_data():
+    conn = duckdb.connect()
+
+    rxdb_ingest(conn)
+
+    assert count_table(conn, "prescribing_norm") == 0
+    assert count_table(conn, "presentation") == 0
+
+
+def test_prescribing_ingest_adds_list_sizes_incrementally(
+    ingest_settings, build_database_calls
+):
+    test_data = generate_prescribing_data()
+    write_as_parquet_files(test_data, ingest_settings.DOWNLOAD_DIR)
+    prescribing.ingest()
+    assert len(build_database_calls) == 1
+
+    # List sizes are published after the prescribing data for the same month
+    write_as_parquet_files(
+        {
+            ("list_size", "2025-01-01", "v2"): [
+                list_size_row("ABC123", "12400"),
+                list_size_row("-", "10"),
+            ],
+        },
+        ingest_settings.DOWNLOAD_DIR,
+    )
+    report = prescribing.ingest()
+
+    assert len(build_database_calls) == 1
+    assert report["stages"]["list_size_norm"]["rows"] == 1
+    assert_same_as_rebuilt_database(ingest_settings.PRESCRIBING_DATABASE)
+
+
+def test_prescribing_ingest_adds_earlier_month_incrementally(
+    ingest_settings, build_database_calls, monkeypatch
+):
+    # Our new month is nothing like the existing one
+    monkeypatch.setattr(prescribing, "NEW_MONTH_VALIDATION_TOLERANCE", float("inf"))
+    write_as_parquet_files(generate_prescribing_data(), ingest_settings.DOWNLOAD_DIR)
+    prescribing.ingest()
+
+    # A month earlier than any we have, for a presentation and practice we already
+    # have and one we don't, doesn't change any existing IDs
+    write_as_parquet_files(
+        {
+            ("prescribing", "2019-01-01", "v2"): [
+                prescribing_row("01234ABC", "ABC123", "5"),
+                prescribing_row("99999ZZZ", "XYZ999", "7"),
+            ],
+        },
+        ingest_settings.DOWNLOAD_DIR,
+    )
+    prescribing.ingest()
+    write_as_parquet_files(
+        {
+            ("list_size", "2019-01-01", "v2"): [
+                list_size_row("ABC123", "12000"),
+                list_size_row("XYZ999", "5000"),
+            ],
+        },
+        ingest_settings.DOWNLOAD_DIR,
+    )
+    prescribing.ingest()
+
+    assert len(build_database_calls) == 1
+    tables = assert_same_as_rebuilt_database(ingest_settings.PRESCRIBING_DATABASE)
+    assert sorted(row["items"] for row in tables["prescribing"]) == [5, 7, 100, 100]
+    assert {row["filename"] for row in tables["ingested_file"]} == {
+        "prescribing_2025-01-01_v3_foobar.parquet",
+        "prescribing_2020-01-01_v2_foobar.parquet",
+        "prescribing_2019-01-01_v2_foobar.parquet",
+        "list_size_2020-01-01_v2_foobar.parquet",
+        "list_size_2019-01-01_v2_foobar.parquet",
+    }
+
+
+def test_prescribing_ingest_adds_later_month_incrementally(
+    ingest_settings, build_database_calls, monkeypatch
+):
+    # Our new month is nothing like the existing one
+    monkeypatch.setattr(prescribing, "NEW_MONTH_VALIDATION_TOLERANCE", float("inf"))
+    write_as_parquet_files(generate_prescribing_data(), ingest_settings.DOWNLOAD_DIR)
+    prescribing.ingest()
+
+    # A new month, with a new practice and a new presentation which sorts before the
+    # existing one
+    write_as_parquet_files(
+        {
+            ("prescribing", "2025-02-01", "v3"): [
+                prescribing_row("01234ABC", "ABC123", "8"),
+                prescribing_row("00000AAA", "AAA111", "9"),
+            ],
+        },
+        ingest_settings.DOWNLOAD_DIR,
+    )
+    prescribing.ingest()
+
+    assert len(build_database_calls) == 1
+    tables = get_sorted_tables(ingest_settings.PRESCRIBING_DATABASE)
+    # Dates are numbered from the most recent, but keyed by months since the epoch
+    assert [(row["id"], row["key"], row["date"]) for row in tables["date"]] == [
+        (0, 301, datetime.date(2025, 2, 1)),
+        (1, 300, datetime.date(2025, 1, 1)),
+        (2, 240, datetime.date(2020, 1, 1)),
+    ]
+    # Existing practices keep their keys, and new ones get keys after them
+    assert [(row["id"], row["key"], row["code"]) for row in tables["practice"]] == [
+        (0, 1, "AAA111"),
+        (1, 0, "ABC123"),
+    ]
+    # Likewise for presentation IDs
+    assert [
+        (row["id"], row["bnf_code"], row["snomed_code"])
+        for row in tables["presentation"]
+    ] == [
+        (1, "01234ABC", 0),
+        (2, "01234ABC", 12345678),
+        (3, "00000AAA", 12345678),
+    ]
+
+    # Apart from presentation IDs, the data is the same as if we'd built the database
+    # from scratch
+    prescribing.ingest(force=True)
+    rebuilt_tables = get_sorted_tables(ingest_settings.PRESCRIBING_DATABASE)
+    for name in ["prescribing", "list_size"]:
+        assert without_column(tables[name], "presentation_id") == without_column(
+            rebuilt_tables[name], "presentation_id"
+        )
+    assert rebuilt_tables["presentation"][0]["bnf_code"] == "00000AAA"
+
+
+def test_prescribing_ingest_rebuilds_database_without_stable_keys(
+    ingest_settings, build_database_calls, caplog
+):
+    write_as_parquet_files(generate_prescribing_data(), ingest_settings.DOWNLOAD_DIR)
+    prescribing.ingest()
+    convert_to_layout_without_stable_keys(ingest_settings.PRESCRIBING_DATABASE)
+
+    write_as_parquet_files(
+        {
+            ("prescribing", "2025-02-01", "v3"): [
+                prescribing_row("01234ABC", "ABC123", "100"),
+            ],
+        },
+        ingest_settings.DOWNLOAD_DIR,
+    )
+    with caplog.at_level(logging.INFO):
+        prescribing.ingest()
+
+    assert "Rebuilding database which was built without stable keys" in (
+        caplog.messages
+    )
+    assert len(build_database_calls) == 2
+    tables = assert_same_as_rebuilt_database(ingest_settings.PRESCRIBING_DATABASE)
+    assert len(tables["prescribing_norm"]) == 3
+
+
+def convert_to_layout_without_stable_keys(path):
+    # Rewrite the database at `path` into the layout we used before dates and practices
+    # had stable keys, where the prescribing and list size data refer to them by ID
+    conn = duckdb.connect(path)
+    conn.sql(
+        """
+        CREATE OR REPLACE TABLE prescribing_norm AS
+        SELECT
+            rx.presentation_id,
+            date.id AS date_id,
+            practice.id AS practice_id,
+            rx.quantity_value,
+            rx.items,
+            rx.quantity,
+            rx.net_cost,
+            rx.actual_cost
+        FROM prescribing_norm AS rx
+        JOIN date ON rx.date_key = date.key
+        JOIN practice ON rx.practice_key = practice.key
+        """
+    )
+    conn.sql(
+        """
+        CREATE OR REPLACE TABLE list_size_norm AS
+        SELECT date.id AS date_id, practice.id AS practice_id, lst.total
+        FROM list_size_norm AS lst
+        JOIN date ON lst.date_key = date.key
+        JOIN practice ON lst.practice_key = practice.key
+        """
+    )
+    conn.sql("CREATE OR REPLACE TABLE date AS SELECT id, date FROM date")
+    conn.sql(
+        """
+        CREATE OR REPLACE TABLE practice AS
+        SELECT id, code, latest_prescribing_date FROM practice
+        """
+    )
+    conn.sql(
+        """
+        CREATE OR REPLACE VIEW prescribing AS
+        SELECT
+            rx.presentation_id,
+            presentation.bnf_code,
+            presentation.snomed_code,
+            rx.date_id,
+            date.date,
+            rx.practice_id,
+            practice.code AS practice_code,
+            rx.quantity_value,
+            rx.items,
+            rx.quantity,
+            rx.net_cost,
+            rx.actual_cost
+        FROM prescribing_norm AS rx
+        JOIN presentation ON rx.presentation_id = presentation.id
+        JOIN date ON rx.date_id = date.id
+        JOIN practice ON rx.practice_id = practice.id
+        """
+    )
+    conn.close()
+
+
+def test_prescribing_ingest_rebuilds_after_max_appended_runs(
+    ingest_settings, build_database_calls, monkeypatch, caplog
+):
+    monkeypatch.setattr(prescribing, "MAX_APPENDED_RUNS", 2)
+    write_as_parquet_files(generate_prescribing_data(), ingest_settings.DOWNLOAD_DIR)
+    prescribing.ingest()
+    # Databases built before we recorded appended runs don't have the table
+    conn = duckdb.connect(ingest_settings.PRESCRIBING_DATABASE)
+    conn.sql("DROP TABLE appended_run")
+    conn.close()
+
+    for date in ["2025-02-01", "2025-03-01", "2025-04-01"]:
+        write_as_parquet_files(
+            {
+                ("prescribing", date, "v3"): [
+                    prescribing_row("01234ABC", "ABC123", "100"),
+                ],
+            },
+            ingest_settings.DOWNLOAD_DIR,
+        )
+        with caplog.at_level(logging.INFO):
+            prescribing.ingest()
+
+    # The first two months are appended, and the third triggers a rebuild
+    assert len(build_database_calls) == 2
+    assert "Rebuilding database after 2 appended runs" in caplog.messages
+    tables = get_all_tables(ingest_settings.PRESCRIBING_DATABASE)
+    assert tables["appended_run"] == []
+    assert len(tables["prescribing_norm"]) == 5
+
+
+def test_prescribing_ingest_rebuilds_when_files_replaced(
+    ingest_settings, build_database_calls, monkeypatch
+):
+    # The new version of the file is nothing like the old one
+    monkeypatch.setattr(prescribing, "VALIDATION_TOLERANCE", float("inf"))
+    write_as_parquet_files(generate_prescribing_data(), ingest_settings.DOWNLOAD_DIR)
+    prescribing.ingest()
+
+    # A new version of a file we've already ingested
+    write_as_parquet_files(
+        {
+            ("prescribing", "2020-01-01", "v3"): [
+                prescribing_row("01234ABC", "ABC123", "50"),
+            ],
+        },
+        ingest_settings.DOWNLOAD_DIR,
+    )
+    prescribing.ingest()
+
+    assert len(build_database_calls) == 2
+    tables = get_all_tables(ingest_settings.PRESCRIBING_DATABASE)
+    assert sorted(row["items"] for row in tables["prescribing"]) == [50, 100]
+
+
+def assert_same_as_rebuilt_database(path):
+    """Check that the database at `path` has the same contents as one built from
+    scratch from the same files (ignoring the order of rows) and return its tables,
+    ordered consistently."""
+
+    tables = get_sorted_tables(path)
+    prescribing.ingest(force=True)
+    rebuilt_tables = get_sorted_tables(path)
+    # This records how the database was built, rather than what's in it
+    tables.pop("appended_run")
+    rebuilt_tables.pop("appended_run")
+    assert tables == rebuilt_tables
+    return tables
+
+
+def get_sorted_tables(path):
+    return {name: sort_rows(rows) for name, rows in get_all_tables(path).items()}
+
+
+def sort_rows(rows):
+    return sorted(
+        rows,
+        key=lambda row: tuple((value is None, str(value)) for value in row.values()),
+    )
+
+
+def without_column(rows, column):
+    return sort_rows([{k: v for k, v in row.items() if k != column} for row in rows])
+
+
+def prescribing_row(bnf_code, practice_code, items):
+    return {
+        "BNF_CODE": bnf_code,
+        "SNOMED_CODE": "12345678",
+        "PRACTICE_CODE": practice_code,
+        "QUANTITY": "10.0",
+        "ITEMS": items,
+        "TOTAL_QUANTITY": "150.0",
+        "NIC": "12.34",
+        "ACTUAL_COST": "15.34",
+    }
+
+
+def list_size_row(practice_code, number_of_patients):
+    return {
+        "ORG_CODE": practice_code,
+        "NUMBER_OF_PATIENTS": number_of_patients,
+        "ORG_TYPE": "GP",
+        "SEX": "ALL",
+        "AGE_GROUP_5": "ALL",
+    }
 
 
 def generate_prescribing_data():
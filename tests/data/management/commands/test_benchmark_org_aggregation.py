@@ -0,0 +1,50 @@
+import io
+
+import pytest
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from openprescribing.data.management.commands import benchmark_org_aggregation
+
+
+def test_benchmark_org_aggregation(rxdb, sample_data):
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+
+    call_command(
+        "benchmark_org_aggregation",
+        "1001030U0",
+        "--repeat",
+        "2",
+        stdout=stdout,
+        stderr=stderr,
+    )
+
+    lines = stdout.getvalue().splitlines()
+    assert [line.partition(":")[0] for line in lines] == ["python", "duckdb"]
+    assert all(line.endswith("(2 runs)") for line in lines)
+    assert stderr.getvalue() == ""
+
+
+def test_benchmark_org_aggregation_reports_differences(rxdb, sample_data, monkeypatch):
+    def get_org_date_matrix(cursor, query, org_id_to_practice_ids, date_count):
+        odm = orig_get_org_date_matrix(
+            cursor, query, org_id_to_practice_ids, date_count
+        )
+        return odm * 2
+
+    orig_get_org_date_matrix = benchmark_org_aggregation.get_org_date_matrix.__wrapped__
+    monkeypatch.setattr(
+        benchmark_org_aggregation.get_org_date_matrix,
+        "__wrapped__",
+        get_org_date_matrix,
+    )
+
+    with pytest.raises(CommandError, match="Results from the two paths differ"):
+        call_command(
+            "benchmark_org_aggregation",
+            "1001030U0",
+            "--repeat",
+            "1",
+            stdout=io.StringIO(),
+        )
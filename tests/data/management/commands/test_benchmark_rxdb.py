@@ -0,0 +1,148 @@
+import datetime
+import io
+import json
+
+import pytest
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from openprescribing.data import rxdb, synthetic_data
+from openprescribing.data.management.commands import benchmark_rxdb
+from openprescribing.data.models import BNFCode, Org, OrgRelation
+from openprescribing.data.rxdb import connection
+
+
+EXPECTED_NAMES = [
+    "get_practice_date_matrix[presentation]",
+    "get_practice_date_matrix[product]",
+    "get_practice_date_matrix[chemical]",
+    "get_practice_date_matrix[paragraph]",
+    "get_practice_date_matrix[section]",
+    "get_practice_date_matrix[chapter]",
+    "group_rows",
+    "get_centiles",
+    "api.prescribing_deciles",
+    "api.prescribing_deciles[prescribing]",
+    "api.prescribing_all_orgs",
+    "api.prescribing_medications",
+    "api.metadata_medications",
+    "api.metadata_dmd",
+    "api.metadata_bnf",
+]
+
+
+@pytest.fixture
+def benchmark_settings(settings, tmp_path, monkeypatch, data_db_with_transaction):
+    settings.SQLITE_DATABASE = settings.TEST_SQLITE_DATABASE
+    settings.DUCKDB_MEMORY_LIMIT = "8GB"
+    settings.DUCKDB_TMP_DIRECTORY_LIMIT = "20GB"
+    # The API views should query the database being benchmarked
+    monkeypatch.setattr(rxdb, "get_cursor", connection.get_cursor)
+    bnf_codes = synthetic_data.get_synthetic_bnf_codes(20)
+    practice_codes = synthetic_data.get_synthetic_practice_codes(10)
+    # Queries only match presentations which are in the BNF, so we add most of them
+    for code in bnf_codes[:15]:
+        BNFCode.objects.create(
+            code=code, name="Presentation", level=BNFCode.Level.PRESENTATION
+        )
+    # The API views need some orgs to group practices into
+    for i in range(2):
+        icb = Org.objects.create(id=f"ICB0{i}", name="ICB", org_type=Org.OrgType.ICB)
+        for practice_code in practice_codes[i::2]:
+            practice = Org.objects.create(
+                id=practice_code, name="Practice", org_type=Org.OrgType.PRACTICE
+            )
+            OrgRelation.objects.create(parent=icb, child=practice)
+    synthetic_data.generate(
+        tmp_path / "source",
+        bnf_codes=bnf_codes,
+        practice_codes=practice_codes,
+        month_count=2,
+        rows_per_month=100,
+        end_date=datetime.date(2025, 2, 1),
+    )
+    return settings
+
+
+def test_benchmark_rxdb(benchmark_settings, tmp_path):
+    stdout = io.StringIO()
+    previous_manager = connection.CONNECTION_MANAGER
+
+    call_command(
+        "benchmark_rxdb",
+        "--source-dir",
+        tmp_path / "source",
+        "--repeat",
+        "2",
+        "--output",
+        tmp_path / "results.json",
+        stdout=stdout,
+    )
+
+    lines = stdout.getvalue().splitlines()
+    assert [line.partition(":")[0] for line in lines] == ["ingest", *EXPECTED_NAMES]
+    assert lines[0].endswith("(1 runs)")
+    assert all(line.endswith("(2 runs)") for line in lines[1:])
+    assert (tmp_path / "source" / "prescribing.duckdb").exists()
+    assert connection.CONNECTION_MANAGER is previous_manager
+
+    results = json.loads((tmp_path / "results.json").read_text())
+    assert results["version"] == benchmark_settings.VERSION
+    assert results["database"]["date"] == 2
+    assert results["database"]["practice"] == 10
+    assert list(results["results"]) == ["ingest", *EXPECTED_NAMES]
+
+
+def test_benchmark_rxdb_compare(benchmark_settings, tmp_path):
+    # Benchmark an existing database
+    benchmark_rxdb.time_ingest(
+        tmp_path / "source", tmp_path / "source" / "prescribing.duckdb"
+    )
+    benchmark_settings.PRESCRIBING_DATABASE = tmp_path / "source" / "prescribing.duckdb"
+    previous = {
+        "version": "abc123",
+        "results": {
+            "group_rows": {"median_ms": 0.0},
+            "get_centiles": {"median_ms": 1_000_000.0},
+        },
+    }
+    (tmp_path / "previous.json").write_text(json.dumps(previous))
+    stdout = io.StringIO()
+
+    call_command(
+        "benchmark_rxdb",
+        "--repeat",
+        "1",
+        "--date-count",
+        "1",
+        "--compare",
+        tmp_path / "previous.json",
+        stdout=stdout,
+    )
+
+    comparison = stdout.getvalue().split("\nCompared with abc123:\n")[1]
+    lines = comparison.splitlines()
+    assert len(lines) == 2
+    assert lines[0].startswith("  group_rows: 0.0ms -> ")
+    assert lines[0].endswith("(+0%)")
+    assert lines[1].startswith("  get_centiles: 1000000.0ms -> ")
+    assert lines[1].endswith("(-100%)")
+
+
+def test_benchmark_rxdb_without_database(benchmark_settings, tmp_path):
+    benchmark_settings.PRESCRIBING_DATABASE = tmp_path / "missing.duckdb"
+
+    with pytest.raises(CommandError, match="No database at"):
+        call_command("benchmark_rxdb", stdout=io.StringIO())
+
+
+def test_get_org_id_to_practice_ids_without_orgs(data_db):
+    practice_codes = [f"P{i}" for i in range(100)] + [None]
+
+    org_id_to_practice_ids = benchmark_rxdb.get_org_id_to_practice_ids(practice_codes)
+
+    assert len(org_id_to_practice_ids) == benchmark_rxdb.SYNTHETIC_ORG_COUNT
+    assert org_id_to_practice_ids[0] == ("ORG00", frozenset({"P0", "P42", "P84"}))
+    assert set().union(*(ids for _, ids in org_id_to_practice_ids)) == set(
+        practice_codes[:-1]
+    )
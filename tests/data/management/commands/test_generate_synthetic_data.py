@@ -0,0 +1,50 @@
+import io
+
+import pytest
+from django.core.management import call_command
+
+from openprescribing.data.management.commands import generate_synthetic_data
+from openprescribing.data.models import Org
+
+
+@pytest.mark.django_db(databases=["data"])
+def test_generate_synthetic_data(tmp_path, bnf_codes):
+    Org.objects.create(id="PRAC01", name="Practice 1", org_type=Org.OrgType.PRACTICE)
+    stdout = io.StringIO()
+
+    call_command(
+        "generate_synthetic_data",
+        tmp_path,
+        "--practices",
+        "3",
+        "--months",
+        "2",
+        "--presentations",
+        "10",
+        "--rows-per-month",
+        "20",
+        "--end-date",
+        "2025-02-01",
+        stdout=stdout,
+    )
+
+    assert stdout.getvalue() == (
+        f"Generated 2 months of data for 3 practices and 10 presentations in "
+        f"{tmp_path}\n"
+    )
+    assert len(list((tmp_path / "prescribing").iterdir())) == 2
+    assert len(list((tmp_path / "list_size").iterdir())) == 2
+
+
+def test_get_codes():
+    # Real codes come first, topped up with synthetic codes which don't collide with
+    # them
+    codes = generate_synthetic_data.get_codes(
+        ["B", "C"], lambda count: ["A", "B", "D", "E"][:count], 4
+    )
+    assert codes == ["A", "B", "C", "D"]
+
+
+def test_get_codes_with_more_real_codes_than_needed():
+    codes = generate_synthetic_data.get_codes(["C", "B", "A"], lambda count: [], 2)
+    assert codes == ["A", "B"]
@@ -1,4 +1,5 @@
 import io
+import json
 import logging
 from unittest.mock import Mock
 
@@ -14,8 +15,8 @@ pytestmark = pytest.mark.django_db(databases=["data"])
 
 
 def test_ingest_named_ingestor(monkeypatch):
-    mock_ingestor_1 = Mock()
-    mock_ingestor_2 = Mock()
+    mock_ingestor_1 = Mock(return_value=None)
+    mock_ingestor_2 = Mock(return_value=None)
     monkeypatch.setattr(
         ingest.Command,
         "available_ingestors",
@@ -32,8 +33,8 @@ def test_ingest_named_ingestor(monkeypatch):
 
 
 def test_ingest_all(monkeypatch):
-    mock_ingestor_1 = Mock()
-    mock_ingestor_2 = Mock()
+    mock_ingestor_1 = Mock(return_value=None)
+    mock_ingestor_2 = Mock(return_value=None)
     monkeypatch.setattr(
         ingest.Command,
         "available_ingestors",
@@ -50,7 +51,7 @@ def test_ingest_all(monkeypatch):
 
 
 def test_ingest_force(monkeypatch):
-    mock_ingestor_1 = Mock()
+    mock_ingestor_1 = Mock(return_value=None)
     monkeypatch.setattr(
         ingest.Command,
         "available_ingestors",
@@ -140,3 +141,35 @@ def test_ingest_ensures_main_database_file_is_updated(monkeypatch):
     with django.db.connections["data"].cursor() as cursor:
         assert cursor.execute("SELECT v FROM t").fetchall() == [(1,), (2,), (1,), (2,)]
     assert sqlite_path.stat().st_mtime > initial_mtime
+
+
+def test_ingest_writes_reports(monkeypatch, freezer):
+    log = logging.getLogger("openprescribing.data.ingestors")
+
+    def ingestor(*_, **__):
+        log.info("hello")
+        return {"stages": {"date": {"seconds": 0.1, "rows": 2}}}
+
+    def ingestor_2(*_, **__):
+        log.info("nothing to report")
+
+    monkeypatch.setattr(
+        ingest.Command,
+        "available_ingestors",
+        {
+            "ingestor": ingestor,
+            "ingestor_2": ingestor_2,
+        },
+    )
+
+    freezer.move_to("2025-01-02T03:04:05")
+    stdout = io.StringIO()
+    call_command("ingest", ["all"], stdout=stdout)
+    logs, _, report = stdout.getvalue().partition("{")
+    assert logs == (
+        "2025-01-02T03:04:05 [  ingestor] hello\n"
+        "2025-01-02T03:04:05 [ingestor_2] nothing to report\n"
+    )
+    assert json.loads("{" + report) == {
+        "ingest_report": {"ingestor": {"stages": {"date": {"seconds": 0.1, "rows": 2}}}}
+    }
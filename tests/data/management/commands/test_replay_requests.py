@@ -0,0 +1,103 @@
+import io
+import json
+
+import pytest
+import requests
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import Client
+
+from openprescribing.data.management.commands import replay_requests
+from openprescribing.web import middleware
+
+
+class ClientSession:
+    """Stands in for `requests.Session`, sending requests to the test client."""
+
+    def __init__(self):
+        self.client = Client()
+
+    def get(self, url, timeout):
+        if url.endswith("/unreachable/"):
+            raise requests.ConnectionError()
+        return self.client.get(url.removeprefix("http://testserver"))
+
+
+def write_records(path, records):
+    path.write_text("".join(json.dumps(record) + "\n" for record in records))
+
+
+def test_replay_requests(sample_data, tmp_path, monkeypatch):
+    monkeypatch.setattr(replay_requests.requests, "Session", ClientSession)
+    # Cache lookups are reported in the Server-Timing header
+    monkeypatch.setattr(middleware, "SEND_SERVER_TIMING", True)
+    analysis = {"queries": [{"numerator": {"bnf_codes": ["1001030U0"]}}]}
+    write_records(
+        tmp_path / "requests.jsonl",
+        [
+            {"endpoint": "/api/prescribing-deciles/", "analysis": analysis},
+            {"endpoint": "/api/prescribing-deciles/", "analysis": analysis},
+            {"endpoint": "/api/metadata/bnf/", "analysis": None},
+            {"endpoint": "/unreachable/", "analysis": None},
+            {"endpoint": "/api/metadata/bnf/", "analysis": None},
+        ],
+    )
+    stdout = io.StringIO()
+
+    call_command(
+        "replay_requests",
+        tmp_path / "requests.jsonl",
+        "--base-url",
+        "http://testserver/",
+        "--concurrency",
+        "1",
+        "--limit",
+        "4",
+        stdout=stdout,
+    )
+
+    lines = stdout.getvalue().splitlines()
+    assert lines[0].startswith("4 requests in ")
+    assert lines[1] == "Statuses: 200=3, ConnectionError=1"
+    assert lines[2] == "Latency:"
+    assert lines[3].startswith("  all: p50 ")
+    assert lines[3].endswith("(4 requests)")
+    assert [line.split(":")[0] for line in lines[4:7]] == [
+        "  /api/metadata/bnf/",
+        "  /api/prescribing-deciles/",
+        "  /unreachable/",
+    ]
+    # The second request for the same analysis hits the caches filled by the first
+    hits, misses = [int(n) for n in lines[7].split()[1:4:2]]
+    assert hits > 0
+    assert misses > 0
+
+
+def test_replay_requests_without_cache_lookups(tmp_path, monkeypatch):
+    monkeypatch.setattr(replay_requests.requests, "Session", ClientSession)
+    write_records(
+        tmp_path / "requests.jsonl", [{"endpoint": "/unreachable/", "analysis": None}]
+    )
+    stdout = io.StringIO()
+
+    call_command("replay_requests", tmp_path / "requests.jsonl", stdout=stdout)
+
+    assert stdout.getvalue().splitlines()[-1].startswith("Cache: no lookups reported")
+
+
+def test_replay_requests_with_empty_file(tmp_path):
+    (tmp_path / "requests.jsonl").write_text("\n")
+
+    with pytest.raises(CommandError, match="No requests in"):
+        call_command("replay_requests", tmp_path / "requests.jsonl")
+
+
+def test_parse_server_timing():
+    header = 'cache;dur=1.5;desc="hits=2 misses=1", total;dur=10.0;x=1, empty'
+
+    assert replay_requests.parse_server_timing(header) == {
+        "cache": {"dur": 1.5, "hits": 2, "misses": 1},
+        "total": {"dur": 10.0},
+        "empty": {},
+    }
+    assert replay_requests.parse_server_timing("") == {}
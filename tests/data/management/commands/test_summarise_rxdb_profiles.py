@@ -0,0 +1,86 @@
+import io
+import json
+
+import pytest
+from django.core.management import CommandError, call_command
+
+
+def write_profile(path, label, duration, children):
+    record = {
+        "label": label,
+        "duration": duration,
+        "sampled": True,
+        "profile": {"query_name": "SELECT ...", "children": children},
+    }
+    path.write_text(json.dumps(record))
+
+
+def operator(operator_type, timing, rows, children=()):
+    return {
+        "operator_type": operator_type,
+        "operator_timing": timing,
+        "operator_cardinality": rows,
+        "children": list(children),
+    }
+
+
+def test_summarise_rxdb_profiles(tmp_path):
+    write_profile(
+        tmp_path / "20250101T000000-abc-1.json",
+        "abc",
+        0.5,
+        [operator("PROJECTION", 0.001, 10, [operator("TABLE_SCAN", 0.4, 1000)])],
+    )
+    write_profile(
+        tmp_path / "20250101T000001-def-2.json",
+        "def",
+        1.5,
+        [operator("HASH_GROUP_BY", 1.2, 10, [operator("TABLE_SCAN", 0.2, 1000)])],
+    )
+    write_profile(tmp_path / "20250101T000002-ghi-3.json", "ghi", 0.1, [])
+    stdout = io.StringIO()
+
+    call_command(
+        "summarise_rxdb_profiles",
+        "--profile-dir",
+        tmp_path,
+        "--limit",
+        "2",
+        stdout=stdout,
+    )
+
+    assert stdout.getvalue().splitlines() == [
+        f"3 profiles in {tmp_path}",
+        "",
+        "Slowest operators (by total time):",
+        "  HASH_GROUP_BY: total 1200.0ms, max 1200.0ms, 1 occurrences, 10 rows",
+        "  TABLE_SCAN: total 600.0ms, max 400.0ms, 2 occurrences, 2,000 rows",
+        "",
+        "Slowest queries:",
+        "  1500.0ms analysis=def (20250101T000001-def-2.json), "
+        "slowest operator HASH_GROUP_BY 1200.0ms",
+        "  500.0ms analysis=abc (20250101T000000-abc-1.json), "
+        "slowest operator TABLE_SCAN 400.0ms",
+    ]
+
+
+def test_summarise_rxdb_profiles_with_query_without_operators(tmp_path):
+    write_profile(tmp_path / "20250101T000002-ghi-3.json", "ghi", 0.1, [])
+    stdout = io.StringIO()
+
+    call_command("summarise_rxdb_profiles", "--profile-dir", tmp_path, stdout=stdout)
+
+    assert "  100.0ms analysis=ghi (20250101T000002-ghi-3.json)" in stdout.getvalue()
+
+
+def test_summarise_rxdb_profiles_with_no_profiles(tmp_path):
+    stdout = io.StringIO()
+
+    call_command("summarise_rxdb_profiles", "--profile-dir", tmp_path, stdout=stdout)
+
+    assert stdout.getvalue() == f"0 profiles in {tmp_path}\n"
+
+
+def test_summarise_rxdb_profiles_without_profile_dir():
+    with pytest.raises(CommandError):
+        call_command("summarise_rxdb_profiles")
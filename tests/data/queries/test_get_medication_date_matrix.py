@@ -2,7 +2,7 @@ from datetime import date
 
 from openprescribing.data.bnf_query import BNFQuery
 from openprescribing.data.models import BNFCode
-from openprescribing.data.queries import get_medication_date_matrix
+from openprescribing.data.queries import get_medication_date_matrix, query_utils
 from tests.utils.rxdb_utils import assert_approx_equal
 
 from .alternative_implementations import get_medication_date_matrix_alternative
@@ -113,3 +113,18 @@ def test_get_medication_date_matrix_for_bnf_query(rxdb, sample_data):
     )
 
     assert_approx_equal(mdm, expected_mdm)
+
+
+def test_get_medication_date_matrix_with_partitions(rxdb, sample_data, monkeypatch):
+    monkeypatch.setattr(query_utils, "PARTITION_COUNT", 2)
+    monkeypatch.setattr(query_utils, "MIN_PRESENTATIONS_PER_PARTITION", 1)
+    query = BNFQuery(bnf_codes=["1001030U0"])
+
+    with rxdb.get_cursor() as cursor:
+        mdm = get_medication_date_matrix(cursor, query, date_count=2)
+
+    expected_mdm = get_medication_date_matrix_alternative(
+        sample_data, query, date_count=2
+    )
+
+    assert_approx_equal(mdm, expected_mdm)
@@ -0,0 +1,74 @@
+import numpy as np
+
+from openprescribing.data.bnf_query import BNFQuery
+from openprescribing.data.list_size_query import ListSizeQuery
+from openprescribing.data.models import Org
+from openprescribing.data.queries import get_org_date_matrix, get_practice_date_matrix
+from tests.utils.rxdb_utils import assert_approx_equal
+
+
+def test_get_org_date_matrix_spot_check(rxdb, sample_data):
+    query = BNFQuery(bnf_codes=["1001030U0AAABAB"])
+    org_id_to_practice_ids = (
+        ("ICB00", frozenset({"PRA00", "PRA01"})),
+        # Practices which haven't prescribed are ignored
+        ("ICB01", frozenset({"PRA10", "PRA99"})),
+        # Orgs with no practices get zero values
+        ("ICB02", frozenset()),
+    )
+
+    with rxdb.get_cursor() as cursor:
+        odm = get_org_date_matrix(cursor, query, org_id_to_practice_ids, date_count=2)
+
+    assert odm.row_labels == ("ICB00", "ICB01", "ICB02")
+    assert odm.values.tolist() == [
+        [(3 + 5), (2 + 4)],
+        [7, 6],
+        [0, 0],
+    ]
+
+
+def test_get_org_date_matrix_for_bnf_query(rxdb, sample_data):
+    query = BNFQuery(bnf_codes=["1001030U0"])
+    org_id_to_practice_ids = Org.objects.filter(
+        org_type=Org.OrgType.ICB
+    ).with_practice_ids()
+
+    with rxdb.get_cursor() as cursor:
+        odm = get_org_date_matrix(cursor, query, org_id_to_practice_ids)
+        pdm = get_practice_date_matrix(cursor, query)
+
+    assert_approx_equal(odm, pdm.group_rows(org_id_to_practice_ids))
+
+
+def test_get_org_date_matrix_for_list_sizes(rxdb, sample_data):
+    query = ListSizeQuery()
+    org_id_to_practice_ids = Org.objects.filter(
+        org_type=Org.OrgType.ICB
+    ).with_practice_ids()
+
+    with rxdb.get_cursor() as cursor:
+        odm = get_org_date_matrix(cursor, query, org_id_to_practice_ids)
+        pdm = get_practice_date_matrix(cursor, query)
+
+    assert_approx_equal(odm, pdm.group_rows(org_id_to_practice_ids))
+
+
+def test_get_org_date_matrix_for_float_values(rxdb):
+    class QuantityQuery:
+        def to_sql(self):
+            return "SELECT practice_id, date_id, quantity AS value FROM prescribing"
+
+    rxdb.ingest(
+        [
+            {"practice_code": "PRA00", "quantity": 1.5},
+            {"practice_code": "PRA01", "quantity": 2.25},
+        ]
+    )
+    org_id_to_practice_ids = (("ICB00", frozenset({"PRA00", "PRA01"})),)
+
+    with rxdb.get_cursor() as cursor:
+        odm = get_org_date_matrix(cursor, QuantityQuery(), org_id_to_practice_ids)
+
+    assert odm.values.dtype == np.float64
+    assert odm.values.tolist() == [[3.75]]
@@ -1,3 +1,5 @@
+import pytest
+
 from openprescribing.data.analysis import Analysis
 from openprescribing.data.bnf_query import BNFQuery
 from openprescribing.data.list_size_query import ListSizeQuery
@@ -7,7 +9,10 @@ from tests.utils.rxdb_utils import assert_approx_equal
 from .alternative_implementations import get_org_date_ratio_matrix_alternative
 
 
-def test_get_org_date_ratio_matrix_prescribing_vs_list_size(rxdb, sample_data):
+@pytest.mark.parametrize("aggregate_in_duckdb", [False, True])
+def test_get_org_date_ratio_matrix_prescribing_vs_list_size(
+    rxdb, sample_data, aggregate_in_duckdb
+):
     analysis = Analysis(
         ntr_query=BNFQuery(bnf_codes=["1001030U0AAABAB"]),
         dtr_query=ListSizeQuery(),
@@ -15,14 +20,19 @@ def test_get_org_date_ratio_matrix_prescribing_vs_list_size(rxdb, sample_data):
     )
 
     with rxdb.get_cursor() as cursor:
-        odm = get_org_date_ratio_matrix(cursor, analysis)
+        odm = get_org_date_ratio_matrix(
+            cursor, analysis, aggregate_in_duckdb=aggregate_in_duckdb
+        )
 
     expected_odm = get_org_date_ratio_matrix_alternative(sample_data, analysis)
 
     assert_approx_equal(odm, expected_odm)
 
 
-def test_get_org_date_ratio_matrix_prescribing_vs_prescribing(rxdb, sample_data):
+@pytest.mark.parametrize("aggregate_in_duckdb", [False, True])
+def test_get_org_date_ratio_matrix_prescribing_vs_prescribing(
+    rxdb, sample_data, aggregate_in_duckdb
+):
     analysis = Analysis(
         ntr_query=BNFQuery(bnf_codes=["1001030U0AAABAB"]),
         dtr_query=BNFQuery(bnf_codes=["1001030U0"]),
@@ -30,7 +40,9 @@ def test_get_org_date_ratio_matrix_prescribing_vs_prescribing(rxdb, sample_data)
     )
 
     with rxdb.get_cursor() as cursor:
-        odm = get_org_date_ratio_matrix(cursor, analysis)
+        odm = get_org_date_ratio_matrix(
+            cursor, analysis, aggregate_in_duckdb=aggregate_in_duckdb
+        )
 
     expected_odm = get_org_date_ratio_matrix_alternative(sample_data, analysis)
 
@@ -0,0 +1,400 @@
+import time
+
+import numpy as np
+import pytest
+
+from openprescribing.data.bnf_query import BNFQuery
+from openprescribing.data.list_size_query import ListSizeQuery
+from openprescribing.data.queries import query_utils
+from openprescribing.data.queries.query_utils import (
+    get_grouped_sum_ndarray,
+    get_presentation_id_partitions,
+    resolve_query,
+)
+from openprescribing.data.rxdb import admission
+from openprescribing.data.rxdb.admission import AdmissionController, Overloaded
+from openprescribing.data.rxdb.connection import QueryTimeout
+from openprescribing.data.utils import timing
+
+
+SQL = """
+SELECT
+    practice_id AS row_index,
+    date_id AS column_index,
+    items AS value,
+    presentation_id AS partition_key
+FROM prescribing
+"""
+
+
+@pytest.fixture
+def prescribing(rxdb):
+    rxdb.ingest(
+        [
+            {
+                "bnf_code": bnf_code,
+                "practice_code": practice_code,
+                "date": date,
+                "items": items,
+            }
+            for bnf_code, items in [
+                ("1001030U0AAABAB", 1),
+                ("1001030U0AAACAC", 10),
+                ("1001030U0BDAAAB", 100),
+                ("1001030U0BDABAC", 1000),
+            ]
+            for practice_code in ["ABC123", "DEF456"]
+            for date in ["2025-01-01", "2025-02-01"]
+        ]
+    )
+
+
+def test_get_grouped_sum_ndarray_with_partitions(rxdb, prescribing):
+    with rxdb.get_cursor() as cursor:
+        unpartitioned = get_grouped_sum_ndarray(
+            cursor,
+            row_count=2,
+            col_count=2,
+            sql=f"SELECT row_index, column_index, value FROM ({SQL})",
+        )
+        partitioned = get_grouped_sum_ndarray(
+            cursor,
+            row_count=2,
+            col_count=2,
+            sql=SQL,
+            partitions=((1, 2), (2, 4), (4, 5)),
+        )
+
+    assert unpartitioned.tolist() == [[1111, 1111], [1111, 1111]]
+    assert partitioned.tolist() == unpartitioned.tolist()
+
+
+def test_get_grouped_sum_ndarray_with_partitions_ignores_values_outside_partitions(
+    rxdb, prescribing
+):
+    with rxdb.get_cursor() as cursor:
+        partitioned = get_grouped_sum_ndarray(
+            cursor,
+            row_count=2,
+            col_count=2,
+            sql=SQL,
+            partitions=((1, 2), (3, 4)),
+        )
+
+    assert partitioned.tolist() == [[101, 101], [101, 101]]
+
+
+def test_get_presentation_id_partitions(rxdb, prescribing, bnf_codes, monkeypatch):
+    monkeypatch.setattr(query_utils, "PARTITION_COUNT", 3)
+    monkeypatch.setattr(query_utils, "MIN_PRESENTATIONS_PER_PARTITION", 1)
+    _, codes = resolve_query(BNFQuery(bnf_codes=["1001030U0"]))
+
+    with rxdb.get_cursor() as cursor:
+        partitions = get_presentation_id_partitions(cursor, codes)
+
+    assert partitions == ((1, 3), (3, 4), (4, 5))
+
+
+def test_get_presentation_id_partitions_for_small_query(
+    rxdb, prescribing, bnf_codes, monkeypatch
+):
+    monkeypatch.setattr(query_utils, "PARTITION_COUNT", 3)
+    monkeypatch.setattr(query_utils, "MIN_PRESENTATIONS_PER_PARTITION", 3)
+    _, codes = resolve_query(BNFQuery(bnf_codes=["1001030U0"]))
+
+    with rxdb.get_cursor() as cursor:
+        partitions = get_presentation_id_partitions(cursor, codes)
+
+    assert partitions is None
+
+
+def test_get_presentation_id_partitions_when_disabled(rxdb, prescribing, monkeypatch):
+    monkeypatch.setattr(query_utils, "PARTITION_COUNT", 1)
+
+    with rxdb.get_cursor() as cursor:
+        partitions = get_presentation_id_partitions(cursor, ["1001030U0AAABAB"])
+
+    assert partitions is None
+
+
+def test_get_presentation_id_partitions_for_list_size_query(rxdb, monkeypatch):
+    monkeypatch.setattr(query_utils, "PARTITION_COUNT", 3)
+    _, codes = resolve_query(ListSizeQuery())
+
+    with rxdb.get_cursor() as cursor:
+        partitions = get_presentation_id_partitions(cursor, codes)
+
+    assert partitions is None
+
+
+def test_resolve_query_finds_codes_once(bnf_codes, monkeypatch):
+    query = BNFQuery(bnf_codes=["1001030U0AA"])
+    calls = []
+    original = BNFQuery.get_matching_presentation_codes
+
+    def get_matching_presentation_codes(self):
+        calls.append(self)
+        return original(self)
+
+    monkeypatch.setattr(
+        BNFQuery, "get_matching_presentation_codes", get_matching_presentation_codes
+    )
+
+    query_sql, codes = resolve_query(query)
+
+    assert calls == [query]
+    assert codes == ["1001030U0AAABAB", "1001030U0AAACAC"]
+    assert query_sql == query.to_sql()
+
+
+def test_resolve_query_for_list_size_query():
+    assert resolve_query(ListSizeQuery()) == (ListSizeQuery().to_sql(), None)
+
+
+def test_get_grouped_sum_ndarray_uses_int32_for_narrow_integers(rxdb, prescribing):
+    with rxdb.get_cursor() as cursor:
+        values = get_grouped_sum_ndarray(
+            cursor,
+            row_count=2,
+            col_count=2,
+            sql=f"SELECT row_index, column_index, value FROM ({SQL})",
+        )
+
+    assert values.dtype == np.int32
+
+
+@pytest.mark.parametrize(
+    "value_type, expected_dtype",
+    [
+        ("BIGINT", np.int64),
+        ("FLOAT", np.float64),
+        ("DOUBLE", np.float64),
+    ],
+)
+def test_get_grouped_sum_ndarray_dtypes(rxdb, value_type, expected_dtype):
+    with rxdb.get_cursor() as cursor:
+        values = get_grouped_sum_ndarray(
+            cursor,
+            row_count=1,
+            col_count=1,
+            sql=f"""
+            SELECT 0::UINTEGER AS row_index, 0::UINTEGER AS column_index,
+            1::{value_type} AS value
+            """,
+        )
+
+    assert values.dtype == expected_dtype
+    assert values.tolist() == [[1]]
+
+
+@pytest.mark.parametrize("batch_size", [1, 1024])
+def test_get_grouped_sum_ndarray_promotes_on_overflow(rxdb, monkeypatch, batch_size):
+    monkeypatch.setattr(query_utils, "RECORD_BATCH_SIZE", batch_size)
+    big = 2**31 - 10
+
+    with rxdb.get_cursor() as cursor:
+        values = get_grouped_sum_ndarray(
+            cursor,
+            row_count=2,
+            col_count=1,
+            sql=f"""
+            SELECT row_index::UINTEGER AS row_index, 0::UINTEGER AS column_index,
+            value::UINTEGER AS value
+            FROM (VALUES (0, {big}), (1, {big}), (0, 20)) AS t(row_index, value)
+            """,
+        )
+
+    assert values.dtype == np.int64
+    assert values.tolist() == [[big + 20], [big]]
+
+
+def test_get_grouped_sum_ndarray_does_not_promote_unnecessarily(rxdb, monkeypatch):
+    # The sum of all the values is over the limit, but because the values are in
+    # different cells the actual maximum never is
+    monkeypatch.setattr(query_utils, "RECORD_BATCH_SIZE", 1)
+    big = 2**30 - 1
+
+    with rxdb.get_cursor() as cursor:
+        values = get_grouped_sum_ndarray(
+            cursor,
+            row_count=3,
+            col_count=1,
+            sql=f"""
+            SELECT row_index::UINTEGER AS row_index, 0::UINTEGER AS column_index,
+            value::UINTEGER AS value
+            FROM (VALUES (0, {big}), (1, {big}), (2, {big})) AS t(row_index, value)
+            """,
+        )
+
+    assert values.dtype == np.int32
+    assert values.tolist() == [[big], [big], [big]]
+
+
+@pytest.mark.parametrize(
+    "big, expected_dtype", [(2**29, np.int32), (2**31 - 10, np.int64)]
+)
+def test_get_grouped_sum_ndarray_with_partitions_promotes_on_overflow(
+    rxdb, big, expected_dtype
+):
+    with rxdb.get_cursor() as cursor:
+        values = get_grouped_sum_ndarray(
+            cursor,
+            row_count=1,
+            col_count=1,
+            sql=f"""
+            SELECT 0::UINTEGER AS row_index, 0::UINTEGER AS column_index,
+            value::UINTEGER AS value, partition_key
+            FROM (VALUES (1, {big}), (2, {big})) AS t(partition_key, value)
+            """,
+            partitions=((1, 2), (2, 3)),
+        )
+
+    assert values.dtype == expected_dtype
+    assert values.tolist() == [[big * 2]]
+
+
+def test_get_grouped_sum_ndarray_with_partitions_for_floats(rxdb):
+    with rxdb.get_cursor() as cursor:
+        values = get_grouped_sum_ndarray(
+            cursor,
+            row_count=1,
+            col_count=1,
+            sql="""
+            SELECT 0::UINTEGER AS row_index, 0::UINTEGER AS column_index,
+            value::DOUBLE AS value, partition_key
+            FROM (VALUES (1, 0.5), (2, 0.25)) AS t(partition_key, value)
+            """,
+            partitions=((1, 2), (2, 3)),
+        )
+
+    assert values.dtype == np.float64
+    assert values.tolist() == [[0.75]]
+
+
+def test_get_grouped_sum_ndarray_with_partitions_and_no_rows(rxdb, prescribing):
+    with rxdb.get_cursor() as cursor:
+        values = get_grouped_sum_ndarray(
+            cursor,
+            row_count=0,
+            col_count=2,
+            sql=SQL,
+            partitions=((1, 3), (3, 5)),
+        )
+
+    assert values.shape == (0, 2)
+
+
+def test_get_grouped_sum_ndarray_reports_batches(rxdb, prescribing, monkeypatch):
+    monkeypatch.setattr(query_utils, "RECORD_BATCH_SIZE", 4)
+    batch_sizes = []
+    token = query_utils.batch_callback.set(batch_sizes.append)
+    try:
+        with rxdb.get_cursor() as cursor:
+            get_grouped_sum_ndarray(
+                cursor,
+                row_count=2,
+                col_count=2,
+                sql=f"SELECT row_index, column_index, value FROM ({SQL})",
+            )
+            # Partitions are consumed in other threads, which still need to report
+            get_grouped_sum_ndarray(
+                cursor, row_count=2, col_count=2, sql=SQL, partitions=((1, 3), (3, 5))
+            )
+    finally:
+        query_utils.batch_callback.reset(token)
+
+    assert sorted(batch_sizes[:4]) == [4, 4, 4, 4]
+    assert sorted(batch_sizes[4:]) == [4, 4, 4, 4]
+
+
+def test_get_grouped_sum_ndarray_records_timings(rxdb, prescribing, monkeypatch):
+    monkeypatch.setattr(query_utils, "RECORD_BATCH_SIZE", 4)
+    with timing.collect() as timings:
+        with rxdb.get_cursor() as cursor:
+            get_grouped_sum_ndarray(
+                cursor, row_count=2, col_count=2, sql=SQL, partitions=((1, 3), (3, 5))
+            )
+
+    # Timings from the partitions' threads are added together
+    assert timings.counts["rxdb.query"] == {"partitions": 2}
+    assert timings.counts["rxdb.fetch"]["rows"] == 16
+    assert timings.counts["rxdb.fetch"]["batches"] == 4
+    assert timings.counts["rxdb.fetch"]["bytes"] > 0
+    assert "rxdb.admission" in timings.durations
+    assert "coo_todense" in timings.durations
+
+
+def test_get_query_cost(rxdb, prescribing, bnf_codes, monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_CAPACITY", 4)
+    monkeypatch.setattr(query_utils, "PRESENTATIONS_PER_COST_UNIT", 2)
+
+    def get_query_cost(query):
+        _, codes = resolve_query(query)
+        return query_utils.get_query_cost(cursor, codes)
+
+    with rxdb.get_cursor() as cursor:
+        assert get_query_cost(ListSizeQuery()) == 1
+        assert get_query_cost(BNFQuery(bnf_codes=["1001030U0"])) == 3
+        assert get_query_cost(BNFQuery(bnf_codes=["1001030U0AA"])) == 2
+
+
+def test_get_query_cost_when_admission_disabled(rxdb, prescribing, monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_CAPACITY", 0)
+    monkeypatch.setattr(query_utils, "PRESENTATIONS_PER_COST_UNIT", 2)
+
+    def get_bnf_code_to_presentation_ids(cursor):
+        assert False, "Presentations shouldn't be looked up"
+
+    monkeypatch.setattr(
+        query_utils,
+        "get_bnf_code_to_presentation_ids",
+        get_bnf_code_to_presentation_ids,
+    )
+
+    with rxdb.get_cursor() as cursor:
+        assert query_utils.get_query_cost(cursor, ["1001030U0AAABAB"] * 10) == 1
+
+
+def test_get_grouped_sum_ndarray_waits_for_admission(rxdb, prescribing, monkeypatch):
+    controller = AdmissionController(capacity=2, max_waiting=0, timeout=0)
+    monkeypatch.setattr(admission, "ADMISSION_CAPACITY", 2)
+    monkeypatch.setattr(admission, "ADMISSION_CONTROLLER", controller)
+
+    with rxdb.get_cursor() as cursor:
+        with controller.admit(1):
+            get_grouped_sum_ndarray(
+                cursor,
+                row_count=2,
+                col_count=2,
+                sql=f"SELECT row_index, column_index, value FROM ({SQL})",
+                cost=1,
+            )
+            with pytest.raises(Overloaded):
+                get_grouped_sum_ndarray(
+                    cursor,
+                    row_count=2,
+                    col_count=2,
+                    sql=f"SELECT row_index, column_index, value FROM ({SQL})",
+                    cost=2,
+                )
+
+
+def test_get_grouped_sum_ndarray_stops_waiting_for_admission_at_deadline(
+    rxdb, prescribing, monkeypatch
+):
+    controller = AdmissionController(capacity=1, max_waiting=1, timeout=5)
+    monkeypatch.setattr(admission, "ADMISSION_CAPACITY", 1)
+    monkeypatch.setattr(admission, "ADMISSION_CONTROLLER", controller)
+
+    start = time.monotonic()
+    with rxdb.get_cursor(deadline=start + 0.05) as cursor:
+        with controller.admit(1):
+            with pytest.raises(QueryTimeout):
+                get_grouped_sum_ndarray(
+                    cursor,
+                    row_count=2,
+                    col_count=2,
+                    sql=f"SELECT row_index, column_index, value FROM ({SQL})",
+                )
+
+    assert time.monotonic() - start < 5
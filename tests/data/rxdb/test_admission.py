@@ -0,0 +1,94 @@
+import threading
+import time
+
+import pytest
+
+from openprescribing.data.rxdb import admission
+from openprescribing.data.rxdb.admission import AdmissionController, Overloaded
+
+
+def test_admit_within_capacity():
+    controller = AdmissionController(capacity=3, max_waiting=0, timeout=0)
+
+    with controller.admit(1), controller.admit(2):
+        assert controller.in_use == 3
+
+    assert controller.in_use == 0
+
+
+def test_admit_clamps_cost_to_capacity():
+    controller = AdmissionController(capacity=3, max_waiting=0, timeout=0)
+
+    with controller.admit(100):
+        assert controller.in_use == 3
+    with controller.admit(0):
+        assert controller.in_use == 1
+
+
+def test_admit_rejects_when_too_many_waiting():
+    controller = AdmissionController(capacity=1, max_waiting=0, timeout=5)
+
+    with controller.admit(1):
+        with pytest.raises(Overloaded, match="Too many queries waiting"):
+            controller.admit(1).__enter__()
+
+
+def test_admit_times_out():
+    controller = AdmissionController(capacity=1, max_waiting=1, timeout=0.01)
+
+    with controller.admit(1):
+        with pytest.raises(Overloaded, match="Timed out"):
+            controller.admit(1).__enter__()
+
+    assert controller.waiting == 0
+
+
+def test_admit_stops_waiting_at_deadline():
+    controller = AdmissionController(capacity=1, max_waiting=1, timeout=5)
+
+    start = time.monotonic()
+    with controller.admit(1):
+        with pytest.raises(Overloaded, match="Timed out"):
+            controller.admit(1, deadline=start + 0.01).__enter__()
+        # A deadline which has already passed means we don't wait at all
+        with pytest.raises(Overloaded, match="Timed out"):
+            controller.admit(1, deadline=start - 1).__enter__()
+
+    assert time.monotonic() - start < 5
+
+
+def test_admit_waits_for_capacity():
+    controller = AdmissionController(capacity=2, max_waiting=2, timeout=5)
+    admitted = threading.Event()
+
+    def wait_for_admission():
+        with controller.admit(2):
+            admitted.set()
+
+    with controller.admit(1):
+        thread = threading.Thread(target=wait_for_admission)
+        thread.start()
+        # A cheap query can still go ahead while the expensive one waits
+        with controller.condition:
+            controller.condition.wait_for(lambda: controller.waiting == 1, timeout=5)
+        with controller.admit(1):
+            assert not admitted.is_set()
+
+    thread.join(timeout=5)
+    assert admitted.is_set()
+
+
+def test_module_admit(monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_CONTROLLER", None)
+
+    monkeypatch.setattr(admission, "ADMISSION_CAPACITY", 0)
+    assert not admission.is_enabled()
+    with admission.admit(5):
+        assert admission.ADMISSION_CONTROLLER is None
+
+    monkeypatch.setattr(admission, "ADMISSION_CAPACITY", 4)
+    assert admission.is_enabled()
+    with admission.admit(5):
+        assert admission.ADMISSION_CONTROLLER.in_use == 4
+    with admission.admit(1):
+        assert admission.ADMISSION_CONTROLLER.in_use == 1
@@ -1,15 +1,22 @@
 import functools
+import os
 import sqlite3
+import time
 
 import duckdb
+import pytest
 
 from openprescribing.data.rxdb import connection
+from openprescribing.data.rxdb.profiling import Profiler
 from openprescribing.data.utils.filename_utils import get_temp_filename_for
 
 
 def test_connection_get_cursor(tmp_path, monkeypatch, settings):
     monkeypatch.setattr(connection, "CONNECTION_MANAGER", None)
     monkeypatch.setattr(connection, "CREATE_VIEWS_PATH", tmp_path / "views.sql")
+    monkeypatch.setattr(connection, "MATERIALISED_VIEWS", ())
+    # This test relies on changes being picked up as soon as we ask for a cursor
+    monkeypatch.setattr(connection, "WATCH_FILES", False)
     settings.PRESCRIBING_DATABASE = tmp_path / "prescribing.duckdb"
     settings.SQLITE_DATABASE = tmp_path / "data.sqlite"
 
@@ -163,3 +170,245 @@ def test_get_cursor_cache_key_wrapper(tmp_path):
 
     assert cached_query.cache_info().hits == 2
     assert cached_query.cache_info().misses == 3
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    monkeypatch.setattr(connection, "WATCHDOG", None)
+    duckdb_file = tmp_path / "data.duckdb"
+    sqlite_file = tmp_path / "data.sqlite"
+    duckdb.connect(duckdb_file).close()
+    sqlite3.connect(sqlite_file).close()
+    return connection.ConnectionManager(
+        duckdb_file=duckdb_file,
+        sqlite_file=sqlite_file,
+    )
+
+
+SLOW_SQL = "SELECT i % 100, sum(i) FROM range(10000000000) t(i) GROUP BY ALL"
+
+
+def test_get_cursor_with_deadline_interrupts_query(manager):
+    with pytest.raises(connection.QueryTimeout):
+        with manager.get_cursor(deadline=time.monotonic() + 0.1) as cursor:
+            cursor.execute(SLOW_SQL)
+
+
+def test_get_cursor_with_deadline_interrupts_streaming_results(manager):
+    with pytest.raises(connection.QueryTimeout):
+        with manager.get_cursor(deadline=time.monotonic() + 0.1) as cursor:
+            results = cursor.sql("SELECT i FROM range(10000000000) t(i)")
+            for _ in results.to_arrow_reader(batch_size=1000):
+                pass
+
+
+def test_get_cursor_with_deadline_for_duplicate_cursor(manager):
+    with manager.get_cursor(deadline=time.monotonic() + 0.1) as cursor:
+        with pytest.raises(connection.QueryTimeout):
+            with cursor.duplicate() as duplicate:
+                assert duplicate.deadline == cursor.deadline
+                duplicate.execute(SLOW_SQL)
+
+
+def test_get_cursor_with_deadline_when_query_finishes_in_time(manager):
+    with manager.get_cursor(deadline=time.monotonic() + 60) as cursor:
+        assert cursor.execute("SELECT 1").fetchall() == [(1,)]
+        cursor.check_deadline()
+
+    assert not cursor.interrupted
+    assert connection.WATCHDOG.watched == {}
+
+
+def test_get_cursor_with_deadline_leaves_other_errors_alone(manager):
+    with pytest.raises(duckdb.CatalogException):
+        with manager.get_cursor(deadline=time.monotonic() + 60) as cursor:
+            cursor.execute("SELECT * FROM no_such_table")
+
+
+def test_check_deadline(manager):
+    with manager.get_cursor(deadline=time.monotonic() - 1) as cursor:
+        with pytest.raises(connection.QueryTimeout):
+            cursor.check_deadline()
+
+    with manager.get_cursor() as cursor:
+        cursor.check_deadline()
+
+
+def test_watchdog_skips_closed_cursors(manager):
+    watchdog = connection.Watchdog()
+    # Not starting the thread lets us drive the watchdog by hand
+    watchdog.thread = "not started"
+    with manager.get_cursor() as cursor_1, manager.get_cursor() as cursor_2:
+        cursor_1.deadline = 1
+        cursor_2.deadline = 2
+        watchdog.watch(cursor_1)
+        watchdog.watch(cursor_2)
+        watchdog.unwatch(cursor_1)
+
+        watchdog.interrupt_overdue(now=1.5)
+        assert watchdog.heap != []
+        assert not cursor_2.interrupted
+
+        watchdog.interrupt_overdue(now=2)
+        assert watchdog.heap == []
+        assert cursor_2.interrupted
+
+
+def test_connection_manager_materialised_views(tmp_path):
+    duckdb_file = tmp_path / "data.duckdb"
+    sqlite_file = tmp_path / "data.sqlite"
+    duckdb.connect(duckdb_file).close()
+    sqlite_conn = sqlite3.connect(sqlite_file)
+    sqlite_conn.executescript(
+        """
+        CREATE TABLE foo (v INT);
+        INSERT INTO foo VALUES (1), (2), (3);
+        """
+    )
+    sqlite_conn.commit()
+
+    manager = connection.ConnectionManager(
+        duckdb_file=duckdb_file,
+        sqlite_file=sqlite_file,
+        init_sql="CREATE VIEW total AS SELECT sum(v) AS v FROM foo",
+        materialised_views=["total"],
+    )
+
+    with manager.get_cursor() as cursor:
+        assert cursor.execute("SELECT v FROM total").fetchall() == [(6,)]
+        table_type = cursor.execute(
+            "SELECT table_type FROM information_schema.tables WHERE table_name = 'total'"
+        ).fetchone()
+        assert table_type == ("BASE TABLE",)
+
+    cache_key = manager.get_cache_key()
+    sqlite_conn.execute("UPDATE foo SET v = v * 2")
+    sqlite_conn.commit()
+    # Make sure the modification time changes even on filesystems with coarse
+    # timestamps
+    os.utime(sqlite_file, ns=(0, sqlite_file.stat().st_mtime_ns + 1_000_000_000))
+
+    # Changing the SQLite file gives us a new connection, with the view re-materialised
+    with manager.get_cursor() as cursor:
+        assert cursor.execute("SELECT v FROM total").fetchall() == [(12,)]
+    assert manager.get_cache_key() != cache_key
+
+
+def test_connection_manager_snapshot_tables(tmp_path):
+    duckdb_file = tmp_path / "data.duckdb"
+    sqlite_file = tmp_path / "data.sqlite"
+    duckdb.connect(duckdb_file).close()
+    sqlite_conn = sqlite3.connect(sqlite_file)
+    sqlite_conn.executescript(
+        """
+        CREATE TABLE foo (v INT);
+        INSERT INTO foo VALUES (1), (2), (3);
+        """
+    )
+    sqlite_conn.commit()
+
+    manager = connection.ConnectionManager(
+        duckdb_file=duckdb_file,
+        sqlite_file=sqlite_file,
+        snapshot_tables=["foo"],
+    )
+
+    def get_foo():
+        with manager.get_cursor() as cursor:
+            return cursor.execute("SELECT v FROM foo ORDER BY v").fetchall()
+
+    with manager.get_cursor() as cursor:
+        table_catalogs = cursor.execute(
+            "SELECT table_catalog FROM information_schema.tables "
+            "WHERE table_name = 'foo' ORDER BY table_catalog"
+        ).fetchall()
+    assert table_catalogs == [("memory",), ("sqlite_db",)]
+    assert get_foo() == [(1,), (2,), (3,)]
+
+    # Changes aren't seen until the SQLite file's modification time changes...
+    mtime_ns = sqlite_file.stat().st_mtime_ns
+    sqlite_conn.execute("UPDATE foo SET v = v * 2")
+    sqlite_conn.commit()
+    os.utime(sqlite_file, ns=(0, mtime_ns))
+    assert get_foo() == [(1,), (2,), (3,)]
+
+    # ...at which point we take a new snapshot
+    os.utime(sqlite_file, ns=(0, mtime_ns + 1_000_000_000))
+    assert get_foo() == [(2,), (4,), (6,)]
+
+
+def test_connection_manager_snapshot_tables_for_medications(
+    rxdb, dmd_data, tmp_path, settings
+):
+    duckdb_file = tmp_path / "data.duckdb"
+    duckdb.connect(duckdb_file).close()
+
+    manager = connection.ConnectionManager(
+        duckdb_file=duckdb_file,
+        sqlite_file=settings.TEST_SQLITE_DATABASE,
+        init_sql=connection.CREATE_VIEWS_PATH.read_text(),
+        materialised_views=connection.MATERIALISED_VIEWS,
+        snapshot_tables=connection.SNAPSHOT_SQLITE_TABLES,
+    )
+
+    with manager.get_cursor() as cursor:
+        snapshot_rows = cursor.execute(
+            "SELECT * FROM medications ORDER BY id"
+        ).fetchall()
+    with rxdb.get_cursor() as cursor:
+        view_rows = cursor.execute("SELECT * FROM medications ORDER BY id").fetchall()
+
+    assert len(snapshot_rows) > 0
+    assert snapshot_rows == view_rows
+
+
+def test_connection_manager_watches_for_changes(tmp_path):
+    duckdb_file = tmp_path / "data.duckdb"
+    sqlite_file = tmp_path / "data.sqlite"
+    duckdb.connect(duckdb_file).close()
+    sqlite3.connect(sqlite_file).close()
+
+    manager = connection.ConnectionManager(
+        duckdb_file=duckdb_file,
+        sqlite_file=sqlite_file,
+        watch_poll_interval=60,
+    )
+    cache_key = manager.get_cache_key()
+    generation = manager.generation
+
+    mtime_ns = sqlite_file.stat().st_mtime_ns
+    os.utime(sqlite_file, ns=(0, mtime_ns + 1_000_000_000))
+
+    # The watcher thread reconnects without our having to ask for a cursor
+    deadline = time.monotonic() + 5
+    while manager.generation is generation and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert manager.get_cache_key() != cache_key
+    with manager.get_cursor() as cursor:
+        assert cursor.cache_key == manager.get_cache_key()
+
+
+def test_cursor_profiled(tmp_path):
+    duckdb_file = tmp_path / "data.duckdb"
+    sqlite_file = tmp_path / "data.sqlite"
+    duckdb.connect(duckdb_file).close()
+    sqlite3.connect(sqlite_file).close()
+    manager = connection.ConnectionManager(
+        duckdb_file=duckdb_file,
+        sqlite_file=sqlite_file,
+        profiler=Profiler(tmp_path / "profiles", sample_rate=1),
+    )
+
+    with manager.get_cursor(label="abc123") as cursor:
+        with cursor.duplicate() as duplicate:
+            assert duplicate.label == "abc123"
+            with duplicate.profiled():
+                duplicate.execute("SELECT 1").fetchall()
+
+    (path,) = (tmp_path / "profiles").glob("*-abc123-*.json")
+
+
+def test_cursor_profiled_without_profiler(manager):
+    with manager.get_cursor() as cursor:
+        with cursor.profiled():
+            assert cursor.execute("SELECT 1").fetchall() == [(1,)]
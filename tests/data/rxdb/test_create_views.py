@@ -1,3 +1,6 @@
+from openprescribing.data.rxdb.connection import ConnectionManager
+
+
 def test_medications(rxdb, dmd_data):
 
     # Confirm that we can query the medications table.
@@ -55,3 +58,20 @@ def test_medications(rxdb, dmd_data):
                 [],  # ingredient_ids
             )
         ]
+
+
+def test_materialised_medications(rxdb, dmd_data):
+    with rxdb.get_cursor() as cursor:
+        view_rows = cursor.execute("SELECT * FROM medications ORDER BY id").fetchall()
+        ConnectionManager.materialise_view(cursor, "medications")
+        table_rows = cursor.execute("SELECT * FROM medications ORDER BY id").fetchall()
+        table_types = cursor.execute(
+            """
+            SELECT table_catalog, table_type FROM information_schema.tables
+            WHERE table_name = 'medications'
+            """
+        ).fetchall()
+
+    assert len(view_rows) > 0
+    assert table_rows == view_rows
+    assert table_types == [("memory", "BASE TABLE")]
@@ -0,0 +1,93 @@
+import threading
+import time
+
+from openprescribing.data.rxdb import file_watcher
+from openprescribing.data.rxdb.file_watcher import (
+    INOTIFY_EVENT,
+    FileWatcher,
+    get_inotify_fd,
+    parse_inotify_names,
+)
+
+
+def test_file_watcher_calls_callback_on_change(tmp_path):
+    path = tmp_path / "data.db"
+    path.write_text("")
+    called = threading.Event()
+
+    watcher = FileWatcher([path], callback=called.set, poll_interval=60).start()
+    path.write_text("changed")
+
+    assert called.wait(timeout=5)
+    watcher.stop()
+    path.write_text("changed again")
+    watcher.thread.join(timeout=5)
+    assert not watcher.thread.is_alive()
+
+
+def test_file_watcher_polls_without_inotify(tmp_path, monkeypatch):
+    monkeypatch.setattr(file_watcher, "get_inotify_fd", lambda directories: None)
+    called = threading.Event()
+
+    watcher = FileWatcher([tmp_path / "data.db"], callback=called.set, poll_interval=0)
+    assert watcher.inotify_fd is None
+    watcher.start()
+
+    assert called.wait(timeout=5)
+    watcher.stop()
+
+
+def test_file_watcher_logs_callback_errors(tmp_path, caplog):
+    calls = []
+    called_twice = threading.Event()
+
+    def callback():
+        calls.append(1)
+        if len(calls) == 2:
+            called_twice.set()
+        raise ValueError("oops")
+
+    watcher = FileWatcher([tmp_path / "data.db"], callback=callback, poll_interval=0)
+    watcher.start()
+
+    # The watcher keeps going after an error
+    assert called_twice.wait(timeout=5)
+    watcher.stop()
+    assert "Error handling change to watched files" in caplog.text
+
+
+def test_file_watcher_ignores_other_files(tmp_path):
+    path = tmp_path / "data.db"
+    other_path = tmp_path / "other.db"
+    watcher = FileWatcher([path], callback=None, poll_interval=60)
+    finished = threading.Event()
+
+    def wait():
+        watcher.wait_for_change()
+        finished.set()
+
+    thread = threading.Thread(target=wait)
+    thread.start()
+    other_path.write_text("")
+    assert not finished.wait(timeout=0.2)
+    path.write_text("")
+    assert finished.wait(timeout=5)
+
+
+def test_file_watcher_ignores_other_files_until_poll_interval(tmp_path):
+    watcher = FileWatcher([tmp_path / "data.db"], callback=None, poll_interval=0.1)
+    (tmp_path / "other.db").write_text("")
+
+    start = time.monotonic()
+    watcher.wait_for_change()
+    assert time.monotonic() - start < 5
+
+
+def test_get_inotify_fd_for_missing_directory(tmp_path):
+    assert get_inotify_fd([tmp_path / "missing"]) is None
+
+
+def test_parse_inotify_names():
+    data = INOTIFY_EVENT.pack(1, 2, 0, 8) + b"a.db\0\0\0\0"
+    data += INOTIFY_EVENT.pack(1, 2, 0, 0)
+    assert parse_inotify_names(data) == {b"a.db", b""}
@@ -0,0 +1,106 @@
+import json
+
+import duckdb
+import pytest
+
+from openprescribing.data.rxdb import profiling
+from openprescribing.data.rxdb.profiling import Profiler
+
+
+def run_query(profiler, label="abc123"):
+    cursor = duckdb.connect()
+    with profiler.profile(cursor, label):
+        cursor.sql(
+            "SELECT i % 10, sum(i) FROM range(1000) t(i) GROUP BY ALL"
+        ).fetchall()
+    return cursor
+
+
+def test_profile_sampled(tmp_path):
+    profiler = Profiler(tmp_path / "profiles", sample_rate=1)
+
+    cursor = run_query(profiler)
+
+    (path,) = (tmp_path / "profiles").glob("*.json")
+    assert "-abc123-" in path.name
+    record = json.loads(path.read_text())
+    assert record["label"] == "abc123"
+    assert record["sampled"]
+    assert record["duration"] > 0
+    assert "GROUP BY" in record["profile"]["query_name"]
+    # Profiling is switched off again afterwards
+    cursor.sql("SELECT 1").fetchall()
+    assert json.loads(cursor.get_profiling_information()) == {"result": "disabled"}
+
+
+def test_profile_over_threshold(tmp_path):
+    profiler = Profiler(tmp_path, threshold=0)
+
+    run_query(profiler, label=None)
+
+    (path,) = tmp_path.glob("*.json")
+    assert "-unlabelled-" in path.name
+    assert not json.loads(path.read_text())["sampled"]
+
+
+def test_profile_under_threshold(tmp_path):
+    profiler = Profiler(tmp_path, threshold=60)
+
+    run_query(profiler)
+
+    assert list(tmp_path.glob("*.json")) == []
+
+
+def test_profile_not_sampled(tmp_path):
+    profiler = Profiler(tmp_path, sample_rate=0)
+
+    cursor = run_query(profiler)
+
+    assert list(tmp_path.glob("*.json")) == []
+    assert json.loads(cursor.get_profiling_information()) == {"result": "disabled"}
+
+
+def test_profile_when_query_fails(tmp_path):
+    profiler = Profiler(tmp_path, sample_rate=1)
+    cursor = duckdb.connect()
+
+    with pytest.raises(duckdb.CatalogException):
+        with profiler.profile(cursor):
+            cursor.sql("SELECT * FROM no_such_table")
+
+    assert list(tmp_path.glob("*.json")) == []
+
+
+def test_profile_rotates_files(tmp_path):
+    profiler = Profiler(tmp_path, sample_rate=1, max_files=2)
+    for name in ["20250101T000000-a.json", "20250102T000000-b.json"]:
+        (tmp_path / name).write_text("{}")
+
+    run_query(profiler)
+
+    paths = sorted(path.name for path in tmp_path.glob("*.json"))
+    assert paths[0] == "20250102T000000-b.json"
+    assert "-abc123-" in paths[1]
+
+
+def test_profile_logs_write_errors(tmp_path, caplog):
+    (tmp_path / "not_a_directory").touch()
+    profiler = Profiler(tmp_path / "not_a_directory", sample_rate=1)
+
+    run_query(profiler)
+
+    assert "Error writing query profile" in caplog.text
+
+
+def test_get_profiler(monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_DIR", "")
+    assert profiling.get_profiler() is None
+
+    monkeypatch.setattr(profiling, "PROFILE_DIR", "/tmp/profiles")
+    monkeypatch.setattr(profiling, "PROFILE_SAMPLE_RATE", 0.5)
+    profiler = profiling.get_profiler()
+    assert profiler.sample_rate == 0.5
+    assert profiler.threshold is None
+
+    monkeypatch.setattr(profiling, "PROFILE_THRESHOLD_SECONDS", "2.5")
+    assert profiling.get_profiler().threshold == 2.5
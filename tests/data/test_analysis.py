@@ -91,3 +91,15 @@ def test_from_dict_ingredients():
     }
     analysis = Analysis.from_dict(analysis_dict)
     assert analysis.to_dict() == analysis_dict
+
+
+@pytest.mark.django_db(databases=["data"])
+def test_get_hash():
+    def analysis(**extra):
+        return Analysis.from_dict(
+            {"queries": [{"numerator": {"bnf_codes": ["01"]}}], **extra}
+        )
+
+    assert analysis().get_hash() == analysis().get_hash()
+    assert analysis().get_hash() != analysis(org_id="PRAC01").get_hash()
+    assert len(analysis().get_hash()) == 16
@@ -2,11 +2,13 @@ import re
 
 import pytest
 
+from openprescribing.data import bnf_query
 from openprescribing.data.bnf_query import (
     BNFQuery,
     ProductType,
     _expand_forms_and_routes,
 )
+from openprescribing.data.utils.cache_metrics import get_cache_stats
 
 
 def test_init_normalizes_lists_to_tuples():
@@ -467,6 +469,23 @@ def test_get_matching_presentation_codes_with_combined_exclusions(medications):
     assert query.get_matching_presentation_codes() == ["1001030U0AAACAC"]
 
 
+def test_get_matching_presentation_codes_caches_medications_lookups(medications):
+    medications.add_rows(
+        [
+            {"bnf_code": "1001030U0AAABAB", "vtm_id": 90356005},
+            {"bnf_code": "1001030U0AAACAC"},
+        ]
+    )
+    query = BNFQuery(bnf_codes=["1001030U0"], vtm_ids=[90356005])
+    cache_name = f"{bnf_query.__name__}._get_bnf_codes_for_medications_matching_cached"
+    hits = get_cache_stats()[cache_name].hits
+
+    assert query.get_matching_presentation_codes() == ["1001030U0AAABAB"]
+    assert query.get_matching_presentation_codes() == ["1001030U0AAABAB"]
+
+    assert get_cache_stats()[cache_name].hits == hits + 1
+
+
 def test_describe_search_for_all_product_types(bnf_codes):
     query = BNFQuery(bnf_codes=["1001030U0"], bnf_codes_excluded=["1001030U0_AB"])
     assert query.describe() == {
@@ -0,0 +1,114 @@
+import datetime
+
+import pyarrow.parquet
+
+from openprescribing.data import synthetic_data
+
+
+def test_generate(tmp_path):
+    bnf_codes = synthetic_data.get_synthetic_bnf_codes(20)
+    practice_codes = synthetic_data.get_synthetic_practice_codes(10)
+
+    synthetic_data.generate(
+        tmp_path,
+        bnf_codes=bnf_codes,
+        practice_codes=practice_codes,
+        month_count=3,
+        rows_per_month=50,
+        end_date=datetime.date(2025, 3, 15),
+    )
+
+    assert sorted(p.name for p in (tmp_path / "prescribing").iterdir()) == [
+        "prescribing_2025-01-01_v1_synthetic.parquet",
+        "prescribing_2025-02-01_v1_synthetic.parquet",
+        "prescribing_2025-03-01_v1_synthetic.parquet",
+    ]
+    assert sorted(p.name for p in (tmp_path / "list_size").iterdir()) == [
+        "list_size_2025-01-01_v2_synthetic.parquet",
+        "list_size_2025-02-01_v2_synthetic.parquet",
+        "list_size_2025-03-01_v2_synthetic.parquet",
+    ]
+
+    prescribing = pyarrow.parquet.read_table(
+        tmp_path / "prescribing" / "prescribing_2025-03-01_v1_synthetic.parquet"
+    ).to_pylist()
+    assert 0 < len(prescribing) <= 50
+    assert set(prescribing[0]) == {
+        "BNF_CODE",
+        "SNOMED_CODE",
+        "PRACTICE_CODE",
+        "QUANTITY",
+        "ITEMS",
+        "TOTAL_QUANTITY",
+        "NIC",
+        "ACTUAL_COST",
+    }
+    # Like the files written by the fetcher, every value is a string
+    assert all(isinstance(value, str) for row in prescribing for value in row.values())
+    assert {row["BNF_CODE"] for row in prescribing} <= set(bnf_codes)
+    assert {row["PRACTICE_CODE"] for row in prescribing} <= set(practice_codes)
+    # Each practice prescribes each presentation at most once a month
+    keys = [(row["PRACTICE_CODE"], row["BNF_CODE"]) for row in prescribing]
+    assert len(keys) == len(set(keys))
+
+    list_size = pyarrow.parquet.read_table(
+        tmp_path / "list_size" / "list_size_2025-03-01_v2_synthetic.parquet"
+    ).to_pylist()
+    assert {row["ORG_CODE"] for row in list_size} <= set(practice_codes)
+    assert all(int(row["NUMBER_OF_PATIENTS"]) > 0 for row in list_size)
+
+
+def test_generate_is_repeatable(tmp_path):
+    kwargs = {
+        "bnf_codes": synthetic_data.get_synthetic_bnf_codes(20),
+        "practice_codes": synthetic_data.get_synthetic_practice_codes(10),
+        "month_count": 1,
+        "rows_per_month": 50,
+        "end_date": datetime.date(2025, 1, 1),
+    }
+    synthetic_data.generate(tmp_path / "a", **kwargs)
+    synthetic_data.generate(tmp_path / "b", **kwargs)
+
+    path = "prescribing/prescribing_2025-01-01_v1_synthetic.parquet"
+    assert pyarrow.parquet.read_table(tmp_path / "a" / path).equals(
+        pyarrow.parquet.read_table(tmp_path / "b" / path)
+    )
+
+
+def test_generate_defaults_to_last_month(tmp_path):
+    synthetic_data.generate(
+        tmp_path,
+        bnf_codes=synthetic_data.get_synthetic_bnf_codes(1),
+        practice_codes=synthetic_data.get_synthetic_practice_codes(1),
+        month_count=1,
+        rows_per_month=1,
+    )
+
+    last_month = datetime.date.today().replace(day=1) - datetime.timedelta(days=1)
+    (path,) = (tmp_path / "prescribing").iterdir()
+    assert path.name == f"prescribing_{last_month.replace(day=1)}_v1_synthetic.parquet"
+
+
+def test_get_month_starts():
+    assert synthetic_data.get_month_starts(datetime.date(2025, 2, 10), 3) == [
+        datetime.date(2024, 12, 1),
+        datetime.date(2025, 1, 1),
+        datetime.date(2025, 2, 1),
+    ]
+
+
+def test_get_synthetic_bnf_codes():
+    codes = synthetic_data.get_synthetic_bnf_codes(1000)
+
+    assert len(codes) == len(set(codes)) == 1000
+    assert codes == sorted(codes)
+    assert all(len(code) == 15 for code in codes)
+    assert codes[:3] == ["010101000AAAAAA", "010101000AAABAB", "010101000AAACAC"]
+
+
+def test_get_synthetic_practice_codes():
+    codes = synthetic_data.get_synthetic_practice_codes(100_001)
+
+    assert len(set(codes)) == 100_001
+    assert codes[0] == "A00000"
+    assert codes[-1] == "B00000"
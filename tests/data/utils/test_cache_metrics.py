@@ -0,0 +1,146 @@
+import numpy as np
+import scipy.sparse
+
+from openprescribing.data.rxdb.labelled_matrix import LabelledMatrix
+from openprescribing.data.utils import cache_metrics, timing
+from openprescribing.data.utils.cache_metrics import (
+    get_cache_stats,
+    get_size,
+    metered_cache,
+)
+
+
+def test_metered_cache():
+    calls = []
+
+    @metered_cache(maxsize=2)
+    def double(x, y=0):
+        calls.append(x)
+        return np.full(10, x * 2 + y, dtype="int64")
+
+    assert list(double(1)) == [2] * 10
+    assert list(double(1)) == [2] * 10
+    assert list(double(1, y=1)) == [3] * 10
+    assert list(double(1, 1)) == [3] * 10
+    assert calls == [1, 1, 1]
+
+    stats = get_cache_stats()[f"{__name__}.test_metered_cache.<locals>.double"]
+    assert stats == cache_metrics.CacheStats(
+        hits=1, misses=3, evictions=1, entries=2, bytes=160
+    )
+
+
+def test_metered_cache_evicts_least_recently_used():
+    @metered_cache(maxsize=2)
+    def identity(x):
+        return x
+
+    identity(1)
+    identity(2)
+    identity(1)
+    identity(3)
+
+    assert list(identity.entries) == [(1,), (3,)]
+
+
+def test_metered_cache_unbounded():
+    @metered_cache()
+    def identity(x):
+        return x
+
+    for x in range(200):
+        identity(x)
+
+    assert identity.stats.entries == 200
+    assert identity.stats.evictions == 0
+
+
+def test_metered_cache_with_name():
+    @metered_cache(name="custom")
+    def identity(x):
+        return x
+
+    assert identity(1) == 1
+    assert identity.name == "custom"
+    assert cache_metrics.CACHES["custom"] is identity
+
+
+def test_metered_cache_when_another_thread_has_filled_entry():
+    @metered_cache()
+    def identity(x):
+        # Simulate another thread computing and storing the same entry while we were
+        # computing it
+        identity.entries[(x,)] = x, 1
+        return x
+
+    assert identity(1) == 1
+    assert identity.stats.bytes == 0
+
+
+def test_metered_cache_clear():
+    @metered_cache()
+    def identity(x):
+        return x
+
+    identity(1)
+    identity(1)
+    identity.cache_clear()
+
+    assert identity.entries == {}
+    assert identity.stats == cache_metrics.CacheStats(hits=1, misses=1)
+
+
+def test_metered_cache_preserves_wrapped():
+    def identity(x):
+        return x
+
+    cached = metered_cache()(identity)
+
+    assert cached(1) == 1
+    assert cached.__wrapped__ is identity
+    assert cached.__name__ == "identity"
+
+
+def test_metered_cache_records_timings():
+    @metered_cache()
+    def identity(x):
+        return x
+
+    with timing.collect() as timings:
+        identity(1)
+        identity(1)
+        identity(2)
+
+    assert timings.counts["cache"] == {"hits": 1, "misses": 2}
+    assert timings.durations["cache"] >= 0
+
+
+def test_get_size():
+    values = np.zeros((3, 4), dtype="int32")
+    matrix = LabelledMatrix(values, ("a", "b", "c"), (1, 2, 3, 4))
+    sparse = scipy.sparse.csr_matrix(np.eye(3, dtype="int64"))
+
+    assert get_size(values) == 48
+    assert get_size(matrix) == 48 + get_size(("a", "b", "c")) + get_size((1, 2, 3, 4))
+    assert get_size(sparse) == sparse.data.nbytes + sparse.indices.nbytes + (
+        sparse.indptr.nbytes
+    )
+    assert get_size(sparse.dot) == get_size(sparse)
+    assert get_size([values]) > 48
+    assert get_size({"a": values}) > 48
+    assert get_size(LabelledMatrix) > 0
+
+
+def test_observe():
+    @metered_cache(name="observed")
+    def identity(x):
+        return x
+
+    identity(1)
+    identity(1)
+
+    observations = {
+        observation.attributes["cache.name"]: observation.value
+        for observation in cache_metrics.observe("hits")(None)
+    }
+    assert observations["observed"] == 1
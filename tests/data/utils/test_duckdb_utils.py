@@ -1,8 +1,12 @@
 import json
 
 import duckdb
+import pytest
 
-from openprescribing.data.utils.duckdb_utils import ProfilingConnection
+from openprescribing.data.utils.duckdb_utils import (
+    ProfilingConnection,
+    parse_memory_size,
+)
 
 
 def test_profiling_connection(tmp_path):
@@ -13,3 +17,22 @@ def test_profiling_connection(tmp_path):
     q1, q2 = [json.loads(q.read_text()) for q in sorted(tmp_path.iterdir())]
     assert q1["query_name"] == "SELECT 1"
     assert q2["query_name"] == "SELECT 2"
+
+
+@pytest.mark.parametrize(
+    "size, expected",
+    [
+        ("8GB", 8_000_000_000),
+        ("512 MiB", 512 * 1024**2),
+        (" 1.5gb ", 1_500_000_000),
+        ("100b", 100),
+    ],
+)
+def test_parse_memory_size(size, expected):
+    assert parse_memory_size(size) == expected
+
+
+@pytest.mark.parametrize("size", ["8", "8 gigabytes", "GB"])
+def test_parse_memory_size_with_invalid_size(size):
+    with pytest.raises(ValueError, match="Invalid memory size"):
+        parse_memory_size(size)
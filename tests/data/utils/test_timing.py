@@ -0,0 +1,73 @@
+import threading
+
+from openprescribing.data.utils import timing
+
+
+def test_span_records_durations_and_counts():
+    with timing.collect() as timings:
+        with timing.span("scan") as counts:
+            counts["rows"] = 10
+        with timing.span("scan") as counts:
+            counts["rows"] = 5
+        timing.record("fetch", 0.25, batches=2)
+
+    assert timings.durations["scan"] > 0
+    assert timings.counts["scan"] == {"rows": 15}
+    assert timings.durations["fetch"] == 0.25
+    assert timings.counts["fetch"] == {"batches": 2}
+
+
+def test_span_records_duration_when_block_raises():
+    with timing.collect() as timings:
+        try:
+            with timing.span("scan"):
+                raise ValueError()
+        except ValueError:
+            pass
+
+    assert "scan" in timings.durations
+
+
+def test_record_without_collect_does_nothing():
+    with timing.span("scan"):
+        pass
+    timing.record("fetch", 1.0)
+
+    assert timing.current_timings.get() is None
+
+
+def test_timings_are_thread_safe():
+    timings = timing.Timings()
+
+    def add():
+        for _ in range(1000):
+            timings.add("step", 1.0, rows=1)
+
+    threads = [threading.Thread(target=add) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert timings.durations["step"] == 4000.0
+    assert timings.counts["step"]["rows"] == 4000
+
+
+def test_to_server_timing():
+    timings = timing.Timings()
+    timings.add("rxdb.query", 0.0123, rows=100, batches=1)
+    timings.add("json encode", 0.002)
+
+    assert timings.to_server_timing() == (
+        'rxdb.query;dur=12.3;desc="rows=100 batches=1", json-encode;dur=2.0'
+    )
+
+
+def test_to_attributes():
+    timings = timing.Timings()
+    timings.add("rxdb.query", 0.5, rows=100)
+
+    assert timings.to_attributes() == {
+        "timing.rxdb.query.ms": 500.0,
+        "timing.rxdb.query.rows": 100,
+    }
@@ -0,0 +1,10 @@
+import time
+
+
+def wait_until_finished(job, timeout=5):
+    """Poll `job` until it has finished, as clients do."""
+
+    deadline = time.monotonic() + timeout
+    while not job.is_finished:
+        assert time.monotonic() < deadline, f"Job {job.id} didn't finish in time"
+        time.sleep(0.01)
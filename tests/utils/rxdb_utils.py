@@ -1,4 +1,3 @@
-import contextlib
 import datetime
 import uuid
 
@@ -98,15 +97,16 @@ class RXDBFixture:
         self.has_data = False
         self.cache_key = None
 
-    def get_cursor(self):
+    def get_cursor(self, deadline=None, label=None):
         if not self.has_data:
             # Ingest one prescribing record to ensure that DuckDB tables are created.
             self.ingest([{}])
         cursor = self.conn.cursor()
         cursor.execute("SET search_path = 'memory,sqlite_db'")
         cursor.execute(CREATE_VIEWS_PATH.read_text())
-        wrapped = CursorCacheKeyWrapper(cursor, self.cache_key)
-        return contextlib.closing(wrapped)
+        return CursorCacheKeyWrapper(
+            cursor, self.cache_key, deadline=deadline, label=label
+        )
 
     def ingest(self, prescribing_data, list_size_data=()):
         rxdb_ingest(
@@ -149,12 +149,16 @@ def rxdb_ingest(conn, prescribing_data=(), list_size_data=()):
         [], schema=VMP_CODE_CHANGES_SOURCE_SCHEMA
     )
     # Register the PyArrow Tables so they can be queried like any other table in DuckDB
-    conn.register("prescribing_source", prescribing_source)
     conn.register("list_size_source", list_size_source)
     conn.register("bnf_code_changes_source", bnf_code_changes_source)
     conn.register("vmp_code_changes_source", vmp_code_changes_source)
+    # The prescribing source is also queried by the ingest's workers, which have their
+    # own connections and so can't see tables registered with ours
+    conn.register("prescribing_source_data", prescribing_source)
+    conn.sql("CREATE TABLE prescribing_source AS SELECT * FROM prescribing_source_data")
     ingest_sources(conn)
-    conn.unregister("prescribing_source")
+    conn.sql("DROP TABLE prescribing_source")
+    conn.unregister("prescribing_source_data")
     conn.unregister("list_size_source")
     conn.unregister("bnf_code_changes_source")
     conn.unregister("vmp_code_changes_source")
@@ -3,12 +3,14 @@ from urllib.parse import urlencode
 
 import pytest
 
-from openprescribing.web import api
+from openprescribing.data.analysis import Analysis
+from openprescribing.web import api, jobs
 from tests.utils.data_utils import (
     DateRelativeToIndexDate,
     default_date_relative_to_index_date,
 )
 from tests.utils.ingest_utils import ingest_dmd_bnf_map_data, ingest_dmd_data
+from tests.utils.job_utils import wait_until_finished
 
 
 def _analysis_dict_to_param(analysis_dict):
@@ -374,3 +376,86 @@ def test_nans_to_nones():
     records = [{"k1": 1.0, "k2": "aaa"}, {"k1": float("NaN"), "k2": "bbb"}]
     api.nans_to_nones(records)
     assert records == [{"k1": 1.0, "k2": "aaa"}, {"k1": None, "k2": "bbb"}]
+
+
+@pytest.fixture
+def job_manager(monkeypatch):
+    job_manager = jobs.JobManager(max_workers=1)
+    monkeypatch.setattr(jobs, "JOB_MANAGER", job_manager)
+    yield job_manager
+    job_manager.executor.shutdown()
+
+
+ANALYSIS_DICT = {
+    "queries": [
+        {
+            "numerator": {
+                "bnf_codes": ["1001030U0"],
+            },
+        },
+    ],
+    "org_id": "PRA00",
+}
+
+
+def _submit_analysis_job(client, analysis_dict):
+    return client.post(
+        "/api/analysis-jobs/",
+        data=json.dumps(analysis_dict),
+        content_type="application/json",
+    )
+
+
+def test_analysis_job(client, sample_data, job_manager):
+    rsp = _submit_analysis_job(client, ANALYSIS_DICT)
+    assert rsp.status_code == 202
+    job_id = rsp.json()["id"]
+    assert rsp["Location"] == f"/api/analysis-jobs/{job_id}/"
+
+    # The job is identified by the analysis's hash and the current data version
+    assert job_id.startswith(Analysis.from_dict(ANALYSIS_DICT).get_hash())
+
+    wait_until_finished(job_manager.get(job_id))
+
+    rsp = client.get(f"/api/analysis-jobs/{job_id}/")
+    payload = rsp.json()
+    assert payload["status"] == "complete"
+    assert payload["progress"]["batches"] > 0
+
+    # The results match those from the synchronous endpoints
+    param = _analysis_dict_to_param(ANALYSIS_DICT)
+    all_orgs = client.get(f"/api/prescribing-all-orgs/?{param}").json()
+    deciles = client.get(f"/api/prescribing-deciles/?{param}").json()
+    assert payload["result"] == {
+        "all_orgs": all_orgs["all_orgs"],
+        "deciles": deciles["deciles"],
+        "org": all_orgs["org"],
+    }
+
+    # Resubmitting the same analysis gives the same job
+    rsp = _submit_analysis_job(client, ANALYSIS_DICT)
+    assert rsp.json()["id"] == job_id
+
+
+def test_submit_analysis_job_with_invalid_analysis(client, sample_data, job_manager):
+    rsp = _submit_analysis_job(
+        client, {"queries": [{"numerator": {"bnf_codes": ["XYZ"]}}]}
+    )
+    assert rsp.status_code == 400
+    assert rsp.json()["error"].startswith("Invalid analysis")
+
+    rsp = client.post(
+        "/api/analysis-jobs/", data="not json", content_type="application/json"
+    )
+    assert rsp.status_code == 400
+
+
+def test_submit_analysis_job_when_busy(client, sample_data, job_manager, monkeypatch):
+    monkeypatch.setattr(jobs, "MAX_UNFINISHED_JOBS", 0)
+    rsp = _submit_analysis_job(client, ANALYSIS_DICT)
+    assert rsp.status_code == 503
+    assert rsp["Retry-After"] == "5"
+
+
+def test_analysis_job_not_found(client, job_manager):
+    assert client.get("/api/analysis-jobs/missing/").status_code == 404
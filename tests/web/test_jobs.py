@@ -0,0 +1,132 @@
+import json
+import threading
+
+import pytest
+
+from openprescribing.data.queries import query_utils
+from openprescribing.web import jobs
+from tests.utils.job_utils import wait_until_finished
+
+
+@pytest.fixture
+def job_manager():
+    job_manager = jobs.JobManager(max_workers=1)
+    yield job_manager
+    job_manager.executor.shutdown()
+
+
+def test_job_reports_progress_and_result(job_manager):
+    def fn():
+        callback = query_utils.batch_callback.get()
+        callback(10)
+        callback(5)
+        return b'{"answer": 42}'
+
+    job = job_manager.submit("abc", fn)
+    wait_until_finished(job)
+
+    assert job.to_dict() == {
+        "id": "abc",
+        "status": "complete",
+        "progress": {"batches": 2, "rows": 15},
+    }
+    assert json.loads(job.to_json()) == {
+        "id": "abc",
+        "status": "complete",
+        "progress": {"batches": 2, "rows": 15},
+        "result": {"answer": 42},
+    }
+    assert job_manager.get("abc") is job
+
+
+def test_job_reports_failure(job_manager, caplog):
+    def fn():
+        raise ValueError("SELECT * FROM secret")
+
+    job = job_manager.submit("abc", fn)
+    wait_until_finished(job)
+
+    assert json.loads(job.to_json()) == {
+        "id": "abc",
+        "status": "failed",
+        "progress": {"batches": 0, "rows": 0},
+        "error": "Analysis failed",
+    }
+    # The details are logged rather than shown to clients
+    assert "SELECT * FROM secret" in caplog.text
+
+
+def test_submit_deduplicates_jobs(job_manager):
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        release.wait(timeout=5)
+
+    job_1 = job_manager.submit("abc", fn)
+    job_2 = job_manager.submit("abc", fn)
+    release.set()
+    wait_until_finished(job_1)
+    job_3 = job_manager.submit("abc", fn)
+
+    assert job_1 is job_2 is job_3
+    assert calls == [1]
+
+
+def test_submit_retries_failed_jobs(job_manager):
+    def fail():
+        raise ValueError("oops")
+
+    job_1 = job_manager.submit("abc", fail)
+    wait_until_finished(job_1)
+    job_2 = job_manager.submit("abc", lambda: b'"ok"')
+    wait_until_finished(job_2)
+
+    assert job_2 is not job_1
+    assert job_2.result == b'"ok"'
+
+
+def test_submit_rejects_jobs_when_busy(job_manager, monkeypatch):
+    monkeypatch.setattr(jobs, "MAX_UNFINISHED_JOBS", 2)
+    release = threading.Event()
+
+    job_1 = job_manager.submit("a", lambda: release.wait(timeout=5))
+    job_manager.submit("b", lambda: None)
+    with pytest.raises(jobs.TooManyJobs):
+        job_manager.submit("c", lambda: None)
+
+    release.set()
+    wait_until_finished(job_1)
+
+
+def test_submit_discards_finished_jobs_over_size_limit(job_manager, monkeypatch):
+    monkeypatch.setattr(jobs, "MAX_FINISHED_JOBS_BYTES", 20)
+
+    for job_id in ["a", "b", "c", "d"]:
+        wait_until_finished(job_manager.submit(job_id, lambda: b"x" * 10))
+
+    # Finished jobs are only discarded on submission, so the newest finished job
+    # survives alongside the two before it
+    assert list(job_manager.jobs) == ["b", "c", "d"]
+
+
+def test_submit_discards_expired_finished_jobs(job_manager, monkeypatch):
+    monkeypatch.setattr(jobs, "FINISHED_JOB_TTL_SECONDS", 60)
+    wait_until_finished(job_manager.submit("a", lambda: b"1"))
+    wait_until_finished(job_manager.submit("b", lambda: b"2"))
+    job_manager.jobs["a"].finished_at -= 120
+
+    release = threading.Event()
+    job_manager.submit("c", lambda: release.wait(timeout=5) and b"3")
+
+    # Unfinished jobs are never discarded
+    assert list(job_manager.jobs) == ["b", "c"]
+    release.set()
+
+
+def test_get_job_manager(monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_MANAGER", None)
+    job_manager = jobs.get_job_manager()
+    assert jobs.get_job_manager() is job_manager
+    job_manager.executor.shutdown()
@@ -0,0 +1,154 @@
+import json
+from urllib.parse import urlencode
+
+import pytest
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+from django.test import Client, RequestFactory
+
+from openprescribing.data.analysis import Analysis
+from openprescribing.data.queries import query_utils
+from openprescribing.data.rxdb.admission import Overloaded
+from openprescribing.web import api, middleware
+from openprescribing.web.middleware import (
+    QueryErrorMiddleware,
+    RequestCaptureMiddleware,
+    ServerTimingMiddleware,
+)
+
+
+ANALYSIS_PARAM = urlencode(
+    {"analysis": json.dumps({"queries": [{"numerator": {"bnf_codes": ["1001030U0"]}}]})}
+)
+
+
+def test_query_error_middleware_for_overloaded(client, sample_data, monkeypatch):
+    def admit(cost, deadline=None):
+        raise Overloaded("Too many queries waiting to run")
+
+    monkeypatch.setattr(query_utils, "admit", admit)
+
+    rsp = client.get(f"/api/prescribing-deciles/?{ANALYSIS_PARAM}")
+
+    assert rsp.status_code == 503
+    assert rsp["Retry-After"] == "5"
+
+
+def test_query_error_middleware_for_timeout(client, sample_data, monkeypatch):
+    # The deadline will have passed by the time we try to start the query
+    monkeypatch.setattr(api, "QUERY_TIMEOUT_SECONDS", -1)
+
+    rsp = client.get(f"/api/prescribing-deciles/?{ANALYSIS_PARAM}")
+
+    assert rsp.status_code == 504
+
+
+def test_query_error_middleware_ignores_other_exceptions():
+    middleware = QueryErrorMiddleware(lambda request: HttpResponse("hello"))
+    request = RequestFactory().get("/")
+
+    assert middleware(request).content == b"hello"
+    assert middleware.process_exception(request, ValueError()) is None
+
+
+def test_server_timing_middleware(client, sample_data, monkeypatch):
+    monkeypatch.setattr(middleware, "SEND_SERVER_TIMING", True)
+    rsp = client.get(f"/api/prescribing-deciles/?{ANALYSIS_PARAM}")
+
+    metrics = [metric.split(";")[0] for metric in rsp["Server-Timing"].split(", ")]
+    assert {
+        "bnf.resolve",
+        "rxdb.admission",
+        "rxdb.query",
+        "rxdb.fetch",
+        "coo_todense",
+        "group_rows",
+        "centiles",
+        "json",
+        "total",
+    } <= set(metrics)
+
+
+def test_server_timing_middleware_in_debug_mode(client, sample_data, settings):
+    settings.DEBUG = True
+    rsp = client.get(f"/api/prescribing-deciles/?{ANALYSIS_PARAM}")
+
+    assert "total" in rsp["Server-Timing"]
+
+
+def test_server_timing_middleware_does_not_send_header_by_default(client, sample_data):
+    rsp = client.get(f"/api/prescribing-deciles/?{ANALYSIS_PARAM}")
+
+    assert "Server-Timing" not in rsp
+
+
+def test_server_timing_middleware_without_timings():
+    middleware = ServerTimingMiddleware(lambda request: HttpResponse("hello"))
+
+    rsp = middleware(RequestFactory().get("/"))
+
+    assert "Server-Timing" not in rsp
+
+
+def test_request_capture_middleware(client, sample_data, tmp_path, monkeypatch):
+    capture_file = tmp_path / "requests.jsonl"
+    monkeypatch.setattr(
+        "openprescribing.web.middleware.REQUEST_CAPTURE_FILE", str(capture_file)
+    )
+    analysis_dict = {
+        "queries": [{"numerator": {"bnf_codes": ["1001030U0"]}}],
+        "org_id": "ICB01",
+    }
+
+    client.get(f"/api/prescribing-deciles/?{ANALYSIS_PARAM}")
+    client.get(
+        "/api/prescribing-all-orgs/?"
+        + urlencode({"analysis": json.dumps(analysis_dict)})
+    )
+    client.get("/api/metadata/bnf/")
+    Client(raise_request_exception=False).get(
+        "/api/prescribing-deciles/?analysis=not-json"
+    )
+    client.get("/measures/")
+
+    records = [json.loads(line) for line in capture_file.read_text().splitlines()]
+    assert [(r["endpoint"], r["status"]) for r in records] == [
+        ("/api/prescribing-deciles/", 200),
+        ("/api/prescribing-all-orgs/", 200),
+        ("/api/metadata/bnf/", 200),
+        ("/api/prescribing-deciles/", 500),
+    ]
+    analysis = Analysis.from_dict(analysis_dict)
+    assert records[1]["analysis"] == json.loads(
+        json.dumps(analysis.to_dict(), default=str)
+    )
+    assert records[1]["analysis_hash"] == analysis.get_hash()
+    assert records[1]["org_id"] == "ICB01"
+    assert records[0]["org_id"] is None
+    assert records[2]["analysis"] is None
+    assert records[3]["analysis_hash"] is None
+    # Equivalent analyses have the same hash
+    assert (
+        records[0]["analysis_hash"]
+        == Analysis.from_dict(
+            {"queries": [{"numerator": {"bnf_codes": ["1001030U0"]}}]}
+        ).get_hash()
+    )
+
+
+def test_request_capture_middleware_not_used_by_default():
+    with pytest.raises(MiddlewareNotUsed):
+        RequestCaptureMiddleware(lambda request: HttpResponse("hello"))
+
+
+def test_request_capture_middleware_with_unwritable_file(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(
+        "openprescribing.web.middleware.REQUEST_CAPTURE_FILE",
+        str(tmp_path / "missing" / "requests.jsonl"),
+    )
+    capture_middleware = RequestCaptureMiddleware(lambda request: HttpResponse("hello"))
+
+    rsp = capture_middleware(RequestFactory().get("/api/metadata/bnf/"))
+
+    assert rsp.content == b"hello"
+    assert "Error capturing request" in caplog.text